@@ -9,12 +9,11 @@ from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from django.utils.timezone import now
-from wagtail.contrib.wagtailfrontendcache.utils import (purge_page_from_cache,
-                                                        purge_url_from_cache)
 from wagtail.wagtailcore.models import Page
 
 from analytics import utils
-from core.models import HomePage
+from caching.invalidate import get_page_urls, purge_urls
+from core.models import HomePage, rebuild_layouts
 
 
 def get_creds_path():
@@ -122,6 +121,11 @@ class Command(BaseCommand):
                 analytics.last_period_views = sessions
                 analytics.save()
 
-        purge_url_from_cache(settings.BASE_URL + 'most-popular/')
-        for page in HomePage.objects.live():
-            purge_page_from_cache(page)
+            # Once for the whole import, the most popular sections depending on the views
+            transaction.on_commit(rebuild_layouts)
+
+            # Once the layouts are rebuilt, from the page cache as well as Cloudflare
+            urls = [settings.BASE_URL + 'most-popular/']
+            for page in HomePage.objects.live():
+                urls.extend(get_page_urls(page))
+            purge_urls(urls)
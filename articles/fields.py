@@ -164,6 +164,8 @@ class RelatedItemsBlock(ThemeableStructBlock):
 
     class Meta:
         template = "articles/blocks/related_items_block.html"
+        # Shows the current title and URL of other pages
+        cacheable = False
 
 
 class StaticHTMLInput(Widget):
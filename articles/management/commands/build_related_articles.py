@@ -0,0 +1,20 @@
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from articles.related import build_related_index, sparse
+
+
+class Command(BaseCommand):
+    help = 'Score the related articles of every live article and series'
+
+    def handle(self, *args, **options):
+        start = time.time()
+        count = build_related_index()
+        self.stdout.write('Indexed the related articles of {} pages in {:.3f}s{}'.format(
+            count,
+            time.time() - start,
+            '' if sparse is not None else ' (without NumPy and SciPy)',
+        ))
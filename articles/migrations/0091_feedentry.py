@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_feed_entries(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    ArticlePage = apps.get_model('articles', 'ArticlePage')
+    SeriesPage = apps.get_model('articles', 'SeriesPage')
+    ArticleTopicLink = apps.get_model('articles', 'ArticleTopicLink')
+    ArticleAuthorLink = apps.get_model('articles', 'ArticleAuthorLink')
+    FeedEntry = apps.get_model('articles', 'FeedEntry')
+
+    for model in (ArticlePage, SeriesPage):
+        content_type = ContentType.objects.get_for_model(model)
+        for page in model.objects.filter(live=True):
+            topic_ids = set()
+            if page.primary_topic_id:
+                topic_ids.add(page.primary_topic_id)
+
+            if model is ArticlePage:
+                topic_ids.update(ArticleTopicLink.objects.filter(article_id=page.pk).values_list('topic_id', flat=True))
+                authors = ArticleAuthorLink.objects.filter(article_id=page.pk)
+                flags = {'visualization': page.visualization, 'interview': page.interview}
+            else:
+                authors = ArticleAuthorLink.objects.filter(article__series_links__series_id=page.pk)
+                flags = {}
+
+            entry = FeedEntry.objects.create(
+                page_id=page.pk,
+                content_type=content_type,
+                first_published_at=page.first_published_at,
+                editors_pick=page.editors_pick,
+                sticky=page.sticky,
+                slippery=page.slippery,
+                primary_topic_id=page.primary_topic_id,
+                image_id=page.main_image_id,
+                **flags
+            )
+            entry.topics.set(topic_ids)
+            entry.authors.set(set(authors.filter(author__isnull=False).values_list('author_id', flat=True)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('people', '0010_auto_20151005_2125'),
+        ('wagtailcore', '0040_page_draft_title'),
+        ('images', '0008_auto_20170302_2108'),
+        ('articles', '0090_auto_20171213_1849'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedEntry',
+            fields=[
+                ('page', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='feed_entry', serialize=False, to='wagtailcore.Page')),
+                ('first_published_at', models.DateTimeField(db_index=True, null=True)),
+                ('visualization', models.BooleanField(default=False)),
+                ('interview', models.BooleanField(default=False)),
+                ('editors_pick', models.BooleanField(default=False)),
+                ('sticky', models.BooleanField(default=False)),
+                ('slippery', models.BooleanField(default=False)),
+                ('authors', models.ManyToManyField(related_name='_feedentry_authors_+', to='people.ContributorPage')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.ContentType')),
+                ('image', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='images.AttributedImage')),
+                ('primary_topic', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='articles.Topic')),
+                ('topics', models.ManyToManyField(related_name='_feedentry_topics_+', to='articles.Topic')),
+            ],
+            options={
+                'verbose_name_plural': 'Feed Entries',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='feedentry',
+            index_together=set([('slippery', 'sticky', 'first_published_at'), ('content_type', 'first_published_at')]),
+        ),
+        migrations.RunPython(create_feed_entries, migrations.RunPython.noop),
+    ]
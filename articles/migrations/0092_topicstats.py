@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def create_topic_stats(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Topic = apps.get_model('articles', 'Topic')
+    TopicListPage = apps.get_model('articles', 'TopicListPage')
+    TopicStats = apps.get_model('articles', 'TopicStats')
+    FeedEntry = apps.get_model('articles', 'FeedEntry')
+
+    article_type = ContentType.objects.get_for_model(apps.get_model('articles', 'ArticlePage'))
+    per_page = TopicListPage.objects.filter(live=True).values_list('articles_per_page', flat=True).first() or 20
+
+    for topic in Topic.objects.all():
+        entries = FeedEntry.objects.filter(topics=topic)
+        article_count = entries.filter(content_type=article_type).count()
+        series_count = entries.exclude(content_type=article_type).count()
+        latest = entries.aggregate(latest=models.Max(Coalesce('page__last_published_at', 'first_published_at')))
+        TopicStats.objects.create(
+            topic=topic,
+            article_count=article_count,
+            series_count=series_count,
+            latest_published_at=latest['latest'],
+            page_count=max(1, -(-(article_count + series_count) // per_page)),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('articles', '0091_feedentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TopicStats',
+            fields=[
+                ('topic', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='articles.Topic')),
+                ('article_count', models.PositiveIntegerField(default=0)),
+                ('series_count', models.PositiveIntegerField(default=0)),
+                ('latest_published_at', models.DateTimeField(null=True)),
+                ('page_count', models.PositiveIntegerField(default=1)),
+            ],
+            options={
+                'verbose_name_plural': 'Topic Stats',
+            },
+        ),
+        migrations.AlterField(
+            model_name='feedentry',
+            name='topics',
+            field=models.ManyToManyField(related_name='feed_entries', to='articles.Topic'),
+        ),
+        migrations.RunPython(create_topic_stats, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,18 @@
 from __future__ import absolute_import, division, unicode_literals
 
 import logging
-from itertools import chain
 from operator import attrgetter
 
 from django import forms
-from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.conf import settings
+from django.core.paginator import EmptyPage, PageNotAnInteger
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
-from django.db.models import Count
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, transaction
+from django.db.models import Prefetch, prefetch_related_objects
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.shortcuts import get_object_or_404, render
 from django.utils.encoding import python_2_unicode_compatible
 from modelcluster.fields import ParentalKey
@@ -19,7 +23,9 @@ from wagtail.wagtailadmin.edit_handlers import (FieldPanel, InlinePanel,
                                                 StreamFieldPanel,
                                                 TabbedInterface)
 from wagtail.wagtailcore.fields import RichTextField
-from wagtail.wagtailcore.models import Orderable, Page
+from wagtail.wagtailcore.models import (Orderable, Page, PageManager,
+                                        PageQuerySet)
+from wagtail.wagtailcore.signals import page_published, page_unpublished
 from wagtail.wagtaildocs.edit_handlers import DocumentChooserPanel
 from wagtail.wagtailimages.edit_handlers import ImageChooserPanel
 from wagtail.wagtailsearch import index
@@ -28,10 +34,19 @@ from wagtail.wagtailsnippets.models import register_snippet
 
 from core.base import (PaginatedListPageMixin, ShareLinksMixin,
                        UniquelySlugable, VideoDocumentMixin)
+from core.bulk import defer, deferred_side_effects
+from core.cache_tags import (add_cache_tags, add_page_tags, get_listing_tag,
+                             get_tag)
+from core.layout import resolve_articles
+from core.memo import memoized_property
+from core.pagination import KeysetPaginator, is_cursor
+from core.rich_text import prefetch_listing_rich_text
+from images.models import AttributedImage
 from people.models import ContributorPage
 from themes.models import ThemeablePage
 
 from . import fields as article_fields
+from .references import defer_stream_references
 
 logger = logging.getLogger('OpenCanada.ArticleModels')
 
@@ -42,6 +57,7 @@ class ArticleListPage(PaginatedListPageMixin, ThemeablePage):
     articles_per_page = models.IntegerField(default=20)
     counter_field_name = 'articles_per_page'
     counter_context_name = 'articles'
+    keyset_field = 'feed_entry__first_published_at'
 
     filter_choices = [
         ('visualizations', 'Visualizations'),
@@ -53,16 +69,18 @@ class ArticleListPage(PaginatedListPageMixin, ThemeablePage):
 
     @property
     def subpages(self):
+        # Live articles have a feed entry
+        articles = ArticlePage.objects.filter(feed_entry__isnull=False).order_by('-feed_entry__first_published_at').for_listing()
         if self.filter == "visualizations":
-            subpages = ArticlePage.objects.live().filter(visualization=True).order_by('-first_published_at')
+            subpages = articles.filter(feed_entry__visualization=True)
         elif self.filter == "interviews":
-            subpages = ArticlePage.objects.live().filter(interview=True).order_by('-first_published_at')
+            subpages = articles.filter(feed_entry__interview=True)
         elif self.filter == "editors_pick":
-            subpages = ArticlePage.objects.live().filter(editors_pick=True).order_by('-first_published_at')
+            subpages = articles.filter(feed_entry__editors_pick=True)
         elif self.filter == "most_popular":
-            subpages = ArticlePage.objects.live().exclude(analytics__isnull=True).order_by('-analytics__last_period_views', '-first_published_at')[:self.articles_per_page]
+            subpages = ArticlePage.objects.live().exclude(analytics__isnull=True).order_by('-analytics__last_period_views', '-first_published_at').for_listing()[:self.articles_per_page]
         else:
-            subpages = ArticlePage.objects.live().order_by('-first_published_at')
+            subpages = articles
 
         return subpages
 
@@ -90,7 +108,7 @@ class ExternalArticleListPage(PaginatedListPageMixin, ThemeablePage):
 
     @property
     def subpages(self):
-        subpages = ExternalArticlePage.objects.live().descendant_of(self).order_by('-first_published_at')
+        subpages = ExternalArticlePage.objects.live().descendant_of(self).order_by('-first_published_at').for_listing()
         return subpages
 
     content_panels = Page.content_panels + [
@@ -115,18 +133,12 @@ class Topic(UniquelySlugable, index.Indexed):
         return self.name
 
     @property
-    def item_list(self):
-        article_list = ArticlePage.objects.live().filter(
-            models.Q(primary_topic=self) | models.Q(topic_links__topic=self)
-        ).order_by('-first_published_at').distinct()
-
-        series_list = SeriesPage.objects.live().filter(
-            primary_topic=self
-        ).order_by('-first_published_at').distinct()
+    def entries(self):
+        return FeedEntry.objects.filter(topics=self).order_by('-first_published_at')
 
-        return sorted(chain(article_list, series_list),
-                      key=lambda x: x.first_published_at,
-                      reverse=True)
+    @property
+    def item_list(self):
+        return get_entry_pages(self.entries)
 
     class Meta:
         ordering = ["name", ]
@@ -143,16 +155,23 @@ register_snippet(Topic)
 
 
 class TopicListPage(RoutablePageMixin, ThemeablePage):
+    lists_pages = True
+    # The field of the feed entries the topic pages are paged on, see core/pagination.py
+    keyset_field = 'first_published_at'
+
     articles_per_page = models.IntegerField(default=20)
 
     @property
     def topics(self):
         popular_topics = Topic.objects.annotate(
-            num_articles=Count('article_links') + Count('articles') + Count('series')).order_by("-num_articles")[:25]
+            num_articles=Coalesce(models.F('stats__article_count') + models.F('stats__series_count'), models.Value(0))
+        ).order_by("-num_articles")[:25]
         return sorted(popular_topics, key=lambda x: x.name)
 
     @route(r'^$', name="topic_list")
     def topics_list(self, request):
+        add_cache_tags(request, ['topics'])
+
         context = {
             "self": self,
         }
@@ -162,9 +181,14 @@ class TopicListPage(RoutablePageMixin, ThemeablePage):
     def topic_view(self, request, topic_slug):
         topic = get_object_or_404(Topic, slug=topic_slug)
 
-        articles = topic.item_list
-
-        paginator = Paginator(articles, self.articles_per_page)
+        # Only the pages listed on the page asked for are loaded
+        paginator = KeysetPaginator(
+            topic.entries,
+            self.articles_per_page,
+            'topic-{}-{}'.format(self.pk, topic.pk),
+            self.keyset_field,
+            resolve=get_listed_pages,
+        )
         page = request.GET.get('page')
 
         try:
@@ -174,6 +198,11 @@ class TopicListPage(RoutablePageMixin, ThemeablePage):
         except EmptyPage:
             articles = paginator.page(paginator.num_pages)
 
+        add_cache_tags(request, [get_tag('topic', topic.pk)])
+        add_page_tags(request, articles.object_list)
+        if is_cursor(page):
+            add_cache_tags(request, [get_listing_tag(self)])
+
         context = {
             "self": self,
             "topic": topic,
@@ -181,19 +210,22 @@ class TopicListPage(RoutablePageMixin, ThemeablePage):
         }
         return render(request, "articles/topic_page.html", context)
 
-    def get_cached_paths(self):
+    def serve(self, request, view=None, args=None, kwargs=None):
+        # The routes don't go through ThemeablePage.serve()
+        return self.serve_conditionally(request, super(TopicListPage, self).serve, view, args, kwargs)
+
+    def get_cached_paths(self, topics=None):
         yield '/'
 
-        for topic in Topic.objects.all():
-            articles = ArticlePage.objects.live().filter(
-                models.Q(primary_topic=topic) | models.Q(topic_links__topic=topic)
-            ).order_by('-first_published_at').distinct()
-            paginator = Paginator(articles, self.articles_per_page)
+        topic_pages = Topic.objects.all()
+        if topics is not None:
+            topic_pages = topic_pages.filter(pk__in=[topic.pk for topic in topics])
 
-            topic_url = '/{}/'.format(topic.slug)
+        for slug, page_count in topic_pages.values_list('slug', 'stats__page_count'):
+            topic_url = '/{}/'.format(slug)
             yield topic_url
 
-            for page_number in range(2, paginator.num_pages + 1):
+            for page_number in range(2, (page_count or 1) + 1):
                 yield topic_url + '?page=' + str(page_number)
 
     content_panels = Page.content_panels + [
@@ -307,6 +339,85 @@ class PageLayoutOptions(models.Model):
         abstract = True
 
 
+def get_article_listing_prefetches(prefix=''):
+    '''
+    Return the lookups prefetching what the teaser of an article shows, for articles at `prefix`:
+    the renditions of its image, and its authors and topics.
+    '''
+    return [
+        prefix + 'main_image__renditions',
+        Prefetch(prefix + 'author_links', queryset=ArticleAuthorLink.objects.select_related('author')),
+        Prefetch(prefix + 'topic_links', queryset=ArticleTopicLink.objects.select_related('topic')),
+    ]
+
+
+def get_article_page_prefetches():
+    '''
+    Return the lookups prefetching what the page of an article shows besides its own fields: its
+    authors, topics, notes, background images, responses, and the series it is in with their
+    articles.
+    '''
+    from content_notes.models import Citation, EndNote
+
+    series_articles = 'series_links__series__related_article_links'
+    return get_article_listing_prefetches() + [
+        'feature_image__renditions',
+        Prefetch('endnote_links', queryset=EndNote.objects.all()),
+        Prefetch('citation_links', queryset=Citation.objects.all()),
+        Prefetch('background_image_links', queryset=BackgroundImageBlock.objects.select_related('image')),
+        'background_image_links__image__renditions',
+        Prefetch('response_links', queryset=ResponseArticleLink.objects.select_related('response')),
+        Prefetch('response_to_links', queryset=ResponseArticleLink.objects.select_related('response_to')),
+        Prefetch('response_to_links__response_to__response_links', queryset=ResponseArticleLink.objects.select_related('response')),
+        Prefetch('series_links', queryset=SeriesArticleLink.objects.select_related('series')),
+        Prefetch(series_articles, queryset=SeriesArticleLink.objects.select_related('article', 'override_image')),
+        series_articles + '__override_image__renditions',
+    ] + get_article_listing_prefetches(series_articles + '__article__')
+
+
+class ArticlePageQuerySet(PageQuerySet):
+    def for_listing(self):
+        '''
+        Load the articles with what their teasers show, in a fixed number of queries however many
+        articles there are.
+        '''
+        return self.select_related(
+            'feature_style',
+            'main_image',
+            'primary_topic',
+        ).prefetch_related(*get_article_listing_prefetches())
+
+
+class SeriesPageQuerySet(PageQuerySet):
+    def for_listing(self):
+        '''
+        Load the series with what their teasers show, including the authors and topics of their
+        articles, in a fixed number of queries however many series there are.
+        '''
+        return self.select_related(
+            'feature_style',
+            'main_image',
+            'primary_topic',
+        ).prefetch_related(
+            'main_image__renditions',
+            Prefetch('related_article_links', queryset=SeriesArticleLink.objects.select_related(
+                'article',
+                'article__primary_topic',
+                'override_image',
+            )),
+            *get_article_listing_prefetches('related_article_links__article__')
+        )
+
+
+class ExternalArticlePageQuerySet(PageQuerySet):
+    def for_listing(self):
+        return self.select_related(
+            'feature_style',
+            'main_image',
+            'source__logo',
+        ).prefetch_related('main_image__renditions', 'source__logo__renditions')
+
+
 class ResponseArticleLink(Orderable, models.Model):
     response = models.ForeignKey(
         "ArticlePage",
@@ -326,7 +437,20 @@ class ResponseArticleLink(Orderable, models.Model):
     ]
 
 
-class ArticlePage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin, PageLayoutOptions, VideoDocumentMixin):
+class FeedPageMixin(object):
+    '''
+    Saves the page and its links, which update its feed entry, as one batch so that the entry is
+    updated once.
+    '''
+    def save(self, *args, **kwargs):
+        with deferred_side_effects():
+            return super(FeedPageMixin, self).save(*args, **kwargs)
+
+
+class ArticlePage(FeedPageMixin, ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin, PageLayoutOptions, VideoDocumentMixin):
+    # Shows related articles, its series, its authors and its responses
+    lists_pages = True
+
     excerpt = RichTextField(blank=True, default="")
     body = article_fields.BodyField()
     chapters = article_fields.ChapterField(blank=True, null=True)
@@ -389,7 +513,7 @@ class ArticlePage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin
         on_delete=models.SET_NULL,
     )
 
-    _response_to = False
+    objects = PageManager.from_queryset(ArticlePageQuerySet)()
 
     search_fields = Page.search_fields + [
         index.SearchField('excerpt', partial_match=True),
@@ -418,7 +542,36 @@ class ArticlePage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin
         return '\n'.join(
             [author_link.author.full_name if author_link.author else "" for author_link in self.author_links.all()])
 
-    @property
+    def get_context(self, request, *args, **kwargs):
+        if self.pk and not getattr(request, 'is_preview', False):
+            # Previews show the relations as edited, not those saved
+            self.load_related()
+        return super(ArticlePage, self).get_context(request, *args, **kwargs)
+
+    def load_related(self):
+        '''
+        Load what the page shows besides its own fields, in a fixed number of queries, so that the
+        relations used by the templates (author_links.all, citation_links.all, series_articles,
+        responses...) are read from memory.
+        '''
+        images = AttributedImage.objects.filter(
+            pk__in=[pk for pk in (self.main_image_id, self.feature_image_id) if pk],
+        ).prefetch_related('renditions').in_bulk()
+        self.main_image = images.get(self.main_image_id)
+        self.feature_image = images.get(self.feature_image_id)
+
+        # The images and their renditions loaded above are skipped
+        prefetch_related_objects([self], 'project', 'primary_topic', *get_article_page_prefetches())
+        defer_stream_references([self], ['body', 'chapters'])
+
+        # The rich text of the page, its authors' bios and the series it is in
+        shown = [self] + self.authors
+        for series, articles in self.series_articles:
+            shown.append(series)
+            shown.extend(articles)
+        prefetch_listing_rich_text(shown)
+
+    @memoized_property
     def authors(self):
         author_list = []
         for link in self.author_links.all():
@@ -426,17 +579,17 @@ class ArticlePage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin
                 author_list.append((link.author))
         return author_list
 
-    @property
+    @memoized_property
     def series_articles(self):
         related_series_data = []
         for link in self.series_links.all():
             series_page = link.series
-            series_articles = series_page.articles
-            series_articles.remove(self)
+            # A copy, the articles of the series are memoized
+            series_articles = [article for article in series_page.articles if article != self]
             related_series_data.append((series_page, series_articles))
         return related_series_data
 
-    @property
+    @memoized_property
     def topics(self):
         primary_topic = self.primary_topic
         all_topics = [link.topic for link in self.topic_links.all()]
@@ -447,22 +600,18 @@ class ArticlePage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin
             all_topics.sort(key=attrgetter('name'))
         return all_topics
 
-    @property
+    @memoized_property
     def response_to(self):
-        if self._response_to is False:
-            response_to_count = self.response_to_links.count()
-            if response_to_count > 1:
-                logger.warning(
-                    'ArticlePage(pk={0}) appears to be a response to multiple articles. Only the first one is being returned.'.format(
-                        self.pk
-                    )
+        links = list(self.response_to_links.all())
+        if len(links) > 1:
+            logger.warning(
+                'ArticlePage(pk={0}) appears to be a response to multiple articles. Only the first one is being returned.'.format(
+                    self.pk
                 )
-            if response_to_count != 0:
-                self._response_to = self.response_to_links.first().response_to
-            else:
-                self._response_to = None
-
-        return self._response_to
+            )
+        if links:
+            return links[0].response_to
+        return None
 
     @property
     def is_response(self):
@@ -483,13 +632,21 @@ class ArticlePage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin
                 yield block
 
     def related_articles(self, number):
+        articles = get_indexed_related_articles(self, number)
+        if articles is None:
+            # Not indexed yet
+            articles = self.find_related_articles(number)
+        return articles
+
+    def find_related_articles(self, number):
         included = [self.id]
         article_list = []
+        live_articles = ArticlePage.objects.live().for_listing()
         if self.primary_topic:
-            articles = ArticlePage.objects.live().filter(primary_topic=self.primary_topic).exclude(
+            articles = live_articles.filter(primary_topic=self.primary_topic).exclude(
                 id=self.id).distinct().order_by('-first_published_at')[:number]
-            article_list.extend(articles.all())
-            included.extend([article.id for article in articles.all()])
+            article_list.extend(articles)
+            included.extend([article.id for article in articles])
 
         current_total = len(article_list)
 
@@ -497,25 +654,25 @@ class ArticlePage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin
             # still don't have enough, so pick using secondary topics
             topics = Topic.objects.filter(article_links__article=self)
             if topics:
-                additional_articles = ArticlePage.objects.live().filter(primary_topic__in=topics).exclude(
+                additional_articles = live_articles.filter(primary_topic__in=topics).exclude(
                     id__in=included).distinct().order_by('-first_published_at')[:number - current_total]
-                article_list.extend(additional_articles.all())
+                article_list.extend(additional_articles)
                 current_total = len(article_list)
-                included.extend([article.id for article in additional_articles.all()])
+                included.extend([article.id for article in additional_articles])
 
         if current_total < number:
             authors = ContributorPage.objects.live().filter(article_links__article=self)
             if authors:
-                additional_articles = ArticlePage.objects.live().filter(author_links__author__in=authors).exclude(
+                additional_articles = live_articles.filter(author_links__author__in=authors).exclude(
                     id__in=included).distinct().order_by('-first_published_at')[:number - current_total]
-                article_list.extend(additional_articles.all())
+                article_list.extend(additional_articles)
                 current_total = len(article_list)
-                included.extend([article.id for article in additional_articles.all()])
+                included.extend([article.id for article in additional_articles])
 
         if current_total < number:
             # still don't have enough, so just pick the most recent
-            additional_articles = ArticlePage.objects.live().exclude(id__in=included).order_by('-first_published_at')[:number - current_total]
-            article_list.extend(additional_articles.all())
+            additional_articles = live_articles.exclude(id__in=included).order_by('-first_published_at')[:number - current_total]
+            article_list.extend(additional_articles)
 
         return article_list
 
@@ -662,6 +819,8 @@ class ExternalArticlePage(Page, FeatureStyleFields, Promotable):
         related_name='+'
     )
 
+    objects = PageManager.from_queryset(ExternalArticlePageQuerySet)()
+
     def __str__(self):
         return "{}".format(
             self.title
@@ -739,7 +898,7 @@ class SeriesListPage(PaginatedListPageMixin, ThemeablePage):
 
     @property
     def subpages(self):
-        subpages = SeriesPage.objects.live().descendant_of(self).order_by('-first_published_at')
+        subpages = SeriesPage.objects.live().descendant_of(self).order_by('-first_published_at').for_listing()
 
         return subpages
 
@@ -795,7 +954,10 @@ class SeriesArticleLink(Orderable, models.Model):
     ]
 
 
-class SeriesPage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin, PageLayoutOptions, VideoDocumentMixin):
+class SeriesPage(FeedPageMixin, ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin, PageLayoutOptions, VideoDocumentMixin):
+    # Shows its articles, with their authors, and the other series of its project
+    lists_pages = True
+
     subtitle = RichTextField(blank=True, default="")
     short_description = RichTextField(blank=True, default="")
     body = article_fields.BodyField(blank=True, default="")
@@ -838,6 +1000,14 @@ class SeriesPage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin,
     number_of_related_articles = models.PositiveSmallIntegerField(default=6,
                                                                   verbose_name="Number of Related Articles to Show")
 
+    objects = PageManager.from_queryset(SeriesPageQuerySet)()
+
+    def get_context(self, request, *args, **kwargs):
+        if self.pk and not getattr(request, 'is_preview', False):
+            defer_stream_references([self], ['body'])
+            prefetch_listing_rich_text([self] + self.articles)
+        return super(SeriesPage, self).get_context(request, *args, **kwargs)
+
     def get_primary_topic_name(self):
         if self.primary_topic:
             return self.primary_topic.name
@@ -850,7 +1020,7 @@ class SeriesPage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin,
     def get_author_names(self):
         return '\n'.join([author.full_name if author else "" for author in self.authors])
 
-    @property
+    @memoized_property
     def articles(self):
         article_list = []
         for article_link in self.related_article_links.all():
@@ -860,7 +1030,7 @@ class SeriesPage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin,
                 article_list.append(article_link.article)
         return article_list
 
-    @property
+    @memoized_property
     def authors(self):
         author_list = []
         for article_link in self.related_article_links.all():
@@ -873,7 +1043,7 @@ class SeriesPage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin,
         author_list.sort(key=attrgetter('last_name'))
         return author_list
 
-    @property
+    @memoized_property
     def topics(self):
         all_topics = []
         if self.primary_topic:
@@ -903,10 +1073,17 @@ class SeriesPage(ThemeablePage, FeatureStyleFields, Promotable, ShareLinksMixin,
             yield block
 
     def related_articles(self, number):
+        articles = get_indexed_related_articles(self, number)
+        if articles is None:
+            # Not indexed yet
+            articles = self.find_related_articles(number)
+        return articles
+
+    def find_related_articles(self, number):
         articles = []
         if self.primary_topic:
             articles = list(ArticlePage.objects.live().filter(primary_topic=self.primary_topic).distinct().order_by(
-                '-first_published_at')[:number])
+                '-first_published_at').for_listing()[:number])
 
         current_total = len(articles)
         if current_total < number:
@@ -1033,3 +1210,365 @@ class BackgroundImageBlock(Orderable, UniquelySlugable):
 
     def __str__(self):
         return self.name
+
+
+@python_2_unicode_compatible
+class FeedEntry(models.Model):
+    '''
+    What the listings of articles and series filter and sort on, one row per live ArticlePage and
+    SeriesPage, so that a listing is one query on this table instead of joins across the page,
+    article, series and link tables. Kept up to date by update_feed_entries().
+    '''
+    page = models.OneToOneField(
+        'wagtailcore.Page',
+        primary_key=True,
+        on_delete=models.CASCADE,
+        related_name='feed_entry'
+    )
+    content_type = models.ForeignKey(
+        'contenttypes.ContentType',
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    first_published_at = models.DateTimeField(null=True, db_index=True)
+
+    visualization = models.BooleanField(default=False)
+    interview = models.BooleanField(default=False)
+    editors_pick = models.BooleanField(default=False)
+    sticky = models.BooleanField(default=False)
+    slippery = models.BooleanField(default=False)
+
+    primary_topic = models.ForeignKey(
+        'Topic',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name='+'
+    )
+    # The topics it is listed under: series are only listed under their primary topic
+    topics = models.ManyToManyField('Topic', related_name='feed_entries')
+    authors = models.ManyToManyField('people.ContributorPage', related_name='+')
+    image = models.ForeignKey(
+        'images.AttributedImage',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name='+'
+    )
+
+    class Meta:
+        verbose_name_plural = "Feed Entries"
+        index_together = [
+            ['content_type', 'first_published_at'],
+            ['slippery', 'sticky', 'first_published_at'],
+        ]
+
+    def __str__(self):
+        return "Feed entry for page {}".format(self.page_id)
+
+    @property
+    def specific_class(self):
+        return ContentType.objects.get_for_id(self.content_type_id).model_class()
+
+
+FEED_MODELS = (ArticlePage, SeriesPage)
+
+# Saves of the page only touching other fields, e.g. saving a draft, don't change its entry
+FEED_FIELDS = {
+    'live', 'first_published_at', 'visualization', 'interview', 'editors_pick', 'sticky', 'slippery',
+    'primary_topic', 'main_image',
+}
+
+
+# Not shown in listings, and the largest columns of the pages
+LISTING_DEFERRED_FIELDS = ('body', 'chapters')
+
+
+def get_entry_pages(entries):
+    '''
+    Return the specific page of each feed entry, in the same order.
+    '''
+    return resolve_articles(list(entries))
+
+
+def get_listed_pages(entries):
+    '''
+    Return the specific page of each feed entry, in the same order, for a listing.
+    '''
+    return resolve_articles(list(entries), LISTING_DEFERRED_FIELDS)
+
+
+def update_feed_entries(pages):
+    '''
+    Create, update or remove the feed entries of the pages from what is in the database, along with
+    those of the series of articles.
+    '''
+    _update_feed_entries([(page.specific_class, page.pk) for page in pages])
+
+
+def _update_feed_entries(pages):
+    # The pages as (model, pk)
+    seen = set()
+    pending = list(pages)
+    changed_topic_ids = set()
+    while pending:
+        model, pk = pending.pop(0)
+        if (model, pk) in seen or model not in FEED_MODELS:
+            continue
+        seen.add((model, pk))
+
+        changed_topic_ids.update(FeedEntry.topics.through.objects.filter(
+            feedentry_id=pk).values_list('topic_id', flat=True))
+
+        page = model.objects.live().filter(pk=pk).first()
+        if page is None:
+            FeedEntry.objects.filter(page_id=pk).delete()
+            continue
+
+        if model is ArticlePage:
+            topic_ids = set(ArticleTopicLink.objects.filter(article_id=pk).values_list('topic_id', flat=True))
+            author_ids = ArticleAuthorLink.objects.filter(
+                article_id=pk,
+                author__isnull=False,
+            ).values_list('author_id', flat=True)
+            defaults = {'visualization': page.visualization, 'interview': page.interview}
+
+            # Series show the authors of their articles
+            pending.extend((SeriesPage, series_id) for series_id in SeriesArticleLink.objects.filter(
+                article_id=pk).values_list('series_id', flat=True))
+        else:
+            topic_ids = set()
+            author_ids = ArticleAuthorLink.objects.filter(
+                article__series_links__series_id=pk,
+                author__isnull=False,
+            ).values_list('author_id', flat=True)
+            defaults = {}
+
+        if page.primary_topic_id:
+            topic_ids.add(page.primary_topic_id)
+
+        defaults.update({
+            'content_type_id': page.content_type_id,
+            'first_published_at': page.first_published_at,
+            'editors_pick': page.editors_pick,
+            'sticky': page.sticky,
+            'slippery': page.slippery,
+            'primary_topic_id': page.primary_topic_id,
+            'image_id': page.main_image_id,
+        })
+        entry, created = FeedEntry.objects.update_or_create(page_id=pk, defaults=defaults)
+        entry.topics.set(topic_ids)
+        entry.authors.set(set(author_ids))
+        changed_topic_ids.update(topic_ids)
+
+    if changed_topic_ids:
+        update_topic_stats(changed_topic_ids)
+
+
+@python_2_unicode_compatible
+class TopicStats(models.Model):
+    '''
+    The live pages listed under a topic, from its feed entries, so that the topics can be sorted by
+    popularity and their pages sized without counting them. Kept up to date by
+    update_topic_stats().
+    '''
+    topic = models.OneToOneField(
+        'Topic',
+        primary_key=True,
+        on_delete=models.CASCADE,
+        related_name='stats'
+    )
+    article_count = models.PositiveIntegerField(default=0)
+    series_count = models.PositiveIntegerField(default=0)
+    latest_published_at = models.DateTimeField(null=True)
+    # Pages of the topic on the topic list page
+    page_count = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        verbose_name_plural = "Topic Stats"
+
+    def __str__(self):
+        return "Stats for topic {}".format(self.topic_id)
+
+    @property
+    def item_count(self):
+        return self.article_count + self.series_count
+
+
+def get_topic_articles_per_page():
+    per_page = TopicListPage.objects.live().values_list('articles_per_page', flat=True).first()
+    return per_page or TopicListPage._meta.get_field('articles_per_page').default
+
+
+def update_topic_stats(topic_ids=None):
+    '''
+    Recompute the stats of the topics, all of them by default, with one query.
+    '''
+    topics = Topic.objects.all()
+    if topic_ids is not None:
+        topics = topics.filter(pk__in=topic_ids)
+
+    article_type = ContentType.objects.get_for_model(ArticlePage)
+    series_type = ContentType.objects.get_for_model(SeriesPage)
+
+    def count(content_type):
+        return models.Sum(models.Case(
+            models.When(feed_entries__content_type=content_type, then=models.Value(1)),
+            default=models.Value(0),
+            output_field=models.IntegerField(),
+        ))
+
+    per_page = get_topic_articles_per_page()
+    stats = topics.values_list('pk').annotate(
+        article_count=count(article_type),
+        series_count=count(series_type),
+        latest_published_at=models.Max(Coalesce(
+            'feed_entries__page__last_published_at',
+            'feed_entries__first_published_at',
+        )),
+    )
+    for pk, article_count, series_count, latest_published_at in stats:
+        article_count = article_count or 0
+        series_count = series_count or 0
+        TopicStats.objects.update_or_create(topic_id=pk, defaults={
+            'article_count': article_count,
+            'series_count': series_count,
+            'latest_published_at': latest_published_at,
+            'page_count': max(1, -(-(article_count + series_count) // per_page)),
+        })
+
+
+@receiver(page_published, sender=TopicListPage)
+def topic_list_page_published_handler(instance, **kwargs):
+    # The page counts depend on its number of articles per page
+    update_topic_stats()
+
+
+def _queue_feed_update(page):
+    # Saving a page saves its links after it, all of them are handled at the end of the save
+    if not defer(_update_feed_entries, page):
+        _update_feed_entries([page])
+
+
+@receiver(page_unpublished)
+def feed_page_unpublished_handler(sender, instance, **kwargs):
+    # Publishing and unpublishing save the page, except for expired pages which are only marked as
+    # not live
+    if sender in FEED_MODELS and FeedEntry.objects.filter(page_id=instance.pk).exists():
+        _queue_feed_update((sender, instance.pk))
+
+
+@receiver(post_save)
+def feed_page_saved_handler(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or sender not in FEED_MODELS:
+        return
+    if update_fields and not FEED_FIELDS.intersection(update_fields):
+        return
+    _queue_feed_update((sender, instance.pk))
+
+
+@receiver(post_save, sender=ArticleTopicLink)
+@receiver(post_delete, sender=ArticleTopicLink)
+@receiver(post_save, sender=ArticleAuthorLink)
+@receiver(post_delete, sender=ArticleAuthorLink)
+def feed_article_link_handler(instance, raw=False, **kwargs):
+    if not raw:
+        _queue_feed_update((ArticlePage, instance.article_id))
+
+
+@receiver(post_save, sender=SeriesArticleLink)
+@receiver(post_delete, sender=SeriesArticleLink)
+def feed_series_link_handler(instance, raw=False, **kwargs):
+    if not raw:
+        _queue_feed_update((SeriesPage, instance.series_id))
+
+
+@python_2_unicode_compatible
+class RelatedArticle(models.Model):
+    '''
+    One of the articles most related to a page, an article or a series, scored offline by
+    articles.related.
+    '''
+    page = models.ForeignKey(
+        'wagtailcore.Page',
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    article = models.ForeignKey(
+        'ArticlePage',
+        on_delete=models.CASCADE,
+        related_name='related_entries'
+    )
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField(default=0)
+
+    class Meta:
+        ordering = ['page', 'rank']
+        unique_together = ('page', 'article')
+        index_together = ('page', 'rank')
+
+    def __str__(self):
+        return "{} related to {}".format(self.article_id, self.page_id)
+
+
+class RelatedTerm(models.Model):
+    '''
+    One of the topics, authors or words of a live article or series with its normalised weight,
+    stored by articles.related so that a publish only scores the pages it changed.
+    '''
+    page = models.ForeignKey(
+        'wagtailcore.Page',
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    kind = models.CharField(max_length=8)
+    key = models.CharField(max_length=100)
+    weight = models.FloatField()
+
+    class Meta:
+        index_together = ('kind', 'key')
+
+    def __str__(self):
+        return "{} {} of {}".format(self.kind, self.key, self.page_id)
+
+
+class RelatedWord(models.Model):
+    '''
+    The inverse document frequency of a word at the last full build of articles.related.
+    '''
+    word = models.CharField(max_length=100, unique=True)
+    idf = models.FloatField()
+
+    def __str__(self):
+        return self.word
+
+
+RELATED_MODELS = (ArticlePage, SeriesPage)
+
+
+def get_indexed_related_articles(page, number):
+    '''
+    Return the `number` live articles most related to the page, from its RelatedArticle rows, or
+    None if it has none.
+    '''
+    if number <= 0:
+        return []
+    articles = list(ArticlePage.objects.live().filter(
+        related_entries__page=page,
+    ).order_by('related_entries__rank').for_listing()[:number])
+    return articles or None
+
+
+def update_related_articles(instances):
+    from .related import update_related_index, update_related_index_in_background
+    if getattr(settings, 'RELATED_ARTICLES_IN_BACKGROUND', False):
+        update_related_index_in_background(instances)
+    else:
+        update_related_index(instances)
+
+
+@receiver(page_published)
+@receiver(page_unpublished)
+def related_page_published_handler(sender, instance, **kwargs):
+    if sender in RELATED_MODELS and not defer(update_related_articles, instance):
+        transaction.on_commit(lambda: update_related_articles([instance]))
@@ -0,0 +1,203 @@
+'''
+Loads the objects the blocks of StreamFields refer to, such as the images, documents, snippets and
+pages chosen in the body and chapters of an article, with one query per model rather than one per
+block:
+
+    resolve_stream_references([page], ['body', 'chapters'])
+
+Left alone, a stream converts the ids of its blocks to objects as its blocks are read, and the
+blocks nested in structs and lists, like the items of RelatedItemsBlock, one id at a time. Here the
+stream data of the fields is walked once to collect the ids by model, each model is loaded with
+in_bulk() (pages with specific(), so that their templates get articles and series rather than
+pages), and the fields are replaced by streams holding the loaded objects.
+
+Pages rendering their blocks from the fragment cache (see caching/fragments.py) defer it instead:
+
+    defer_stream_references([page], ['body', 'chapters'])
+
+replaces the fields by streams whose blocks keep their stream data, from which the fragment keys
+are computed, and which load the objects of every stream deferred with them once the value of one
+of their blocks is first read, e.g. to render it when its fragment is not cached.
+'''
+from __future__ import absolute_import, unicode_literals
+
+from collections import defaultdict
+
+from django.db.models import prefetch_related_objects
+from wagtail.wagtailcore import blocks
+from wagtail.wagtailcore.models import Page
+from wagtail.wagtailimages.models import AbstractImage
+
+
+def iter_chooser_values(block, raw_value):
+    '''
+    Yield (block, value) for the chooser blocks, with the id chosen, and the rich text blocks, with
+    their source, found in the stream data `raw_value` of `block`. Blocks with no value are skipped.
+    '''
+    if raw_value is None:
+        return
+
+    if isinstance(block, blocks.BaseStreamBlock):
+        for item in raw_value:
+            child_block = block.child_blocks.get(item['type'])
+            if child_block is not None:
+                for found in iter_chooser_values(child_block, item.get('value')):
+                    yield found
+    elif isinstance(block, blocks.BaseStructBlock):
+        for name, child_block in block.child_blocks.items():
+            if name in raw_value:
+                for found in iter_chooser_values(child_block, raw_value[name]):
+                    yield found
+    elif isinstance(block, blocks.ListBlock):
+        for item in raw_value:
+            for found in iter_chooser_values(block.child_block, item):
+                yield found
+    elif isinstance(block, (blocks.ChooserBlock, blocks.RichTextBlock)):
+        yield block, raw_value
+
+
+def collect_references(block, raw_value, references):
+    '''
+    Add the ids chosen in the stream data `raw_value` of `block` to `references`, by model.
+    '''
+    for chooser_block, value in iter_chooser_values(block, raw_value):
+        if isinstance(chooser_block, blocks.ChooserBlock):
+            model = chooser_block.target_model
+            references[model].add(model._meta.pk.to_python(value))
+
+
+def load_references(references):
+    '''
+    Return the objects of each model by id, with one query per model, plus one per type of page
+    and what the articles show when listed.
+    '''
+    from .models import ArticlePage, get_article_listing_prefetches
+
+    loaded = {}
+    for model, ids in references.items():
+        queryset = model.objects.filter(pk__in=ids)
+        if issubclass(model, Page):
+            queryset = queryset.specific()
+        elif issubclass(model, AbstractImage):
+            queryset = queryset.prefetch_related('renditions')
+        loaded[model] = dict((obj.pk, obj) for obj in queryset)
+
+    articles = [obj for objects in loaded.values() for obj in objects.values() if isinstance(obj, ArticlePage)]
+    if articles:
+        prefetch_related_objects(articles, *get_article_listing_prefetches())
+    return loaded
+
+
+def to_python(block, raw_value, loaded):
+    '''
+    Return the value of `block` for the stream data `raw_value`, like block.to_python(), with the
+    objects referred to taken from `loaded`.
+    '''
+    if isinstance(block, blocks.BaseStreamBlock):
+        return blocks.StreamValue(block, [
+            (item['type'], to_python(block.child_blocks[item['type']], item.get('value'), loaded), item.get('id'))
+            for item in raw_value or []
+            if item['type'] in block.child_blocks
+        ])
+    if isinstance(block, blocks.BaseStructBlock):
+        return blocks.StructValue(block, [
+            (name, to_python(child_block, raw_value[name], loaded) if name in raw_value else child_block.get_default())
+            for name, child_block in block.child_blocks.items()
+        ])
+    if isinstance(block, blocks.ListBlock):
+        return [to_python(block.child_block, item, loaded) for item in raw_value]
+    if isinstance(block, blocks.ChooserBlock):
+        if raw_value is None:
+            return None
+        model = block.target_model
+        return loaded.get(model, {}).get(model._meta.pk.to_python(raw_value))
+    return block.to_python(raw_value)
+
+
+def resolve_stream_references(pages, field_names):
+    '''
+    Replace the StreamFields `field_names` of `pages` by streams holding the objects their blocks
+    refer to, all loaded at once. Streams already converted, e.g. those of a preview, are left as
+    they are.
+    '''
+    streams = []
+    references = defaultdict(set)
+    for page in pages:
+        for name in field_names:
+            value = getattr(page, name, None)
+            if isinstance(value, blocks.StreamValue) and value.is_lazy and value.raw_text is None:
+                collect_references(value.stream_block, value.stream_data, references)
+                streams.append((page, name, value))
+
+    loaded = load_references(references)
+    for page, name, value in streams:
+        setattr(page, name, to_python(value.stream_block, value.stream_data, loaded))
+
+
+class DeferredStreamValue(blocks.StreamValue):
+    '''
+    A stream from defer_stream_references(), read as the StreamValue it replaces.
+    '''
+    class StreamChild(blocks.StreamValue.StreamChild):
+        def __init__(self, stream, index, block, block_id):
+            self.stream = stream
+            self.index = index
+            self.block = block
+            self.id = block_id
+            self.prefix = ''
+            self.errors = None
+
+        @property
+        def value(self):
+            return self.stream.resolve()[self.index].value
+
+    def __init__(self, value, group):
+        stream_data = [item for item in value.stream_data if item['type'] in value.stream_block.child_blocks]
+        super(DeferredStreamValue, self).__init__(value.stream_block, stream_data, is_lazy=True)
+        self.group = group
+        self.resolved = None
+
+    def __getitem__(self, i):
+        if i not in self._bound_blocks:
+            item = self.stream_data[i]
+            child_block = self.stream_block.child_blocks[item['type']]
+            self._bound_blocks[i] = self.StreamChild(self, i, child_block, item.get('id'))
+        return self._bound_blocks[i]
+
+    def resolve(self):
+        if self.resolved is None:
+            self.group.resolve()
+        return self.resolved
+
+
+class DeferredStreams(object):
+    '''
+    The streams deferred together, resolved at once.
+    '''
+    def __init__(self):
+        self.streams = []
+
+    def resolve(self):
+        references = defaultdict(set)
+        for stream in self.streams:
+            collect_references(stream.stream_block, stream.stream_data, references)
+
+        loaded = load_references(references)
+        for stream in self.streams:
+            stream.resolved = to_python(stream.stream_block, stream.stream_data, loaded)
+
+
+def defer_stream_references(pages, field_names):
+    '''
+    Like resolve_stream_references(), but only once the value of one of the blocks is read, so
+    that pages whose blocks are all served from the fragment cache load none of the objects.
+    '''
+    group = DeferredStreams()
+    for page in pages:
+        for name in field_names:
+            value = getattr(page, name, None)
+            if (isinstance(value, blocks.StreamValue) and value.is_lazy and value.raw_text is None
+                    and not isinstance(value, DeferredStreamValue)):
+                stream = DeferredStreamValue(value, group)
+                group.streams.append(stream)
+                setattr(page, name, stream)
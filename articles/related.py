@@ -0,0 +1,549 @@
+'''
+Precomputed related articles.
+
+The articles related to each live article and series are scored offline and the best of them kept
+in RelatedArticle rows, so that showing them takes one query (see ArticlePage.related_articles()).
+
+An article scores for a page by how alike they are in three ways, each a cosine similarity:
+
+    * the topics they share, the primary topic counting double,
+    * the authors they share,
+    * the words of their title, excerpt and body, weighted by TF-IDF.
+
+Articles with the same score are ranked newest first, and articles scoring nothing fill the rest
+of the list, newest first, as the related articles were chosen before.
+
+build_related_index() scores every page, as the build_related_articles command does, and stores
+the inverse document frequency of every word (RelatedWord) and the normalised vectors of every page
+(RelatedTerm). update_related_index() is called when pages are published or unpublished: it only
+reads those pages, weighs their words with the stored frequencies and scores them, and the pages
+whose lists had them, against the stored vectors of the others. The frequencies are only
+recomputed by a full build. With RELATED_ARTICLES_IN_BACKGROUND, publishes update the index from a
+background thread rather than the request's.
+
+The similarities of a full build are computed with NumPy and SciPy sparse matrices when they are
+installed, and in Python otherwise.
+'''
+from __future__ import absolute_import, division, unicode_literals
+
+import heapq
+import logging
+import math
+import re
+import threading
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+
+import six
+from django.db import connection, transaction
+from django.utils.html import strip_tags
+from wagtail.wagtailcore.blocks import StreamValue
+
+from .models import (ArticleAuthorLink, ArticlePage, ArticleTopicLink,
+                     RelatedArticle, RelatedTerm, RelatedWord,
+                     SeriesArticleLink, SeriesPage)
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+logger = logging.getLogger(__name__)
+
+# Articles kept for each page, or its number_of_related_articles if more
+RELATED_ARTICLES_COUNT = 12
+
+WEIGHTS = {
+    'topics': 1.0,
+    'authors': 0.5,
+    'text': 1.0,
+}
+
+PRIMARY_TOPIC_WEIGHT = 2.0
+
+# Pages scored at once by a full build
+BATCH_SIZE = 500
+
+# Values looked up in one query, under the 999 parameters SQLite allows
+MAX_VALUES_PER_QUERY = 500
+
+WORD_RE = re.compile(r'[^\W\d_]{3,}', re.UNICODE)
+
+# Longer runs of letters are not words, and would not fit in RelatedWord
+MAX_WORD_LENGTH = 100
+
+# Stored in place of the words no page had at the last full build
+UNSEEN_WORD = ''
+
+STOP_WORDS = frozenset('''
+    about above after again against all and any are because been before being below between both
+    but can could did does doing down during each few for from further had has have having her here
+    hers herself him himself his how into its itself just more most not now off once only other our
+    ours out over own same she should some such than that the their theirs them then there these
+    they this those through too under until very was were what when where which while who whom why
+    will with would you your yours
+'''.split())
+
+Document = namedtuple('Document', ['pk', 'is_article', 'first_published_at', 'count', 'topics', 'authors', 'words'])
+
+
+def chunks(values):
+    values = list(values)
+    return (values[start:start + MAX_VALUES_PER_QUERY] for start in range(0, len(values), MAX_VALUES_PER_QUERY))
+
+
+def get_strings(value):
+    '''
+    Yield the strings of a field value, including those nested in the blocks of a StreamField.
+    '''
+    if isinstance(value, StreamValue):
+        value = value.stream_data
+    if isinstance(value, six.string_types):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            for string in get_strings(item):
+                yield string
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            for string in get_strings(item):
+                yield string
+    elif hasattr(value, 'source'):
+        # RichText
+        for string in get_strings(value.source):
+            yield string
+
+
+def get_words(*values):
+    text = ' '.join(strip_tags(string) for value in values for string in get_strings(value))
+    return Counter(
+        word for word in WORD_RE.findall(text.lower())
+        if word not in STOP_WORDS and len(word) <= MAX_WORD_LENGTH
+    )
+
+
+def load_documents(pks=None):
+    '''
+    Return the documents of the live articles and series, or of those of `pks`, by page id, newest
+    first.
+    '''
+    documents = OrderedDict()
+
+    def add(pk, is_article, first_published_at, count, primary_topic_id, words):
+        topics = {primary_topic_id: PRIMARY_TOPIC_WEIGHT} if primary_topic_id else {}
+        documents[pk] = Document(pk, is_article, first_published_at, count, topics, {}, words)
+
+    articles = ArticlePage.objects.live()
+    series = SeriesPage.objects.live()
+    series_links = SeriesArticleLink.objects.filter(series__live=True, article__live=True)
+    if pks is not None:
+        series = series.filter(pk__in=pks)
+        series_links = series_links.filter(series_id__in=pks)
+        # Series have the topics and authors of their articles, which are loaded too
+        article_pks = set(pks) | set(series_links.values_list('article_id', flat=True))
+        articles = articles.filter(pk__in=article_pks)
+
+    articles = articles.values_list(
+        'pk', 'first_published_at', 'number_of_related_articles', 'primary_topic_id', 'title', 'excerpt', 'body',
+    )
+    for pk, first_published_at, count, primary_topic_id, title, excerpt, body in articles:
+        add(pk, True, first_published_at, count, primary_topic_id, get_words(title, excerpt, body))
+
+    series = series.values_list(
+        'pk', 'first_published_at', 'number_of_related_articles', 'primary_topic_id', 'title', 'subtitle',
+        'short_description', 'body',
+    )
+    for pk, first_published_at, count, primary_topic_id, title, subtitle, description, body in series:
+        add(pk, False, first_published_at, count, primary_topic_id, get_words(title, subtitle, description, body))
+
+    topic_links = ArticleTopicLink.objects.filter(article__live=True)
+    author_links = ArticleAuthorLink.objects.filter(article__live=True, author__isnull=False)
+    if pks is not None:
+        topic_links = topic_links.filter(article_id__in=article_pks)
+        author_links = author_links.filter(article_id__in=article_pks)
+    for article_id, topic_id in topic_links.values_list('article_id', 'topic_id'):
+        documents[article_id].topics.setdefault(topic_id, 1.0)
+    for article_id, author_id in author_links.values_list('article_id', 'author_id'):
+        documents[article_id].authors[author_id] = 1.0
+
+    for series_id, article_id in series_links.values_list('series_id', 'article_id'):
+        for topic_id in documents[article_id].topics:
+            documents[series_id].topics.setdefault(topic_id, 1.0)
+        documents[series_id].authors.update(documents[article_id].authors)
+
+    return OrderedDict(sorted(
+        ((pk, document) for pk, document in documents.items() if pks is None or pk in pks),
+        key=lambda item: (item[1].first_published_at is not None, item[1].first_published_at, item[0]),
+        reverse=True,
+    ))
+
+
+def get_idf(documents):
+    '''
+    Return the inverse document frequency of the words of the documents: the log of the inverse of
+    the share of documents they are in. UNSEEN_WORD has that of a word in none of them.
+    '''
+    frequencies = Counter(word for document in documents for word in document.words)
+    total = len(documents)
+    idf = dict((word, math.log((1 + total) / (1 + frequency)) + 1) for word, frequency in frequencies.items())
+    idf[UNSEEN_WORD] = math.log(1 + total) + 1
+    return idf
+
+
+def get_tfidf_vector(document, idf):
+    '''
+    Return the words of a document weighted by TF-IDF: the log of their count, times their inverse
+    document frequency in `idf`.
+    '''
+    return dict(
+        (word, (1 + math.log(count)) * idf.get(word, idf[UNSEEN_WORD]))
+        for word, count in document.words.items()
+    )
+
+
+def get_terms(document, text_vector):
+    '''
+    Return the RelatedTerm rows of a document, its vectors normalised.
+    '''
+    terms = []
+    for kind, vector in (('topics', document.topics), ('authors', document.authors), ('text', text_vector)):
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1
+        terms.extend(
+            RelatedTerm(page_id=document.pk, kind=kind, key=six.text_type(key), weight=weight / norm)
+            for key, weight in vector.items()
+        )
+    return terms
+
+
+def cosine_similarities(vectors, sources):
+    '''
+    Return, for each index of `sources`, the cosine similarities of its vector with those of
+    `vectors` that are not orthogonal to it, as a dict of indexes. Vectors are dicts of weights.
+    '''
+    if not sources:
+        return []
+    if sparse is not None:
+        return _sparse_cosine_similarities(vectors, sources)
+    return _python_cosine_similarities(vectors, sources)
+
+
+def _sparse_cosine_similarities(vectors, sources):
+    keys = {}
+    rows = []
+    columns = []
+    data = []
+    for row, vector in enumerate(vectors):
+        for key, weight in vector.items():
+            rows.append(row)
+            columns.append(keys.setdefault(key, len(keys)))
+            data.append(weight)
+
+    matrix = sparse.csr_matrix((data, (rows, columns)), shape=(len(vectors), max(len(keys), 1)), dtype=np.float64)
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    matrix = sparse.diags(1 / norms).dot(matrix).tocsr()
+
+    products = matrix[sources].dot(matrix.T).tocsr()
+    similarities = []
+    for row in range(len(sources)):
+        start, end = products.indptr[row], products.indptr[row + 1]
+        similarities.append(dict(
+            (int(index), float(value))
+            for index, value in zip(products.indices[start:end], products.data[start:end])
+            if value
+        ))
+    return similarities
+
+
+def _python_cosine_similarities(vectors, sources):
+    norms = [math.sqrt(sum(weight * weight for weight in vector.values())) or 1 for vector in vectors]
+    postings = defaultdict(list)
+    for index, vector in enumerate(vectors):
+        for key, weight in vector.items():
+            postings[key].append((index, weight / norms[index]))
+
+    similarities = []
+    for source in sources:
+        totals = defaultdict(float)
+        for key, weight in vectors[source].items():
+            weight = weight / norms[source]
+            for index, other in postings[key]:
+                totals[index] += weight * other
+        similarities.append(dict((index, total) for index, total in totals.items() if total))
+    return similarities
+
+
+def rank_articles(pk, scores, count, recency, newest):
+    '''
+    Return the `count` best articles for a page from the scores of the pages, as (article id, score)
+    pairs, filled with the `newest` articles. `recency` orders the live articles, and only them, by
+    date.
+    '''
+    articles = ((article_id, score) for article_id, score in scores.items() if article_id in recency)
+    ranked = heapq.nlargest(count, articles, key=lambda item: (item[1], recency[item[0]]))
+
+    ranked_ids = set(article_id for article_id, score in ranked)
+    for article_id in newest:
+        if len(ranked) >= count:
+            break
+        if article_id != pk and article_id not in ranked_ids:
+            ranked.append((article_id, 0.0))
+    return ranked
+
+
+class RelatedArticleScorer(object):
+    '''
+    Scores the articles of `documents`, from load_documents(), for any of them.
+    '''
+    def __init__(self, documents):
+        self.documents = list(documents.values())
+        self.indexes = dict((document.pk, index) for index, document in enumerate(self.documents))
+        self.idf = get_idf(self.documents)
+        self.text_vectors = [get_tfidf_vector(document, self.idf) for document in self.documents]
+        # The documents are newest first
+        self.recency = dict(
+            (document.pk, -index) for index, document in enumerate(self.documents) if document.is_article
+        )
+        self.newest = [document.pk for document in self.documents if document.is_article]
+
+    def score(self, pks):
+        '''
+        Return the scores of the other pages for each page of `pks`, as dicts of page ids, without
+        the pages scoring nothing.
+        '''
+        sources = [self.indexes[pk] for pk in pks]
+        similarities = [
+            (WEIGHTS['topics'], cosine_similarities([document.topics for document in self.documents], sources)),
+            (WEIGHTS['authors'], cosine_similarities([document.authors for document in self.documents], sources)),
+            (WEIGHTS['text'], cosine_similarities(self.text_vectors, sources)),
+        ]
+
+        scores = []
+        for row, source in enumerate(sources):
+            totals = defaultdict(float)
+            for weight, rows in similarities:
+                for index, similarity in rows[row].items():
+                    if index != source:
+                        totals[self.documents[index].pk] += weight * similarity
+            scores.append(totals)
+        return scores
+
+    def get_count(self, pk):
+        return max(RELATED_ARTICLES_COUNT, self.documents[self.indexes[pk]].count)
+
+    def rank(self, pk, scores):
+        '''
+        Return the best articles for a page from the scores of the pages, as (article id, score)
+        pairs, filled with the newest articles.
+        '''
+        return rank_articles(pk, scores, self.get_count(pk), self.recency, self.newest)
+
+    def get_terms(self):
+        '''
+        Yield the RelatedTerm rows of every document.
+        '''
+        for document, text_vector in zip(self.documents, self.text_vectors):
+            for term in get_terms(document, text_vector):
+                yield term
+
+
+class StoredTermsScorer(object):
+    '''
+    Scores the articles for pages from the RelatedTerm rows, reading only the rows of the terms
+    those pages have.
+    '''
+    def __init__(self):
+        self.counts = {}
+        self.recency = {}
+        for model in (ArticlePage, SeriesPage):
+            for pk, first_published_at, count in model.objects.live().values_list(
+                'pk', 'first_published_at', 'number_of_related_articles',
+            ):
+                self.counts[pk] = count
+                if model is ArticlePage:
+                    self.recency[pk] = (first_published_at is not None, first_published_at, pk)
+        self.newest = sorted(self.recency, key=self.recency.get, reverse=True)
+
+    def score(self, pks):
+        '''
+        Return the scores of the other pages for each page of `pks`, as dicts of page ids, without
+        the pages scoring nothing.
+        '''
+        sources = defaultdict(dict)
+        for page_id, kind, key, weight in RelatedTerm.objects.filter(page_id__in=pks).values_list(
+            'page_id', 'kind', 'key', 'weight',
+        ):
+            sources[page_id][kind, key] = weight
+
+        keys = defaultdict(set)
+        for terms in sources.values():
+            for kind, key in terms:
+                keys[kind].add(key)
+        postings = defaultdict(list)
+        for kind, kind_keys in keys.items():
+            for chunk in chunks(kind_keys):
+                for page_id, key, weight in RelatedTerm.objects.filter(kind=kind, key__in=chunk).values_list(
+                    'page_id', 'key', 'weight',
+                ):
+                    postings[kind, key].append((page_id, weight))
+
+        scores = []
+        for pk in pks:
+            totals = defaultdict(float)
+            for (kind, key), weight in sources[pk].items():
+                for page_id, other in postings[kind, key]:
+                    if page_id != pk:
+                        totals[page_id] += WEIGHTS[kind] * weight * other
+            scores.append(totals)
+        return scores
+
+    def get_count(self, pk):
+        return max(RELATED_ARTICLES_COUNT, self.counts.get(pk, 0))
+
+    def rank(self, pk, scores):
+        '''
+        Return the best articles for a page from the scores of the pages, as (article id, score)
+        pairs, filled with the newest articles.
+        '''
+        return rank_articles(pk, scores, self.get_count(pk), self.recency, self.newest)
+
+
+def load_idf(documents):
+    '''
+    Return the stored inverse document frequencies of the words of the documents, and of
+    UNSEEN_WORD unless no full build stored any.
+    '''
+    words = set(word for document in documents for word in document.words)
+    words.add(UNSEEN_WORD)
+    idf = {}
+    for chunk in chunks(words):
+        idf.update(RelatedWord.objects.filter(word__in=chunk).values_list('word', 'idf'))
+    return idf
+
+
+def save_related_articles(lists, replace_all=False):
+    '''
+    Replace the related articles of the pages with their new ranked lists, or those of every page
+    with `replace_all`.
+    '''
+    with transaction.atomic():
+        if replace_all:
+            RelatedArticle.objects.all().delete()
+        else:
+            for chunk in chunks(lists):
+                RelatedArticle.objects.filter(page_id__in=chunk).delete()
+        RelatedArticle.objects.bulk_create([
+            RelatedArticle(page_id=pk, article_id=article_id, rank=rank, score=score)
+            for pk, ranked in lists.items()
+            for rank, (article_id, score) in enumerate(ranked)
+        ], batch_size=BATCH_SIZE)
+
+
+def build_related_index():
+    '''
+    Score the related articles of every live article and series, and store the word frequencies
+    and vectors update_related_index() scores against. Returns the number of pages.
+    '''
+    documents = load_documents()
+    scorer = RelatedArticleScorer(documents)
+    pks = list(documents)
+    lists = {}
+    # In batches, the scores of a batch for every page are held at once
+    for start in range(0, len(pks), BATCH_SIZE):
+        batch = pks[start:start + BATCH_SIZE]
+        lists.update((pk, scorer.rank(pk, scores)) for pk, scores in zip(batch, scorer.score(batch)))
+
+    with transaction.atomic():
+        save_related_articles(lists, replace_all=True)
+        RelatedWord.objects.all().delete()
+        RelatedWord.objects.bulk_create(
+            (RelatedWord(word=word, idf=idf) for word, idf in scorer.idf.items()),
+            batch_size=BATCH_SIZE,
+        )
+        RelatedTerm.objects.all().delete()
+        RelatedTerm.objects.bulk_create(scorer.get_terms(), batch_size=BATCH_SIZE)
+
+    logger.info('Indexed the related articles of {} pages.'.format(len(pks)))
+    return len(pks)
+
+
+def update_related_index(pages):
+    '''
+    Update the index after the pages were published or unpublished: store their vectors, rescore
+    them and the pages whose lists had them, and add them to the lists of other pages where they
+    now rank. Only the changed pages are read; the others are scored from their stored vectors.
+    Returns the number of lists replaced.
+
+    Updates run one at a time, whichever process runs them, as each replaces lists the others may
+    be replacing: the row of UNSEEN_WORD, stored by every full build, is locked until it is done.
+    Before the first full build nothing is updated and pages are related by query.
+    '''
+    with transaction.atomic():
+        if not RelatedWord.objects.select_for_update().filter(word=UNSEEN_WORD).values_list('pk', flat=True):
+            logger.warning('No related articles to update, they are built by build_related_articles.')
+            return 0
+
+        changed = set(page.pk for page in pages)
+        # Series have the topics and authors of their articles
+        changed.update(SeriesArticleLink.objects.filter(article_id__in=changed).values_list('series_id', flat=True))
+
+        documents = load_documents(changed)
+        idf = load_idf(documents.values())
+
+        gone = changed - set(documents)
+        # Pages that are no longer live are not related to anything
+        RelatedArticle.objects.filter(page_id__in=gone).delete()
+        holders = set(RelatedArticle.objects.filter(article_id__in=changed).values_list('page_id', flat=True))
+        RelatedTerm.objects.filter(page_id__in=changed).delete()
+        RelatedTerm.objects.bulk_create([
+            term for document in documents.values() for term in get_terms(document, get_tfidf_vector(document, idf))
+        ], batch_size=BATCH_SIZE)
+
+        scorer = StoredTermsScorer()
+        rescored = list(set(documents) | holders)
+        rescored_scores = dict(zip(rescored, scorer.score(rescored)))
+        lists = dict((pk, scorer.rank(pk, scores)) for pk, scores in rescored_scores.items())
+
+        # The similarities are symmetric: the scores of the changed articles for any page are the
+        # scores of that page for them
+        changed_articles = [pk for pk, document in documents.items() if document.is_article]
+        candidates = set(pk for article_id in changed_articles for pk in rescored_scores[article_id]) - set(lists)
+        existing = defaultdict(list)
+        for chunk in chunks(candidates):
+            for page_id, article_id, score in RelatedArticle.objects.filter(page_id__in=chunk).values_list(
+                'page_id', 'article_id', 'score',
+            ):
+                existing[page_id].append((article_id, score))
+
+        for pk, entries in existing.items():
+            scores = dict(entries)
+            for article_id in changed_articles:
+                if article_id != pk:
+                    scores[article_id] = rescored_scores[article_id].get(pk, 0.0)
+            ranked = scorer.rank(pk, dict((article_id, score) for article_id, score in scores.items() if score))
+            if [article_id for article_id, score in ranked] != [article_id for article_id, score in entries]:
+                lists[pk] = ranked
+
+        save_related_articles(lists)
+    return len(lists)
+
+
+def _update_in_background(pages):
+    try:
+        update_related_index(pages)
+    except Exception:
+        logger.exception('Unable to update the related articles of {} pages.'.format(len(pages)))
+    finally:
+        # The thread ends here, along with its connection
+        connection.close()
+
+
+def update_related_index_in_background(pages):
+    '''
+    Run update_related_index() from a new thread, so that the request publishing the pages does
+    not wait for it.
+    '''
+    thread = threading.Thread(target=_update_in_background, args=(list(pages),))
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -4,9 +4,11 @@ import re
 from django import template
 from django.utils.text import Truncator, slugify
 from six.moves.urllib_parse import quote_plus
+from wagtail.wagtailcore.models import Page
 
 from articles.models import (ArticlePage, ExternalArticlePage, SeriesPage,
                              TopicListPage)
+from caching import fragments
 
 register = template.Library()
 
@@ -46,21 +48,14 @@ def get_feature_image(item):
 
 @register.simple_tag()
 def typed_article(page):
-    try:
-        return page.articlepage
-    except ArticlePage.DoesNotExist:
-        pass
-
-    try:
-        return page.seriespage
-    except SeriesPage.DoesNotExist:
-        pass
-
-    try:
-        return page.externalarticlepage
-    except ExternalArticlePage.DoesNotExist:
-        pass
-
+    '''
+    Return the article, series or external article a page is, or the page. The pages chosen in the
+    streams of articles are already specific (see articles/references.py), others take one query.
+    '''
+    if type(page) is Page:
+        specific = page.specific
+        if isinstance(specific, (ArticlePage, SeriesPage, ExternalArticlePage)):
+            return specific
     return page
 
 
@@ -170,3 +165,12 @@ def page_preview(page):
             break
 
     return Truncator(content).chars(500, html=True)
+
+
+@register.simple_tag(takes_context=True)
+def include_cached_block(context, block):
+    '''
+    Render a block of the page's streams like include_block, from the fragment cache when it is
+    enabled (see caching/fragments.py).
+    '''
+    return fragments.render_block(context, block)
@@ -1,12 +1,34 @@
-from django.test import TestCase
+import json
+import threading
+from unittest import skipUnless
+
+import mock
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         TransactionTestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
 from django.utils import six
+from wagtail.wagtailcore.models import Page, Site
 
+from caching.coalescer import get_purge_coalescer, get_tag_purge_coalescer
+from caching.fake_cloudflare import fake_cloudflare
+from core.bulk import bulk_publish, bulk_unpublish
+from core.cache_tags import get_tag
+from core.memo import get_stats, memoization
 from images.models import AttributedImage
 from people.models import ContributorPage
+from themes import resolver
+from themes.models import Theme
 
+from . import related
 from .models import (ArticleAuthorLink, ArticleListPage, ArticlePage,
-                     ArticleTopicLink, Headline, SeriesListPage, SeriesPage,
-                     Topic, TopicListPage)
+                     ArticleTopicLink, FeedEntry, Headline, RelatedArticle,
+                     RelatedTerm, RelatedWord, SeriesListPage, SeriesPage,
+                     Topic, TopicListPage, TopicStats,
+                     update_related_articles, update_topic_stats)
+from .references import defer_stream_references, resolve_stream_references
+from .templatetags.article_tags import typed_article
 
 
 class SeriesPageTestCase(TestCase):
@@ -257,6 +279,448 @@ class SeriesListPageTestCase(TestCase):
         self.assertEqual(len(series_pages), 2)
 
 
+class ListingPrefetchTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def count_queries(self, items, template, name):
+        with CaptureQueriesContext(connection) as context:
+            for item in list(items):
+                render_to_string(template, {name: item, 'heading': 'h2'})
+        return len(context.captured_queries)
+
+    def test_article_teasers_take_the_same_queries_for_any_number_of_articles(self):
+        articles = ArticleListPage.objects.get(slug='features').subpages
+        # Once for the site root paths the URLs are made from
+        self.count_queries(articles[:1], 'articles/includes/article_teaser.html', 'article')
+
+        self.assertEqual(
+            self.count_queries(articles[:1], 'articles/includes/article_teaser.html', 'article'),
+            self.count_queries(articles, 'articles/includes/article_teaser.html', 'article'),
+        )
+
+    def test_series_teasers_take_the_same_queries_for_any_number_of_series(self):
+        series = SeriesListPage.objects.get(slug='indepth').subpages
+        # The series with the most articles to load
+        one = series.filter(pk=max(series, key=lambda item: len(item.articles)).pk)
+        self.count_queries(one, 'articles/includes/series_teaser.html', 'series')
+
+        self.assertEqual(
+            self.count_queries(one, 'articles/includes/series_teaser.html', 'series'),
+            self.count_queries(series, 'articles/includes/series_teaser.html', 'series'),
+        )
+
+    def test_topic_items_have_their_authors_and_topics_loaded(self):
+        items = Topic.objects.get(slug="topic-1").item_list
+        with self.assertNumQueries(0):
+            for item in items:
+                item.authors
+                item.topics
+
+    def test_related_articles_have_their_authors_loaded(self):
+        related = ArticlePage.objects.get(pk=107).related_articles(5)
+        self.assertTrue(related)
+        with self.assertNumQueries(0):
+            for article in related:
+                article.authors
+
+
+class ArticlePageLoadRelatedTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def count_queries(self):
+        article = ArticlePage.objects.get(pk=107)
+        with CaptureQueriesContext(connection) as context:
+            article.load_related()
+        return article, len(context.captured_queries)
+
+    def test_the_page_relations_are_read_from_memory(self):
+        article, count = self.count_queries()
+        with self.assertNumQueries(0):
+            self.assertTrue(article.authors)
+            article.topics
+            article.response_to
+            article.responses()
+            list(article.endnote_links.all())
+            list(article.citation_links.all())
+            list(article.background_image_links.all())
+            article.project
+            article.main_image
+            article.feature_image
+            for series, articles in article.series_articles:
+                self.assertTrue(articles)
+                [other.authors for other in articles]
+
+    def test_takes_the_same_queries_however_many_relations(self):
+        article, count = self.count_queries()
+        for name in ("Topic A", "Topic B"):
+            ArticleTopicLink.objects.create(article=article, topic=Topic.objects.create(name=name))
+        for author in ContributorPage.objects.all():
+            ArticleAuthorLink.objects.create(article=article, author=author)
+
+        self.assertEqual(self.count_queries()[1], count)
+
+
+class StreamReferencesTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def get_article(self, related_items):
+        article = ArticlePage.objects.get(pk=107)
+        article.body = json.dumps([
+            {'type': 'Image', 'value': {'image': 1, 'placement': 'full'}, 'id': 'image'},
+            {'type': 'RelatedItems', 'value': {'heading': 'Related', 'items': related_items[0]}},
+            {'type': 'ColumnedContent', 'value': {'body': [
+                {'type': 'RelatedItems', 'value': {'heading': 'More', 'items': related_items[1]}},
+            ]}},
+        ])
+        article.chapters = json.dumps([
+            {'type': 'chapter', 'value': {'heading': 'One', 'body': [
+                {'type': 'Image', 'value': {'image': 1, 'placement': 'left'}},
+            ]}},
+        ])
+        return article
+
+    def count_queries(self, related_items):
+        article = self.get_article(related_items)
+        with CaptureQueriesContext(connection) as context:
+            resolve_stream_references([article], ['body', 'chapters'])
+        return article, len(context.captured_queries)
+
+    def test_blocks_hold_the_loaded_objects(self):
+        article, count = self.count_queries([[108, 110], [109, 112]])
+        with self.assertNumQueries(0):
+            self.assertEqual(article.body[0].id, 'image')
+            self.assertEqual(article.body[0].value['image'].pk, 1)
+            self.assertEqual(article.chapters[0].value['body'][0].value['image'].pk, 1)
+
+            items = article.body[1].value['items']
+            self.assertEqual([type(item) for item in items], [ArticlePage, SeriesPage])
+            self.assertIs(typed_article(items[0]), items[0])
+            self.assertTrue(items[0].authors)
+
+            nested = article.body[2].value['body'][0].value['items']
+            self.assertEqual([type(item) for item in nested], [ArticlePage, ContributorPage])
+
+    def test_takes_the_same_queries_however_many_references(self):
+        count = self.count_queries([[108], [110]])[1]
+        self.assertEqual(self.count_queries([[108, 109, 111], [110, 116, 115]])[1], count)
+
+    def test_renders_as_the_stream_read_lazily(self):
+        article = self.get_article([[108, 110], [109, 112]])
+        expected = [block.render() for block in article.body]
+        resolve_stream_references([article], ['body', 'chapters'])
+        self.assertEqual([block.render() for block in article.body], expected)
+
+    def test_deferred_streams_load_everything_once_a_value_is_read(self):
+        article, count = self.count_queries([[108, 110], [109, 112]])
+        deferred = self.get_article([[108, 110], [109, 112]])
+        with self.assertNumQueries(0):
+            defer_stream_references([deferred], ['body', 'chapters'])
+            self.assertEqual([block.id for block in deferred.body], ['image', None, None])
+        with self.assertNumQueries(count):
+            self.assertEqual(deferred.body[0].value['image'].pk, 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(deferred.chapters[0].value['body'][0].value['image'].pk, 1)
+        self.assertEqual([block.render() for block in deferred.body], [block.render() for block in article.body])
+
+    def test_typed_article_loads_specific_articles(self):
+        self.assertIsInstance(typed_article(Page.objects.get(pk=108)), ArticlePage)
+        self.assertIsInstance(typed_article(Page.objects.get(pk=110)), SeriesPage)
+        page = Page.objects.get(pk=112)
+        self.assertIs(typed_article(page), page)
+
+
+class RelatedArticleTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def setUp(self):
+        related.build_related_index()
+
+    def get_related_ids(self, page):
+        return list(RelatedArticle.objects.filter(page=page).values_list('article_id', flat=True))
+
+    def test_every_live_article_and_series_is_indexed(self):
+        for page in list(ArticlePage.objects.live()) + list(SeriesPage.objects.live()):
+            related_ids = self.get_related_ids(page)
+            self.assertTrue(related_ids)
+            self.assertNotIn(page.pk, related_ids)
+
+    def test_articles_are_ranked_by_score(self):
+        article = ArticlePage.objects.get(pk=107)
+        scores = list(RelatedArticle.objects.filter(page=article).values_list('score', flat=True))
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertGreater(scores[0], 0)
+
+        first = article.related_articles(1)[0]
+        shared_topics = set(article.topics) & set(first.topics)
+        shared_authors = set(article.authors) & set(first.authors)
+        self.assertTrue(shared_topics or shared_authors)
+
+    def test_related_articles_are_one_lookup(self):
+        article = ArticlePage.objects.get(pk=107)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(len(article.related_articles(1)), 1)
+        with self.assertNumQueries(len(context.captured_queries)):
+            articles = article.related_articles(4)
+        self.assertEqual([item.pk for item in articles], self.get_related_ids(article)[:4])
+
+    def test_pages_not_indexed_are_related_by_query(self):
+        article = ArticlePage.objects.get(pk=107)
+        RelatedArticle.objects.filter(page=article).delete()
+        self.assertEqual(article.related_articles(3), article.find_related_articles(3))
+
+    def test_unpublished_articles_leave_the_lists(self):
+        article = ArticlePage.objects.get(pk=108)
+        self.assertTrue(RelatedArticle.objects.filter(article=article).exists())
+
+        bulk_unpublish([article])
+        self.assertFalse(RelatedArticle.objects.filter(article=article).exists())
+        self.assertFalse(RelatedArticle.objects.filter(page=article).exists())
+        self.assertTrue(self.get_related_ids(ArticlePage.objects.get(pk=107)))
+
+    def test_published_articles_enter_the_lists_they_rank_in(self):
+        article = ArticlePage.objects.get(pk=107)
+        other = ArticlePage.objects.get(pk=115)
+        topic = Topic.objects.create(name="Shared Topic")
+        ArticleTopicLink.objects.create(article=other, topic=topic)
+        other.save_revision()
+        bulk_publish([other])
+
+        ArticleTopicLink.objects.create(article=article, topic=topic)
+        article.primary_topic = topic
+        article.save_revision()
+
+        bulk_publish([article])
+        self.assertEqual(self.get_related_ids(other)[0], article.pk)
+
+    def test_full_and_incremental_builds_agree_on_the_changed_page(self):
+        article = ArticlePage.objects.get(pk=107)
+        bulk_publish([article])
+        incremental = self.get_related_ids(article)
+        related.build_related_index()
+        self.assertEqual(self.get_related_ids(article), incremental)
+
+    def test_updates_only_read_the_changed_pages(self):
+        article = ArticlePage.objects.get(pk=115)
+        with mock.patch.object(related, 'load_documents', wraps=related.load_documents) as load_documents, \
+                mock.patch.object(related, 'RelatedArticleScorer', side_effect=AssertionError):
+            related.update_related_index([article])
+        load_documents.assert_called_once_with({article.pk})
+
+    def test_updates_store_the_vectors_of_the_changed_pages(self):
+        article = ArticlePage.objects.get(pk=108)
+        RelatedTerm.objects.filter(page=article).delete()
+        related.update_related_index([article])
+        self.assertTrue(RelatedTerm.objects.filter(page=article, kind='text').exists())
+
+        bulk_unpublish([article])
+        self.assertFalse(RelatedTerm.objects.filter(page=article).exists())
+
+    def test_updates_before_any_build_leave_the_pages_to_the_query(self):
+        article = ArticlePage.objects.get(pk=107)
+        RelatedArticle.objects.all().delete()
+        RelatedTerm.objects.all().delete()
+        RelatedWord.objects.all().delete()
+        with mock.patch.object(related, 'RelatedArticleScorer', side_effect=AssertionError):
+            self.assertEqual(related.update_related_index([article]), 0)
+        self.assertFalse(RelatedArticle.objects.exists())
+        self.assertEqual(article.related_articles(3), article.find_related_articles(3))
+
+    @override_settings(RELATED_ARTICLES_IN_BACKGROUND=True)
+    def test_updates_can_run_in_the_background(self):
+        article = ArticlePage.objects.get(pk=107)
+        threads = []
+        in_background = related.update_related_index_in_background
+        with mock.patch.object(related, 'update_related_index') as update_related_index, \
+                mock.patch.object(related, 'update_related_index_in_background',
+                                  side_effect=lambda pages: threads.append(in_background(pages))):
+            update_related_articles([article])
+            threads[0].join()
+        self.assertNotEqual(threads[0].ident, threading.current_thread().ident)
+        update_related_index.assert_called_once_with([article])
+
+    @skipUnless(related.sparse, "NumPy and SciPy are not installed")
+    def test_sparse_and_python_similarities_agree(self):
+        vectors = [{'a': 1.0, 'b': 2.0}, {'b': 1.0}, {'c': 3.0}, {'a': 0.5, 'c': 1.0}]
+        sources = [0, 3]
+        expected = related._python_cosine_similarities(vectors, sources)
+        actual = related._sparse_cosine_similarities(vectors, sources)
+        for expected_row, actual_row in zip(expected, actual):
+            self.assertEqual(set(expected_row), set(actual_row))
+            for index in expected_row:
+                self.assertAlmostEqual(expected_row[index], actual_row[index])
+
+    def test_similarities_are_cosines(self):
+        vectors = [{'a': 1.0}, {'a': 2.0, 'b': 2.0}, {'c': 1.0}]
+        similarities = related.cosine_similarities(vectors, [0])[0]
+        self.assertAlmostEqual(similarities[0], 1.0)
+        self.assertAlmostEqual(similarities[1], 2 ** -0.5)
+        self.assertNotIn(2, similarities)
+
+
+class ThemedBlockRenderingTestCase(SimpleTestCase):
+    def setUp(self):
+        # Shared by every article, as blocks are
+        self.block = ArticlePage._meta.get_field('chapters').stream_block.child_blocks['chapter']
+        self.value = self.block.to_python({'heading': 'A Chapter', 'body': []})
+        self.themes = [
+            None,
+            Theme(name="Maple Washing", folder="themes/maplewashing"),
+            Theme(name="Leftist Foreign Policy", folder="themes/leftistForeignPolicy"),
+            Theme(name="No chapter template", folder="themes/default"),
+        ]
+
+    def render(self, theme):
+        return self.block.render(self.value, context={'theme': theme})
+
+    def test_blocks_render_with_the_template_of_the_theme_in_the_context(self):
+        self.assertIn('Back to top', self.render(None))
+        self.assertIn('heading-wrapper', self.render(self.themes[1]))
+        self.assertEqual(self.render(self.themes[3]), self.render(None))
+
+    def test_theme_templates_are_found_at_startup(self):
+        self.assertIn('themes/maplewashing/articles/blocks/chapter.html', resolver.find_theme_templates())
+        self.assertNotIn('themes/default/articles/blocks/chapter.html', resolver.find_theme_templates())
+
+    def test_theme_templates_are_resolved_once(self):
+        resolver.prewarm()
+        chapter = 'articles/blocks/chapter.html'
+        self.assertEqual(resolver.resolve_theme_template(self.themes[1], chapter),
+                         'themes/maplewashing/' + chapter)
+        self.assertEqual(resolver.resolve_theme_template(self.themes[3], chapter), chapter)
+        self.assertEqual(resolver.resolve_theme_template(None, chapter), chapter)
+
+        # Without searching the loaders again, even for the theme without the template
+        with mock.patch.object(resolver, 'template_exists', side_effect=AssertionError):
+            self.assertEqual(resolver.resolve_theme_template(self.themes[3], chapter), chapter)
+            self.assertEqual(self.render(self.themes[3]), self.render(None))
+
+
+class ThemedPageTemplateTestCase(TestCase):
+    def test_pages_without_a_template_in_their_theme_use_their_own(self):
+        request = RequestFactory().get('/')
+        page = ArticlePage(theme=Theme(name="Dark", folder="themes/dark"))
+        self.assertEqual(page.get_template(request), 'themes/dark/articles/article_page.html')
+        page.theme.folder = 'themes/components'
+        self.assertEqual(page.get_template(request), 'articles/article_page.html')
+
+    def test_chapters_render_with_the_theme_of_the_page(self):
+        theme = Theme(name="Maple Washing", folder="themes/maplewashing")
+        page = ArticlePage(theme=theme, chapters=[('chapter', {'heading': 'A Chapter', 'body': []})])
+        content = render_to_string('articles/includes/advanced-content.html', {'self': page, 'theme': theme})
+        self.assertIn('heading-wrapper', content)
+
+
+class ConcurrentThemedArticlesTestCase(TransactionTestCase):
+    # Committed, so that the threads serving the articles see them
+    fixtures = ["articlestest.json", ]
+
+    def setUp(self):
+        folders = [None, "themes/maplewashing", "themes/leftistForeignPolicy", "themes/millennials"]
+        self.pages = []
+        self.themes = []
+        # The purges of the committed changes go to the stand-in rather than the network
+        with fake_cloudflare() as server:
+            for pk, folder in zip((107, 108, 109, 111), folders):
+                page = ArticlePage.objects.get(pk=pk)
+                page.theme = Theme.objects.create(name=folder or "Default", folder=folder or "themes/default")
+                page.body = json.dumps([{'type': 'Paragraph', 'value': {'text': '<p>Body of {}</p>'.format(pk)}}])
+                page.chapters = json.dumps([{'type': 'chapter', 'value': {
+                    'heading': 'Chapter of {}'.format(pk),
+                    'body': [{'type': 'Paragraph', 'value': {'text': '<p>Chapter body of {}</p>'.format(pk)}}],
+                }}])
+                page.save()
+                self.pages.append(page.pk)
+                self.themes.append(page.theme.pk)
+            get_purge_coalescer().flush()
+            get_tag_purge_coalescer().flush()
+        self.purged_tags = server.purged_tags
+
+    def serve(self, pk):
+        page = ArticlePage.objects.get(pk=pk)
+        request = RequestFactory().get(page.url)
+        request.site = Site.find_for_request(request)
+        response = page.serve(request)
+        response.render()
+        return response.content
+
+    def test_concurrent_serves_use_the_theme_of_their_page(self):
+        for pk in self.themes:
+            self.assertIn(get_tag('theme', pk), self.purged_tags)
+
+        expected = dict((pk, self.serve(pk)) for pk in self.pages)
+        self.assertEqual(len(set(expected.values())), len(self.pages))
+        self.assertIn(b'heading-wrapper', expected[self.pages[1]])
+        self.assertNotIn(b'heading-wrapper', expected[self.pages[0]])
+
+        errors = []
+
+        def serve_many(offset):
+            try:
+                for i in range(10):
+                    pk = self.pages[(offset + i) % len(self.pages)]
+                    if self.serve(pk) != expected[pk]:
+                        errors.append((offset, i, pk))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=serve_many, args=(offset,)) for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+
+class MemoizedPropertyTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def test_properties_are_computed_once_while_memoizing(self):
+        series = SeriesPage.objects.get(pk=110)
+        with memoization():
+            authors = series.authors
+            articles = series.articles
+            with self.assertNumQueries(0):
+                self.assertEqual(series.authors, authors)
+                self.assertEqual(series.articles, articles)
+
+    def test_properties_are_computed_on_each_access_otherwise(self):
+        article = ArticlePage.objects.get(pk=107)
+        article.authors
+        # The links, then their authors
+        with self.assertNumQueries(2):
+            article.authors
+
+    def test_saving_forgets_the_values(self):
+        series = SeriesPage.objects.get(pk=110)
+        bob = ContributorPage.objects.get(email="bobsmith@example.com")
+        with memoization():
+            self.assertEqual(series.authors[1], bob)
+            bob.last_name = "Achange"
+            bob.save()
+            self.assertEqual(series.authors[0], bob)
+
+    def test_series_articles_leave_the_series_articles_whole(self):
+        article = ArticlePage.objects.get(pk=107)
+        with memoization():
+            series, articles = article.series_articles[0]
+            self.assertNotIn(article, articles)
+            self.assertIn(article, series.articles)
+
+    @override_settings(DEBUG=True)
+    def test_hits_and_misses_are_counted_in_debug(self):
+        article = ArticlePage.objects.get(pk=107)
+        with memoization():
+            article.topics
+            article.topics
+            article.topics
+            hits, misses = get_stats()
+            self.assertEqual(hits['ArticlePage.topics'], 2)
+            self.assertEqual(misses['ArticlePage.topics'], 1)
+
+
 class ArticleTopicLinkTestCase(TestCase):
     fixtures = ["articlestest.json", ]
 
@@ -307,6 +771,156 @@ class TopicListPageTestCase(TestCase):
         )
 
 
+class FeedEntryTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def test_live_articles_and_series_have_an_entry(self):
+        live_ids = set(ArticlePage.objects.live().values_list('pk', flat=True))
+        live_ids.update(SeriesPage.objects.live().values_list('pk', flat=True))
+        self.assertEqual(set(FeedEntry.objects.values_list('page_id', flat=True)), live_ids)
+
+    def test_entry_has_the_topics_and_authors(self):
+        article = ArticlePage.objects.get(pk=107)
+        entry = FeedEntry.objects.get(page=article)
+
+        six.assertCountEqual(self, entry.topics.all(), article.topics)
+        six.assertCountEqual(self, entry.authors.all(), article.authors)
+
+    def test_series_entry_has_the_authors_of_its_articles(self):
+        series = SeriesPage.objects.live().first()
+        entry = FeedEntry.objects.get(page=series)
+        six.assertCountEqual(self, entry.authors.all(), series.authors)
+
+    def test_unpublishing_and_publishing(self):
+        article = ArticlePage.objects.get(pk=107)
+        article.unpublish()
+        self.assertFalse(FeedEntry.objects.filter(page=article).exists())
+
+        article.save_revision().publish()
+        self.assertTrue(FeedEntry.objects.filter(page=article).exists())
+
+    def test_drafts_do_not_change_the_entry(self):
+        article = ArticlePage.objects.get(pk=107)
+        article.editors_pick = True
+        article.save_revision()
+        self.assertFalse(FeedEntry.objects.get(page=article).editors_pick)
+
+        article.save_revision().publish()
+        self.assertTrue(FeedEntry.objects.get(page=article).editors_pick)
+
+    def test_topic_links_update_the_entry(self):
+        article = ArticlePage.objects.get(pk=107)
+        topic = Topic.objects.create(name="New Topic")
+        ArticleTopicLink.objects.create(article=article, topic=topic)
+
+        self.assertIn(topic, FeedEntry.objects.get(page=article).topics.all())
+        self.assertIn(article, topic.item_list)
+
+    def test_publishing_updates_the_entry_once(self):
+        article = ArticlePage.objects.get(pk=107)
+        topic = Topic.objects.create(name="New Topic")
+        article.topic_links.add(ArticleTopicLink(topic=topic))
+
+        with mock.patch('articles.models.update_topic_stats', wraps=update_topic_stats) as update:
+            article.save_revision().publish()
+        self.assertEqual(update.call_count, 1)
+        self.assertIn(topic, FeedEntry.objects.get(page=article).topics.all())
+
+    def test_loaded_data_does_not_change_the_entry(self):
+        article = ArticlePage.objects.get(pk=107)
+        topic = Topic.objects.create(name="New Topic")
+        ArticleTopicLink(article=article, topic=topic).save_base(raw=True)
+        self.assertNotIn(topic, FeedEntry.objects.get(page=article).topics.all())
+
+    def test_topic_items_are_one_query_on_the_entries(self):
+        topic = Topic.objects.get(slug="topic-1")
+        # The entries, then the articles, the only type of page listed, and their authors and topics
+        with self.assertNumQueries(4):
+            items = topic.item_list
+        self.assertEqual(items, sorted(items, key=lambda item: item.first_published_at, reverse=True))
+
+
+@override_settings(ALLOWED_HOSTS=['localhost'])
+class TopicPageTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def setUp(self):
+        topics_page = TopicListPage.objects.get(slug='topics')
+        topics_page.articles_per_page = 1
+        topics_page.save()
+        self.topic = Topic.objects.get(slug="topic-1")
+
+    def get(self, page=None):
+        response = self.client.get('/topics/topic-1/', {'page': page} if page else {}, HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, 200)
+        return response.context['articles']
+
+    def test_pages_list_the_topic_items_in_order(self):
+        pages = [self.get()]
+        while pages[-1].has_next():
+            pages.append(self.get(pages[-1].next_page_number()))
+
+        self.assertEqual([item for page in pages for item in page], self.topic.item_list)
+        self.assertEqual(self.get(2).object_list, self.topic.item_list[1:2])
+
+    def test_only_the_listed_pages_are_loaded_without_their_body(self):
+        page = self.get()
+        self.assertEqual(len(page.object_list), 1)
+        self.assertIn('body', page.object_list[0].get_deferred_fields())
+
+
+class TopicStatsTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def assertStatsMatch(self, topic):
+        stats = TopicStats.objects.get(topic=topic)
+        items = topic.item_list
+        self.assertEqual(stats.article_count, len([item for item in items if isinstance(item, ArticlePage)]))
+        self.assertEqual(stats.series_count, len([item for item in items if isinstance(item, SeriesPage)]))
+
+    def test_stats_match_the_topic_pages(self):
+        for topic in Topic.objects.all():
+            self.assertStatsMatch(topic)
+
+    def test_unpublishing_updates_the_stats(self):
+        topic = Topic.objects.get(slug="topic-1")
+        article = topic.item_list[0]
+        count = TopicStats.objects.get(topic=topic).item_count
+
+        article.unpublish()
+        self.assertEqual(TopicStats.objects.get(topic=topic).item_count, count - 1)
+        self.assertStatsMatch(topic)
+
+    def test_topic_links_update_the_stats(self):
+        topic = Topic.objects.create(name="New Topic")
+        ArticleTopicLink.objects.create(article=ArticlePage.objects.get(pk=107), topic=topic)
+        self.assertEqual(TopicStats.objects.get(topic=topic).article_count, 1)
+
+    def test_popular_topics_are_one_query(self):
+        topics_page = TopicListPage.objects.get(slug='topics')
+        with self.assertNumQueries(1):
+            topics_page.topics
+
+    def test_cached_paths_have_a_url_per_topic_page(self):
+        topics_page = TopicListPage.objects.get(slug='topics')
+        topics_page.articles_per_page = 1
+        topics_page.save_revision().publish()
+
+        topic = Topic.objects.get(slug="topic-1")
+        page_count = TopicStats.objects.get(topic=topic).page_count
+        self.assertEqual(page_count, len(topic.item_list))
+
+        with self.assertNumQueries(1):
+            paths = list(topics_page.get_cached_paths(topics=[topic]))
+        expected = ['/', '/topic-1/'] + ['/topic-1/?page={}'.format(number) for number in range(2, page_count + 1)]
+        self.assertEqual(paths, expected)
+
+    def test_stats_can_be_rebuilt(self):
+        TopicStats.objects.all().delete()
+        update_topic_stats()
+        self.test_stats_match_the_topic_pages()
+
+
 class HeadlineTestCase(TestCase):
     def test_str_returns_id(self):
         page = TopicListPage.objects.all().first()
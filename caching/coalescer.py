@@ -0,0 +1,162 @@
+from __future__ import absolute_import, unicode_literals
+
+import atexit
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection, transaction
+from six.moves import xrange
+
+logger = logging.getLogger(__name__)
+
+# Cloudflare accepts at most 30 files per purge_cache request
+MAX_URLS_PER_PURGE = 30
+
+
+# From http://stackoverflow.com/a/434328/91243
+def chunker(seq, size):
+    return (seq[pos:pos + size] for pos in xrange(0, len(seq), size))
+
+
+class PurgeCoalescer(object):
+    '''
+    Collects the URLs to purge over a short window and sends them de-duplicated, in as few
+    requests as possible, from a background thread so that publishing never waits on the CDN.
+
+    URLs added inside a transaction are held back until it commits, and are flushed as soon as
+    it does; URLs added outside of one are flushed once the window has elapsed. `on_flush`, if
+    given, is called with all the URLs once they have been sent, except by the flush at exit.
+    '''
+    def __init__(self, send, window=None, workers=None, chunk_size=MAX_URLS_PER_PURGE, on_flush=None):
+        self.send = send
+        self.on_flush = on_flush
+        if window is None:
+            window = getattr(settings, 'CACHING_PURGE_WINDOW', 2)
+        if workers is None:
+            workers = getattr(settings, 'CACHING_PURGE_WORKERS', 4)
+        self.window = window
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_set = set()
+        self._timer = None
+        self._pool = None
+
+    def add(self, urls):
+        urls = list(urls)
+        if not urls:
+            return
+
+        if transaction.get_connection().in_atomic_block:
+            # Purging before the commit would let the CDN fetch the old content again
+            transaction.on_commit(lambda: self._queue(urls, 0))
+        else:
+            self._queue(urls, self.window)
+
+    def _queue(self, urls, delay):
+        with self._lock:
+            for url in urls:
+                if url not in self._pending_set:
+                    self._pending_set.add(url)
+                    self._pending.append(url)
+
+            if self._timer is not None:
+                if delay > 0:
+                    # A flush is already on its way and will pick these up
+                    return
+                self._timer.cancel()
+
+            self._timer = threading.Timer(delay, self._flush_in_background)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        finally:
+            # The timer thread ends here, along with the connection on_flush may have opened
+            connection.close()
+
+    def flush(self, notify=True):
+        '''
+        Send the pending URLs now, then pass them to `on_flush` if `notify`.
+        '''
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            urls = self._pending
+            self._pending = []
+            self._pending_set = set()
+
+        if not urls:
+            return
+
+        chunks = list(chunker(urls, self.chunk_size))
+        logger.info('Purging {} URLs in {} requests'.format(len(urls), len(chunks)))
+
+        if len(chunks) == 1 or self.workers <= 1:
+            for chunk in chunks:
+                self._send(chunk)
+        else:
+            self._get_pool().map(self._send, chunks)
+
+        if notify and self.on_flush is not None:
+            try:
+                self.on_flush(urls)
+            except Exception:
+                logger.exception('Unable to process {} purged URLs.'.format(len(urls)))
+
+    def _send(self, urls):
+        try:
+            self.send(urls)
+        except Exception:
+            logger.exception('Unable to purge {} URLs.'.format(len(urls)))
+
+    def _get_pool(self):
+        # Created lazily so that it is never shared across forked worker processes
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        return self._pool
+
+    @property
+    def pending(self):
+        with self._lock:
+            return list(self._pending)
+
+
+_purge_coalescer = None
+
+
+def get_purge_coalescer():
+    global _purge_coalescer
+    if _purge_coalescer is None:
+        from .invalidate import cloudflare_purge_chunk
+        from .warmer import is_enabled_after_publish, warm_urls
+
+        _purge_coalescer = PurgeCoalescer(cloudflare_purge_chunk,
+                                          on_flush=warm_urls if is_enabled_after_publish() else None)
+        # Don't lose purges still waiting for their window when the process exits, without warming
+        # the URLs on the way out
+        atexit.register(_purge_coalescer.flush, notify=False)
+
+    return _purge_coalescer
+
+
+_tag_purge_coalescer = None
+
+
+def get_tag_purge_coalescer():
+    global _tag_purge_coalescer
+    if _tag_purge_coalescer is None:
+        from .invalidate import cloudflare_purge_tag_chunk
+
+        # Cloudflare takes as many tags as files per request
+        _tag_purge_coalescer = PurgeCoalescer(cloudflare_purge_tag_chunk)
+        atexit.register(_tag_purge_coalescer.flush)
+
+    return _tag_purge_coalescer
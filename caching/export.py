@@ -0,0 +1,315 @@
+'''
+Renders every public URL of the site to a tree of static files, so that it can be served from
+object storage alone.
+
+Each URL is written under its host, with an index file for URLs ending in a slash, and with gzip
+(and brotli, when installed) variants next to it. manifest.json lists what was exported, with the
+content type of each file and the validator it was rendered at (see ThemeablePage.get_etag()), so
+that an incremental export only renders the URLs whose validator has changed.
+'''
+from __future__ import absolute_import, unicode_literals
+
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.paginator import PageNotAnInteger
+from django.core.handlers.base import BaseHandler
+from django.core.urlresolvers import reverse, set_urlconf
+from django.db import connection
+from django.http import HttpRequest
+from django.test import RequestFactory
+from six.moves.urllib.parse import urljoin, urlparse
+from wagtail.wagtailcore.models import Page, Site
+
+from core.conditional import get_listing_etag
+from core.pagination import decode_cursor, is_cursor
+
+from .invalidate import get_page_urls
+from .warmer import get_sitemap_urls
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+
+# Extension of the index files written for URLs ending in a slash
+EXTENSIONS = {
+    'text/html': '.html',
+    'application/rss+xml': '.xml',
+    'application/xml': '.xml',
+    'application/json': '.json',
+}
+
+# Links of the pagers of the list pages, e.g. href="?page=2"
+PAGE_LINK = re.compile(br'href="\?page=([\w.-]+)"')
+
+ExportResult = namedtuple('ExportResult', ['url', 'status', 'path', 'elapsed', 'skipped', 'error'])
+
+
+def get_export_urls():
+    '''
+    Return the URLs to export, each with the validator of its content: the paths of every live page
+    (including the topic routes of TopicListPage), the sitemap, the feed and the sitemap itself.
+    '''
+    # Only used to compute the listing validator once
+    request = HttpRequest()
+    listing_etag = get_listing_etag(request)
+
+    urls = []
+    seen = set()
+
+    def add(url, etag):
+        if url not in seen:
+            seen.add(url)
+            urls.append((url, etag))
+
+    for page in Page.objects.live().specific():
+        if hasattr(page, 'get_etag'):
+            etag = page.get_etag(request)
+        else:
+            etag = 'page-{}-{}-{}'.format(page.pk, page.live_revision_id, listing_etag)
+        for url in get_page_urls(page):
+            add(url, etag)
+
+    # The sitemap lists a few URLs no page reports, which can change with any publish
+    for url in get_sitemap_urls():
+        add(url, listing_etag)
+
+    root_url = Site.objects.get(is_default_site=True).root_url
+    add(urljoin(root_url, reverse('main_feed')), listing_etag)
+    add(urljoin(root_url, reverse('django.contrib.sitemaps.views.sitemap')), listing_etag)
+
+    return urls
+
+
+def get_export_path(url, content_type):
+    '''
+    Return the path of the file for a URL, relative to the root of the export.
+    '''
+    parsed = urlparse(url)
+    path = parsed.path.lstrip('/')
+    if not path or path.endswith('/'):
+        name = 'index'
+        if parsed.query:
+            # Static hosts ignore query strings, so pagination gets its own files
+            name += '-' + re.sub(r'[^\w]+', '-', parsed.query).strip('-')
+        path += name + EXTENSIONS.get(content_type.split(';')[0].strip(), '.html')
+    elif parsed.query:
+        root, ext = os.path.splitext(path)
+        path = '{}-{}{}'.format(root, re.sub(r'[^\w]+', '-', parsed.query).strip('-'), ext)
+
+    return os.path.join(parsed.netloc, *path.split('/'))
+
+
+def get_page_link(url, number):
+    '''
+    Return the path of the file of page `number` of the listing at `url`, as exported.
+    '''
+    path = urlparse(url).path
+    if number == 1:
+        return path
+    return path + os.path.basename(get_export_path(urljoin(url, '?page={}'.format(number)), 'text/html'))
+
+
+def rewrite_page_links(content, url):
+    '''
+    Point the Previous and Next links of the listing at `url` to the files of the pages they go to,
+    as static hosts ignore query strings. Cursors link to the numbered page they stand for, which is
+    exported with the same articles.
+    '''
+    def replace(match):
+        number = match.group(1).decode('ascii')
+        try:
+            if is_cursor(number):
+                number = decode_cursor(number)[1]
+            number = int(number)
+        except (PageNotAnInteger, ValueError):
+            return match.group(0)
+        return 'href="{}"'.format(get_page_link(url, number)).encode('utf-8')
+
+    return PAGE_LINK.sub(replace, content)
+
+
+def _write(path, content):
+    # Written aside and moved in place, so that the tree can be served while it is exported
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    tmp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+
+
+def _gzip(content):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+def _remove(path):
+    for variant in (path, path + '.gz', path + '.br'):
+        if os.path.exists(variant):
+            os.remove(variant)
+
+
+class ExportHandler(BaseHandler):
+    '''
+    Serves requests in-process through the middleware of the site, as the WSGI handler does, but
+    around the page cache: an export renders every page afresh and stores none of them.
+    '''
+    def __init__(self):
+        super(ExportHandler, self).__init__()
+        self.load_middleware()
+
+    def __call__(self, request):
+        set_urlconf(settings.ROOT_URLCONF)
+        request.skip_page_cache = True
+        return self.get_response(request)
+
+
+class StaticExporter(object):
+    '''
+    Renders URLs in-process, `workers` at a time, and writes them under `root`.
+    '''
+    def __init__(self, root, workers=4, compress=True):
+        self.root = root
+        self.workers = workers
+        self.compress = compress
+        self._handler = None
+        self._factory = RequestFactory()
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.root, MANIFEST_NAME)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_manifest(self, manifest):
+        content = json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+        _write(os.path.join(self.root, MANIFEST_NAME), content)
+
+    def export(self, urls=None, incremental=False):
+        '''
+        Export the URLs (all of them by default), yielding an ExportResult for each. Files of URLs
+        that are no longer exported are removed.
+        '''
+        if urls is None:
+            urls = get_export_urls()
+
+        manifest = self.load_manifest()
+        previous = manifest.get('urls', {})
+        exported = {}
+
+        def is_current(url, etag):
+            entry = previous.get(url)
+            return (
+                incremental
+                and entry is not None
+                and entry['etag'] == etag
+                and os.path.exists(os.path.join(self.root, entry['path']))
+            )
+
+        to_render = []
+        for url, etag in urls:
+            if is_current(url, etag):
+                exported[url] = previous[url]
+                yield ExportResult(url, 200, previous[url]['path'], 0, True, None)
+            else:
+                to_render.append((url, etag))
+
+        if self.workers <= 1:
+            results = (self.render(job) for job in to_render)
+        else:
+            pool = ThreadPool(self.workers)
+            results = pool.imap_unordered(self.render, to_render)
+
+        try:
+            for result, entry in results:
+                if entry is None and (result.status is None or result.status >= 500):
+                    # Keep serving the last good export rather than nothing
+                    entry = previous.get(result.url)
+                if entry is not None:
+                    exported[result.url] = entry
+                yield result
+        finally:
+            if self.workers > 1:
+                pool.close()
+                pool.join()
+
+        exported_paths = set(entry['path'] for entry in exported.values())
+        for url, entry in previous.items():
+            if url not in exported and entry['path'] not in exported_paths:
+                _remove(os.path.join(self.root, entry['path']))
+
+        manifest['urls'] = exported
+        manifest['exported_at'] = time.time()
+        self.save_manifest(manifest)
+
+    def get_handler(self):
+        # Shared by the workers, as the WSGI handler is by the threads of a server
+        if self._handler is None:
+            self._handler = ExportHandler()
+        return self._handler
+
+    def render(self, job):
+        url, etag = job
+        parsed = urlparse(url)
+        path = parsed.path + ('?' + parsed.query if parsed.query else '')
+
+        start = time.time()
+        try:
+            request = self._factory.get(path, HTTP_HOST=parsed.netloc, secure=parsed.scheme == 'https')
+            response = self.get_handler()(request)
+        except Exception as e:
+            logger.exception('Unable to render {}'.format(url))
+            return ExportResult(url, None, None, time.time() - start, False, e), None
+        finally:
+            if self.workers > 1:
+                # Like a request served by the site, each render of a worker gets a connection of
+                # its own, closed once done with rather than left open when the pool ends
+                connection.close()
+
+        elapsed = time.time() - start
+        if response.status_code != 200:
+            return ExportResult(url, response.status_code, None, elapsed, False, None), None
+
+        content_type = response.get('Content-Type', 'text/html')
+        relative_path = get_export_path(url, content_type)
+        file_path = os.path.join(self.root, relative_path)
+        content = response.content
+        if relative_path.endswith('.html'):
+            content = rewrite_page_links(content, url)
+
+        _write(file_path, content)
+        if self.compress:
+            _write(file_path + '.gz', _gzip(content))
+            if brotli is not None:
+                _write(file_path + '.br', brotli.compress(content))
+
+        entry = {
+            'path': relative_path,
+            'etag': etag,
+            'content_type': content_type,
+        }
+        return ExportResult(url, 200, relative_path, elapsed, False, None), entry
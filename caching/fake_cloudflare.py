@@ -0,0 +1,230 @@
+'''
+A local stand-in for the Cloudflare purge_cache endpoint, so that cache invalidation can be
+exercised and measured without a live zone.
+
+    with fake_cloudflare(latency=0.05, rate_limit=10) as server:
+        ... publish some pages ...
+    server.purged_urls
+
+The test settings send no purges otherwise (see opencanada/settings/test.py).
+'''
+from __future__ import absolute_import, unicode_literals
+
+import json
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlparse
+
+PURGE_PATH_RE = re.compile(r'^(?P<prefix>.*)/zones/(?P<zone>[^/]+)/purge_cache/?$')
+
+# Cloudflare rejects purges of more files, or tags, than this
+MAX_FILES = 30
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _PurgeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_DELETE(self):
+        self.server.fake.handle(self)
+
+    # The current API purges with POST, the one we use with DELETE
+    do_POST = do_DELETE
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeCloudflareServer(object):
+    '''
+    In-process HTTP server answering /zones/{ZONEID}/purge_cache like Cloudflare does.
+
+    Every request is recorded. `latency` seconds are added to each response, a fraction
+    `error_rate` of requests fail with a 500, and once more than `rate_limit` requests arrive
+    within `rate_limit_period` seconds the rest get a 429 with a Retry-After header.
+    '''
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0, rate_limit=None,
+                 rate_limit_period=1, retry_after=1):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_period = rate_limit_period
+        self.retry_after = retry_after
+
+        self._lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+        self.reset()
+
+    @classmethod
+    def from_settings(cls, **kwargs):
+        '''
+        Listen on the address the Cloudflare API_URL setting points at.
+        '''
+        config = getattr(settings, 'WAGTAILFRONTENDCACHE', {}).get('cloudflare', {})
+        api_url = urlparse(config.get('API_URL', ''))
+        if api_url.hostname in ('127.0.0.1', 'localhost'):
+            kwargs.setdefault('host', api_url.hostname)
+            kwargs.setdefault('port', api_url.port or 80)
+        return cls(**kwargs)
+
+    def reset(self):
+        with self._lock:
+            self.requests = []
+            self._window = []
+
+    def start(self):
+        self._httpd = _ThreadingHTTPServer((self.host, self.port), _PurgeRequestHandler)
+        self._httpd.fake = self
+        self.port = self._httpd.server_address[1]
+
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+            self._thread.join()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/client/v4'.format(self.host, self.port)
+
+    @property
+    def purged_urls(self):
+        with self._lock:
+            return [url for request in self.requests if request['status'] == 200
+                    for url in request['data'].get('files', [])]
+
+    @property
+    def purged_tags(self):
+        with self._lock:
+            return [tag for request in self.requests if request['status'] == 200
+                    for tag in request['data'].get('tags', [])]
+
+    @property
+    def purge_everything_count(self):
+        with self._lock:
+            return len([request for request in self.requests
+                        if request['status'] == 200 and request['data'].get('purge_everything')])
+
+    def handle(self, handler):
+        match = PURGE_PATH_RE.match(urlparse(handler.path).path)
+        if match is None:
+            return handler.send_json(404, self._error(7000, 'No route for that URI'))
+
+        length = int(handler.headers.get('Content-Length') or 0)
+        try:
+            data = json.loads(handler.rfile.read(length).decode('utf-8') or '{}')
+        except ValueError:
+            data = None
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        status, response, headers = self._respond(data)
+
+        with self._lock:
+            self.requests.append({
+                'method': handler.command,
+                'zone': match.group('zone'),
+                'data': data or {},
+                'status': status,
+                'time': time.time(),
+            })
+
+        handler.send_json(status, response, headers)
+
+    def _respond(self, data):
+        if self._is_rate_limited():
+            return 429, self._error(971, 'Please wait and consider throttling your request speed'), {
+                'Retry-After': str(self.retry_after),
+            }
+
+        if self.error_rate and random.random() < self.error_rate:
+            return 500, self._error(1000, 'Internal Server Error'), {}
+
+        if not isinstance(data, dict) or not (data.get('purge_everything') or data.get('files') or data.get('tags')):
+            return 400, self._error(1012, 'Request must contain one of "purge_everything", "files" or "tags"'), {}
+
+        if len(data.get('files', [])) > MAX_FILES:
+            return 400, self._error(1015, 'Only {} files can be purged per request'.format(MAX_FILES)), {}
+
+        if len(data.get('tags', [])) > MAX_FILES:
+            return 400, self._error(1015, 'Only {} tags can be purged per request'.format(MAX_FILES)), {}
+
+        return 200, {
+            'success': True,
+            'errors': [],
+            'messages': [],
+            'result': {'id': 'fake'},
+        }, {}
+
+    def _is_rate_limited(self):
+        if self.rate_limit is None:
+            return False
+
+        now = time.time()
+        with self._lock:
+            self._window = [t for t in self._window if now - t < self.rate_limit_period]
+            if len(self._window) >= self.rate_limit:
+                return True
+            self._window.append(now)
+        return False
+
+    def _error(self, code, message):
+        return {
+            'success': False,
+            'errors': [{'code': code, 'message': message}],
+            'messages': [],
+            'result': None,
+        }
+
+
+@contextmanager
+def fake_cloudflare(**kwargs):
+    '''
+    Run a FakeCloudflareServer and send every purge to it for the duration of the block.
+    '''
+    from . import invalidate
+
+    server = FakeCloudflareServer.from_settings(**kwargs).start()
+
+    config = dict(getattr(settings, 'WAGTAILFRONTENDCACHE', {}).get('cloudflare') or {
+        'EMAIL': 'fake@example.com',
+        'TOKEN': 'fake',
+        'ZONEID': 'fake',
+    })
+    config['API_URL'] = server.url
+
+    original_client = invalidate._cloudflare_client
+    invalidate._cloudflare_client = invalidate.CloudflareClient(config)
+    try:
+        yield server
+    finally:
+        invalidate._cloudflare_client = original_client
+        server.stop()
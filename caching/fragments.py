@@ -0,0 +1,265 @@
+'''
+Cache of the HTML of the blocks of a page's StreamFields, such as the chapters and body blocks of
+articles, rendered with:
+
+    {% include_cached_block block %}
+
+in place of include_block (see articles/templatetags/article_tags.py).
+
+Fragments are keyed by page, live revision, theme, stream field and the id of the block in its
+stream, or its position for blocks saved before blocks had ids, so that publishing a page or
+changing its theme renders its blocks afresh. Deploying new templates does too, the key including
+a version of the template files. The key also holds the versions core.rich_text gives the pages,
+images, documents and snippets the block chooses or links to, so that changing one of them renders
+the blocks showing it again. Fragments are kept in a small in-process LRU in front of the
+CACHING_FRAGMENT_CACHE_ALIAS cache (Redis in production), for CACHING_FRAGMENT_CACHE_TIMEOUT
+seconds.
+
+Blocks whose HTML depends on more than their value, the page and its theme, such as on the request
+or on other pages, opt out with `cacheable = False` in their Meta, which also leaves out the blocks
+holding one of them. Previews are never cached.
+
+The keys are computed from the stream data of the blocks, so that pages deferring the loading of
+what their blocks refer to (see articles/references.py) only load it for the blocks not cached.
+'''
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import six
+from django.conf import settings
+from django.core.cache import caches
+from django.template.utils import get_app_template_dirs
+from django.utils.safestring import mark_safe
+from wagtail.wagtailcore import blocks
+from wagtail.wagtailcore.fields import StreamField
+
+from articles.references import iter_chooser_values
+from core import rich_text
+from themes.blocks import get_context_theme
+
+_lru = None
+_lru_lock = threading.Lock()
+_templates_version = None
+
+
+def is_enabled():
+    return getattr(settings, 'CACHING_FRAGMENT_CACHE_ENABLED', False)
+
+
+def get_cache():
+    return caches[getattr(settings, 'CACHING_FRAGMENT_CACHE_ALIAS', 'default')]
+
+
+def get_timeout():
+    return getattr(settings, 'CACHING_FRAGMENT_CACHE_TIMEOUT', 60 * 60)
+
+
+class LRUCache(object):
+    '''
+    A thread-safe mapping keeping the `size` most recently used items, each for `timeout` seconds.
+    '''
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None or item[0] < time.time():
+                return None
+            self._items[key] = item
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + self.timeout, value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+def get_lru():
+    global _lru
+    if _lru is None:
+        with _lru_lock:
+            if _lru is None:
+                _lru = LRUCache(getattr(settings, 'CACHING_FRAGMENT_CACHE_LRU_SIZE', 1000), get_timeout())
+    return _lru
+
+
+def get_templates_version():
+    '''
+    Return a hash of the names and modification times of the template files, which changes when
+    templates are deployed.
+    '''
+    global _templates_version
+    if _templates_version is None:
+        directories = []
+        for engine in settings.TEMPLATES:
+            directories.extend(engine.get('DIRS', []))
+            if engine.get('APP_DIRS'):
+                directories.extend(get_app_template_dirs('templates'))
+
+        digest = hashlib.md5()
+        for directory in directories:
+            for root, dirs, files in os.walk(directory):
+                dirs.sort()
+                for filename in sorted(files):
+                    path = os.path.join(root, filename)
+                    digest.update('{}:{}|'.format(path, int(os.path.getmtime(path))).encode('utf-8'))
+        _templates_version = digest.hexdigest()[:12]
+    return _templates_version
+
+
+def may_be_uncacheable(block):
+    '''
+    Whether the block, or a block it can contain, opts out of the cache.
+    '''
+    uncacheable = getattr(block, '_fragment_uncacheable', None)
+    if uncacheable is None:
+        children = list(getattr(block, 'child_blocks', {}).values())
+        if getattr(block, 'child_block', None) is not None:
+            children.append(block.child_block)
+
+        uncacheable = not getattr(block.meta, 'cacheable', True) or any(may_be_uncacheable(child) for child in children)
+        block._fragment_uncacheable = uncacheable
+    return uncacheable
+
+
+def is_cacheable(block, raw_value):
+    '''
+    Whether the block can be cached with the stream data `raw_value`: none of the blocks it holds
+    opts out.
+    '''
+    if not may_be_uncacheable(block):
+        return True
+    if not getattr(block.meta, 'cacheable', True):
+        return False
+
+    if isinstance(block, blocks.BaseStreamBlock):
+        return all(
+            is_cacheable(block.child_blocks[item['type']], item.get('value'))
+            for item in raw_value or [] if item['type'] in block.child_blocks
+        )
+    if isinstance(block, blocks.BaseStructBlock):
+        return all(
+            is_cacheable(child_block, (raw_value or {}).get(name))
+            for name, child_block in block.child_blocks.items()
+        )
+    if isinstance(block, blocks.ListBlock):
+        return all(is_cacheable(block.child_block, item) for item in raw_value or [])
+    return True
+
+
+def get_stream_field_names(model):
+    names = getattr(model, '_fragment_stream_fields', None)
+    if names is None:
+        names = model._fragment_stream_fields = [
+            field.name for field in model._meta.get_fields() if isinstance(field, StreamField)
+        ]
+    return names
+
+
+def find_in_streams(page, child):
+    '''
+    Return the name of the page's StreamField holding the block and the block's stream data, or
+    None and None if it is in none of them.
+    '''
+    for name in get_stream_field_names(type(page)):
+        value = getattr(page, name, None)
+        if isinstance(value, blocks.StreamValue):
+            for index, item in enumerate(value):
+                if item is child:
+                    if value.is_lazy:
+                        return name, value.stream_data[index].get('value')
+                    return name, child.block.get_prep_value(child.value)
+    return None, None
+
+
+def collect_references(block, raw_value, references):
+    '''
+    Add the (kind, id) of the pages, images, documents and snippets the stream data `raw_value` of
+    `block` chooses or links to in its rich text to `references`, kinds as in core.rich_text.
+    '''
+    for chooser_block, value in iter_chooser_values(block, raw_value):
+        if isinstance(chooser_block, blocks.RichTextBlock):
+            references.update(rich_text.get_references(value))
+        else:
+            references.add((rich_text.get_kind(chooser_block.target_model), six.text_type(value)))
+
+
+def get_fragment_key(context, child):
+    '''
+    Return the key of a block of a stream, rendered in `context`, or None if it is not to be cached.
+    '''
+    request = context.get('request')
+    page = context.get('page')
+    if getattr(request, 'is_preview', False) or page is None or not getattr(page, 'live_revision_id', None):
+        return None
+
+    # From the stream data, so that the objects the block refers to are not loaded
+    field_name, raw_value = find_in_streams(page, child)
+
+    # Blocks saved before blocks had ids are keyed by their position in the stream
+    block_id = getattr(child, 'id', None)
+    if block_id is None:
+        forloop = context.get('forloop')
+        if forloop is None or field_name is None:
+            return None
+        block_id = 'position-{}'.format(forloop['counter0'])
+
+    if field_name is None:
+        raw_value = child.block.get_prep_value(child.value)
+    if not is_cacheable(child.block, raw_value):
+        return None
+
+    references = set()
+    collect_references(child.block, raw_value, references)
+    versions = rich_text.get_versions(references)
+
+    theme = get_context_theme(context)
+    parts = [
+        page.pk,
+        page.live_revision_id,
+        theme.pk if theme else '',
+        theme.folder if theme else '',
+        get_templates_version(),
+        field_name or '',
+        child.block_type,
+        block_id,
+    ] + ['{}.{}.{}'.format(kind, pk, versions[(kind, pk)]) for kind, pk in sorted(references)]
+    return 'fragment:{}'.format(hashlib.md5('|'.join(six.text_type(part) for part in parts).encode('utf-8')).hexdigest())
+
+
+def render_block(context, child):
+    '''
+    Render a block of a stream like include_block does, from the fragment cache if it can be.
+    '''
+    key = get_fragment_key(context, child) if is_enabled() else None
+    if key is None:
+        return child.render_as_block(context=context.flatten())
+
+    lru = get_lru()
+    html = lru.get(key)
+    if html is None:
+        cache = get_cache()
+        html = cache.get(key)
+        if html is None:
+            html = child.render_as_block(context=context.flatten())
+            cache.set(key, html, get_timeout())
+        lru.set(key, html)
+    return mark_safe(html)
@@ -1,21 +1,35 @@
 from __future__ import absolute_import, unicode_literals
 
 import logging
+import threading
+import time
+from itertools import chain
 
 import requests
 from django.conf import settings
-from django.db.models.signals import pre_delete
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
-from wagtail.contrib.wagtailfrontendcache.utils import purge_page_from_cache
-from wagtail.wagtailcore.signals import page_published
+from requests.adapters import HTTPAdapter
+from six.moves.urllib.parse import urljoin
+from wagtail.wagtailcore.models import Page, Site
+from wagtail.wagtailcore.signals import page_published, page_unpublished
 
 from articles import models as articles_models
+from core.bulk import defer
+from core.cache_tags import get_listing_tag, get_purge_tags
 from core.models import HomePage
 from events.models import EventListPage, EventPage
 from jobs.models import JobPostingListPage, JobPostingPage
 from newsletter.models import NewsletterListPage, NewsletterPage
 from people.models import ContributorListPage, ContributorPage
-from six.moves import xrange
+from projects.models import ProjectListPage, ProjectPage
+from themes.models import Theme, ThemeContent
+
+from . import page_cache
+from .coalescer import (MAX_URLS_PER_PURGE, chunker, get_purge_coalescer,
+                        get_tag_purge_coalescer)
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +43,8 @@ invalidation_map = {
 
     NewsletterPage: [NewsletterListPage],
 
+    ProjectPage: [ProjectListPage],
+
     articles_models.ArticlePage: [
         articles_models.ArticleListPage,
         articles_models.TopicListPage,
@@ -45,14 +61,12 @@ invalidation_map = {
 
     articles_models.ExternalArticlePage: [
         articles_models.ArticleListPage,
+        articles_models.ExternalArticleListPage,
         HomePage,
     ]
 }
 
 
-# TODO: Invalidate related pages when possible.
-
-
 _cloudflare_config = None
 
 
@@ -73,81 +87,526 @@ def get_cloudflare_config():
     return _cloudflare_config
 
 
-def cloudflare_request(method, url, data):
-    cloudflare_config = get_cloudflare_config()
-
-    if cloudflare_config is None:
-        return
+class CloudflareClient(object):
+    '''
+    Client for the Cloudflare API.
 
+    Requests go through a keep-alive session with connect/read timeouts, and are retried with
+    exponential backoff on 429 and 5xx responses, waiting at least as long as Cloudflare asks
+    through its rate-limit headers. After `failure_threshold` consecutive failed requests the
+    circuit opens for `recovery_time` seconds: purges are queued instead of sent, and replayed
+    as soon as a request succeeds again.
+    '''
     url_base = 'https://api.cloudflare.com/client/v4'
-    url = url_base + url.format(**cloudflare_config)
-
-    headers = {
-        'X-Auth-Email': cloudflare_config['EMAIL'],
-        'X-Auth-Key': cloudflare_config['TOKEN'],
-    }
-
-    resp = method(url, json=data, headers=headers)
-    try:
-        resp_json = resp.json()
-    except ValueError:
-        logger.error('Cloudflare API Error: Unable to parse response into JSON. {}'.format(resp.content))
-        return None
+    purge_path = '/zones/{ZONEID}/purge_cache'
+
+    def __init__(self, config, timeout=(3.05, 10), max_retries=3, backoff_factor=0.5, max_backoff=30,
+                 failure_threshold=5, recovery_time=60, pool_size=10):
+        self.config = config
+        self.url_base = config.get('API_URL', self.url_base)
+        self.timeout = config.get('TIMEOUT', timeout)
+        self.max_retries = config.get('MAX_RETRIES', max_retries)
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.failure_threshold = config.get('FAILURE_THRESHOLD', failure_threshold)
+        self.recovery_time = config.get('RECOVERY_TIME', recovery_time)
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'X-Auth-Email': config['EMAIL'],
+            'X-Auth-Key': config['TOKEN'],
+        })
+        # One connection per purge worker, kept alive between calls
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._queued_urls = []
+        self._queued_tags = []
+        self._queued_purge_everything = False
+
+    def request(self, method, path, data):
+        resp, delivered = self._request(method, path, data)
+        return resp
+
+    def purge_everything(self):
+        if self._is_open():
+            logger.warning('Cloudflare API unavailable: purge of everything queued.')
+            self._queue(purge_everything=True)
+            return None
 
-    if resp_json['success'] is False:
-        logger.error('Cloudflare API Error: Request did not succeed. {}'.format(resp_json))
-        return None
+        resp, delivered = self._request('DELETE', self.purge_path, {"purge_everything": True})
+        if delivered:
+            self._replay_queued()
+        else:
+            self._queue(purge_everything=True)
+        return resp
+
+    def purge_files(self, urls):
+        if self._is_open():
+            logger.warning('Cloudflare API unavailable: purge of {} URLs queued.'.format(len(urls)))
+            self._queue(urls=urls)
+            return None
 
-    return resp
+        resp, delivered = self._request('DELETE', self.purge_path, {"files": urls})
+        if delivered:
+            self._replay_queued()
+        else:
+            self._queue(urls=urls)
+        return resp
+
+    def purge_tags(self, tags):
+        if self._is_open():
+            logger.warning('Cloudflare API unavailable: purge of {} tags queued.'.format(len(tags)))
+            self._queue(tags=tags)
+            return None
+
+        resp, delivered = self._request('DELETE', self.purge_path, {"tags": tags})
+        if delivered:
+            self._replay_queued()
+        else:
+            self._queue(tags=tags)
+        return resp
+
+    @property
+    def queued(self):
+        with self._lock:
+            return self._queued_purge_everything, list(self._queued_urls)
+
+    @property
+    def queued_tags(self):
+        with self._lock:
+            return list(self._queued_tags)
+
+    def _request(self, method, path, data):
+        '''
+        Returns the response, or None if the request failed, and whether Cloudflare received the
+        request at all.
+        '''
+        url = self.url_base + path.format(**self.config)
+
+        resp = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self._get_retry_delay(attempt, resp))
+
+            start = time.time()
+            try:
+                resp = self.session.request(method, url, json=data, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                resp = None
+                logger.warning('Cloudflare API Error: {} {} failed after {:.0f}ms. {}'.format(
+                    method, path, (time.time() - start) * 1000, e))
+                continue
+
+            logger.info('Cloudflare API: {} {} returned {} in {:.0f}ms'.format(
+                method, path, resp.status_code, (time.time() - start) * 1000))
+
+            if resp.status_code != 429 and resp.status_code < 500:
+                self._record_success()
+                return self._parse(resp), True
+
+        self._record_failure()
+        if resp is not None:
+            logger.error('Cloudflare API Error: {} {} still returned {} after {} attempts.'.format(
+                method, path, resp.status_code, self.max_retries + 1))
+        return None, False
+
+    def _parse(self, resp):
+        try:
+            resp_json = resp.json()
+        except ValueError:
+            logger.error('Cloudflare API Error: Unable to parse response into JSON. {}'.format(resp.content))
+            return None
+
+        if resp_json.get('success') is False:
+            logger.error('Cloudflare API Error: Request did not succeed. {}'.format(resp_json))
+            return None
+
+        return resp
+
+    def _get_retry_delay(self, attempt, resp):
+        delay = self.backoff_factor * (2 ** (attempt - 1))
+
+        if resp is not None:
+            # Cloudflare tells us how long to back off when rate limiting
+            for header in ('Retry-After', 'X-RateLimit-Reset'):
+                try:
+                    requested = float(resp.headers[header])
+                except (KeyError, ValueError):
+                    continue
+                if requested > time.time():
+                    # An epoch timestamp rather than a number of seconds
+                    requested -= time.time()
+                delay = max(delay, requested)
+                break
+
+        return min(delay, self.max_backoff)
+
+    def _is_open(self):
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.time() - self._opened_at >= self.recovery_time:
+                # Half open: let the next request through to probe the API
+                return False
+            return True
+
+    def _record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.warning('Cloudflare API available again, closing the circuit.')
+            self._failures = 0
+            self._opened_at = None
+
+    def _record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.error('Cloudflare API Error: {} consecutive failures, opening the circuit for {}s.'.format(
+                        self._failures, self.recovery_time))
+                # Restarts the recovery period when probing in the half open state fails
+                self._opened_at = time.time()
+
+    def _queue(self, urls=None, tags=None, purge_everything=False):
+        with self._lock:
+            if purge_everything:
+                self._queued_purge_everything = True
+            if urls:
+                queued = set(self._queued_urls)
+                self._queued_urls.extend(url for url in urls if url not in queued)
+            if tags:
+                queued = set(self._queued_tags)
+                self._queued_tags.extend(tag for tag in tags if tag not in queued)
+
+    def _replay_queued(self):
+        with self._lock:
+            purge_everything, urls, tags = self._queued_purge_everything, self._queued_urls, self._queued_tags
+            self._queued_purge_everything = False
+            self._queued_urls = []
+            self._queued_tags = []
+
+        if purge_everything:
+            logger.warning('Replaying the queued purge of everything.')
+            self.purge_everything()
+            return
+
+        if urls:
+            logger.warning('Replaying the queued purge of {} URLs.'.format(len(urls)))
+            for chunk in chunker(urls, MAX_URLS_PER_PURGE):
+                self.purge_files(chunk)
+        if tags:
+            logger.warning('Replaying the queued purge of {} tags.'.format(len(tags)))
+            for chunk in chunker(tags, MAX_URLS_PER_PURGE):
+                self.purge_tags(chunk)
+
+
+_cloudflare_client = None
+_cloudflare_client_lock = threading.Lock()
+
+
+def get_cloudflare_client():
+    global _cloudflare_client
+    with _cloudflare_client_lock:
+        if _cloudflare_client is None:
+            if not getattr(settings, 'CACHING_PURGE_ENABLED', True):
+                return None
+
+            cloudflare_config = get_cloudflare_config()
+            if cloudflare_config is None:
+                return None
+
+            _cloudflare_client = CloudflareClient(cloudflare_config)
+
+    return _cloudflare_client
 
 
 def cloudflare_purge_all():
-    data = {"purge_everything": True}
+    client = get_cloudflare_client()
+    if client is not None:
+        client.purge_everything()
+
 
-    cloudflare_request(
-        requests.delete,
-        '/zones/{ZONEID}/purge_cache',
-        data,
-    )
+def cloudflare_purge_chunk(urls):
+    client = get_cloudflare_client()
+    if client is not None:
+        client.purge_files(urls)
 
 
-# From http://stackoverflow.com/a/434328/91243
-def chunker(seq, size):
-    return (seq[pos:pos + size] for pos in xrange(0, len(seq), size))
+def cloudflare_purge_tag_chunk(tags):
+    client = get_cloudflare_client()
+    if client is not None:
+        client.purge_tags(tags)
 
 
 def cloudflare_purge_urls(urls):
     if not isinstance(urls, list):
         urls = [urls]
 
-    for urls in chunker(urls, 30):
-        data = {"files": urls}
+    for urls in chunker(urls, MAX_URLS_PER_PURGE):
+        cloudflare_purge_chunk(urls)
+
+
+def get_page_urls(page, **kwargs):
+    """
+    Return the full URL of every path the page serves, as reported by its get_cached_paths().
+    """
+    page_url = page.full_url
+    if page_url is None:
+        # Nothing to purge for a page without a routable URL
+        return []
+
+    return [page_url + path[1:] for path in page.get_cached_paths(**kwargs)]
+
+
+def get_site_urls(instance):
+    """
+    Return the URLs of the feed and the sitemap listing the instance, which are not pages.
+    """
+    site = Site.objects.filter(is_default_site=True).first()
+    if site is None:
+        return []
+
+    names = ['django.contrib.sitemaps.views.sitemap']
+    if isinstance(instance, articles_models.FEED_MODELS):
+        names.append('main_feed')
+    return [urljoin(site.root_url, reverse(name)) for name in names]
+
+
+def get_affected_topics(instance):
+    """
+    Return the topics whose topic pages list the instance, or listed it before it was published, or
+    None if it is not listed on any.
+    """
+    if isinstance(instance, articles_models.ArticlePage):
+        topics = list(instance.topics)
+    elif isinstance(instance, articles_models.SeriesPage):
+        # Series are only listed under their primary topic (see Topic.item_list)
+        topics = [instance.primary_topic] if instance.primary_topic else []
+    else:
+        return None
 
-        cloudflare_request(
-            requests.delete,
-            '/zones/{ZONEID}/purge_cache',
-            data,
+    left_ids = getattr(instance, '_listed_topic_ids', set()) - set(topic.pk for topic in topics)
+    if left_ids:
+        topics.extend(articles_models.Topic.objects.filter(pk__in=left_ids))
+    return topics
+
+
+def get_affected_projects(instance):
+    """
+    Return the live project pages listing the instance, or listing it before it was published.
+    """
+    project_ids = {getattr(instance, 'project_id', None), getattr(instance, '_listed_project_id', None)}
+    project_ids.discard(None)
+    if not project_ids:
+        return []
+    return ProjectPage.objects.live().filter(pk__in=project_ids)
+
+
+def get_dependent_pages(instance):
+    """
+    Return the live pages that render part of the instance outside of the index pages in the invalidation map.
+    """
+    if isinstance(instance, articles_models.ArticlePage):
+        return chain(
+            get_affected_projects(instance),
+            # 'In the series' blocks and the series page itself
+            articles_models.SeriesPage.objects.live().filter(related_article_links__article=instance),
+            articles_models.ArticlePage.objects.live().filter(series_links__series__related_article_links__article=instance),
+            # 'Most recent posts' on the contributor pages
+            ContributorPage.objects.live().filter(article_links__article=instance),
+            # Responses link back and forth
+            articles_models.ArticlePage.objects.live().filter(response_links__response=instance),
+            articles_models.ArticlePage.objects.live().filter(response_to_links__response_to=instance),
         )
 
+    if isinstance(instance, articles_models.SeriesPage):
+        return chain(
+            get_affected_projects(instance),
+            articles_models.ArticlePage.objects.live().filter(series_links__series=instance),
+        )
 
-def purge_related(instance):
-    global invalidation_map
-    instance_model = instance.__class__
-    if instance_model not in invalidation_map:
+    if isinstance(instance, ContributorPage):
+        return articles_models.ArticlePage.objects.live().filter(author_links__author=instance)
+
+    return []
+
+
+def get_purged_pages(instance):
+    """
+    Return the pages to purge for a page that was published, unpublished or deleted: itself, the pages
+    depending on it and the index pages listing it, without duplicates.
+    """
+    instance = instance.specific
+    pages = [instance]
+    pages.extend(get_dependent_pages(instance))
+    for related_page_model in invalidation_map.get(instance.__class__, []):
+        pages.extend(related_page_model.objects.live())
+
+    purged = []
+    seen_pages = set()
+    for page in pages:
+        if page.pk not in seen_pages:
+            seen_pages.add(page.pk)
+            purged.append(page)
+    return purged
+
+
+def get_purge_urls(instance, pages=None):
+    """
+    Plan the purge for a page that was published, unpublished or deleted: its own URLs, the URLs of the
+    pages depending on it, those of the index pages listing it and the feed and sitemap, without
+    duplicates. `pages` are its get_purged_pages(), if already known.
+    """
+    instance = instance.specific
+    topics = get_affected_topics(instance)
+    if pages is None:
+        pages = get_purged_pages(instance)
+
+    urls = []
+    seen_urls = set()
+    for page in pages:
+        if isinstance(page, articles_models.TopicListPage) and topics is not None:
+            # Only the topics listing the instance have changed
+            page_urls = get_page_urls(page, topics=topics)
+        else:
+            page_urls = get_page_urls(page)
+
+        for url in page_urls:
+            if url not in seen_urls:
+                seen_urls.add(url)
+                urls.append(url)
+
+    for url in get_site_urls(instance):
+        if url not in seen_urls:
+            seen_urls.add(url)
+            urls.append(url)
+
+    return urls
+
+
+def purge_page(instance):
+    purge_pages([instance])
+
+
+def purge_pages(instances):
+    """
+    Purge the union of the URLs affected by each of the pages.
+    """
+    urls = []
+    seen_urls = set()
+    listing_tags = set()
+    contributor_ids = []
+    for instance in instances:
+        pages = get_purged_pages(instance)
+        for url in get_purge_urls(instance, pages):
+            if url not in seen_urls:
+                seen_urls.add(url)
+                urls.append(url)
+
+        # Their pages reached through cursors are not among their cached paths
+        listing_tags.update(get_listing_tag(page) for page in pages if getattr(page, 'keyset_field', None))
+
+        if isinstance(instance.specific, ContributorPage):
+            contributor_ids.append(instance.pk)
+
+    if urls:
+        logger.info('Queueing {} URLs for purging for {} pages'.format(len(urls), len(instances)))
+        purge_urls(urls)
+
+    if listing_tags:
+        purge_tags(sorted(listing_tags))
+
+    if contributor_ids:
+        # Their name and picture appear on every page listing their articles
+        purge_tags(get_purge_tags('contributor', contributor_ids))
+
+
+def purge_urls(urls):
+    """
+    Purge the URLs from the page cache, then from Cloudflare, once the transaction commits.
+    """
+    # The origin cache first, so that the CDN refetches fresh pages
+    transaction.on_commit(lambda: page_cache.invalidate_urls(urls))
+    get_purge_coalescer().add(urls)
+
+
+def purge_tags(tags):
+    """
+    Purge every response tagged with any of the tags, see core/cache_tags.py.
+    """
+    transaction.on_commit(lambda: page_cache.invalidate_tags(tags))
+
+    logger.info('Queueing tags {} for purging'.format(', '.join(tags)))
+    get_tag_purge_coalescer().add(tags)
+
+
+@receiver(pre_save)
+def page_listing_handler(sender, instance, raw=False, update_fields=None, **kwargs):
+    '''
+    Remember the topics and project listing an article or series before a publish saves the page
+    and its links, for the purge to include the topic and project pages it leaves. Saves of some
+    fields, like those of drafts, don't change them.
+    '''
+    if raw or update_fields is not None or sender not in articles_models.FEED_MODELS or instance.pk is None:
         return
-    for related_page_model in invalidation_map[instance_model]:
-        for page in related_page_model.objects.live():
-            print("Purging {}".format(page))
-            purge_page_from_cache(page)
+
+    instance._listed_topic_ids = set(articles_models.FeedEntry.topics.through.objects.filter(
+        feedentry_id=instance.pk).values_list('topic_id', flat=True))
+    instance._listed_project_id = sender.objects.filter(pk=instance.pk).values_list('project_id', flat=True).first()
 
 
 @receiver(page_published)
 def page_published_handler(instance, **kwargs):
-    cloudflare_purge_all()
-    # purge_related(instance)
+    if not defer(purge_pages, instance):
+        purge_page(instance)
+
+
+@receiver(page_unpublished)
+def page_unpublished_handler(instance, **kwargs):
+    if not defer(purge_pages, instance):
+        purge_page(instance)
 
 
 @receiver(pre_delete)
 def page_deleted_handler(instance, **kwargs):
-    cloudflare_purge_all()
-    # purge_related(instance)
+    if not isinstance(instance, Page):
+        return
+
+    # Deleting a page sends pre_delete for the base Page row as well as the specific one; only handle the latter
+    if type(instance) is not instance.specific_class:
+        return
+
+    purge_page(instance)
+
+
+@receiver(post_save, sender=articles_models.Topic)
+@receiver(post_delete, sender=articles_models.Topic)
+def topic_changed_handler(instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    purge_tags(get_purge_tags('topic', [instance.pk]))
+
+
+@receiver(post_save, sender=Theme)
+@receiver(post_delete, sender=Theme)
+def theme_changed_handler(instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    purge_tags(get_purge_tags('theme', [instance.pk]))
+
+
+@receiver(post_save, sender=ThemeContent)
+def theme_content_changed_handler(instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    theme_ids = list(Theme.objects.filter(content=instance).values_list('pk', flat=True))
+    if theme_ids:
+        purge_tags(get_purge_tags('theme', theme_ids))
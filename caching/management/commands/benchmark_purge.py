@@ -0,0 +1,152 @@
+from __future__ import absolute_import, unicode_literals
+
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from articles.models import (ArticleCategory, ArticleListPage, ArticlePage,
+                             FeatureStyle)
+from caching import coalescer, invalidate
+from caching.fake_cloudflare import fake_cloudflare
+
+
+class ImmediatePurger(object):
+    '''
+    Sends the URLs of every publish straight away, one request per chunk.
+    '''
+    def add(self, urls):
+        invalidate.cloudflare_purge_urls(list(urls))
+
+    def flush(self):
+        pass
+
+
+class PurgeAllPurger(object):
+    '''
+    Purges the whole zone on every publish.
+    '''
+    def add(self, urls):
+        invalidate.cloudflare_purge_all()
+
+    def flush(self):
+        pass
+
+
+class Command(BaseCommand):
+    help = 'Publish synthetic articles against a local stand-in for the Cloudflare API and report the purges it received'
+
+    strategies = ('coalesced', 'immediate', 'purge-all')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n',
+            '--pages',
+            action='store',
+            type=int,
+            dest='pages',
+            default=20,
+            help='The number of synthetic articles to publish'
+        )
+        parser.add_argument(
+            '--strategy',
+            action='store',
+            dest='strategy',
+            choices=self.strategies,
+            default='coalesced',
+            help='How purges are sent: coalesced (default), immediate or purge-all'
+        )
+        parser.add_argument(
+            '--latency',
+            action='store',
+            type=float,
+            dest='latency',
+            default=0.05,
+            help='Seconds the fake API takes to answer each request'
+        )
+        parser.add_argument(
+            '--error-rate',
+            action='store',
+            type=float,
+            dest='error_rate',
+            default=0,
+            help='Fraction of requests the fake API fails with a 500'
+        )
+        parser.add_argument(
+            '--rate-limit',
+            action='store',
+            type=int,
+            dest='rate_limit',
+            default=None,
+            help='Requests per second the fake API accepts before answering with a 429'
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            dest='keep',
+            default=False,
+            help='Keep the synthetic articles instead of deleting them afterwards'
+        )
+
+    def handle(self, *args, **options):
+        parent = ArticleListPage.objects.live().first()
+        if parent is None:
+            raise CommandError('A live ArticleListPage is needed to publish the synthetic articles under.')
+
+        if options['strategy'] == 'immediate':
+            purger = ImmediatePurger()
+        elif options['strategy'] == 'purge-all':
+            purger = PurgeAllPurger()
+        else:
+            # Only flushed explicitly, so that the whole run is measured
+            purger = coalescer.PurgeCoalescer(invalidate.cloudflare_purge_chunk, window=3600)
+
+        server_options = dict(
+            port=0,
+            latency=options['latency'],
+            error_rate=options['error_rate'],
+            rate_limit=options['rate_limit'],
+        )
+
+        original_purger = coalescer._purge_coalescer
+        coalescer._purge_coalescer = purger
+        pages = []
+        try:
+            with fake_cloudflare(**server_options) as server:
+                run_id = uuid.uuid4().hex[:8]
+                category = ArticleCategory.objects.order_by('id').first()
+                feature_style = FeatureStyle.objects.order_by('id').first()
+
+                start = time.time()
+                for number in range(options['pages']):
+                    page = parent.add_child(instance=ArticlePage(
+                        title='Purge benchmark {} #{}'.format(run_id, number),
+                        slug='purge-benchmark-{}-{}'.format(run_id, number),
+                        theme=parent.theme,
+                        category=category,
+                        feature_style=feature_style,
+                        live=False,
+                    ))
+                    page.save_revision().publish()
+                    pages.append(page)
+                published = time.time()
+                purger.flush()
+                elapsed = time.time() - start
+
+                purged_urls = server.purged_urls
+                self.stdout.write('Strategy:           {}'.format(options['strategy']))
+                self.stdout.write('Pages published:    {}'.format(len(pages)))
+                self.stdout.write('Purge calls:        {}'.format(len(server.requests)))
+                self.stdout.write('  failed:           {}'.format(
+                    len([request for request in server.requests if request['status'] != 200])))
+                self.stdout.write('  purge everything: {}'.format(server.purge_everything_count))
+                self.stdout.write('URLs purged:        {} ({} unique)'.format(len(purged_urls), len(set(purged_urls))))
+                self.stdout.write('Publishing:         {:.3f}s'.format(published - start))
+                self.stdout.write('Wall time:          {:.3f}s'.format(elapsed))
+
+                if not options['keep']:
+                    for page in pages:
+                        page.delete()
+                    purger.flush()
+        finally:
+            coalescer._purge_coalescer = original_purger
@@ -0,0 +1,66 @@
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from caching.export import StaticExporter
+
+
+class Command(BaseCommand):
+    help = 'Render every public URL of the site to a tree of static files, with precompressed variants'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'output',
+            help='The directory to export to'
+        )
+        parser.add_argument(
+            '-w',
+            '--workers',
+            action='store',
+            type=int,
+            dest='workers',
+            default=4,
+            help='The number of URLs rendered at the same time'
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            dest='incremental',
+            default=False,
+            help='Only render the URLs whose content changed since the last export to the directory'
+        )
+        parser.add_argument(
+            '--no-compress',
+            action='store_false',
+            dest='compress',
+            default=True,
+            help='Do not write gzip and brotli variants of the files'
+        )
+
+    def handle(self, *args, **options):
+        exporter = StaticExporter(options['output'], workers=options['workers'], compress=options['compress'])
+
+        start = time.time()
+        rendered = skipped = 0
+        failed = []
+        for result in exporter.export(incremental=options['incremental']):
+            if result.skipped:
+                skipped += 1
+                continue
+
+            if result.status == 200:
+                rendered += 1
+                if options['verbosity'] > 1:
+                    self.stdout.write('{:>8.3f}s {} -> {}'.format(result.elapsed, result.url, result.path))
+            else:
+                failed.append(result)
+
+        self.stdout.write('Rendered:  {}'.format(rendered))
+        self.stdout.write('Unchanged: {}'.format(skipped))
+        self.stdout.write('Failed:    {}'.format(len(failed)))
+        self.stdout.write('Wall time: {:.3f}s'.format(time.time() - start))
+
+        for result in failed:
+            self.stderr.write('Failed: {} ({})'.format(result.url, result.error or result.status))
@@ -0,0 +1,94 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from wagtail.wagtailcore.models import Page
+
+from caching.invalidate import get_purge_urls
+from caching.warmer import CacheWarmer, get_all_urls
+
+
+class Command(BaseCommand):
+    help = 'Request the URLs of the site, most viewed first, so that they are cached before visitors ask for them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-p',
+            '--page',
+            action='append',
+            type=int,
+            dest='pages',
+            default=[],
+            help='Only warm the URLs purged when this page is published. Can be given more than once'
+        )
+        parser.add_argument(
+            '-u',
+            '--url',
+            action='append',
+            dest='urls',
+            default=[],
+            help='Warm this URL. Can be given more than once'
+        )
+        parser.add_argument(
+            '-w',
+            '--workers',
+            action='store',
+            type=int,
+            dest='workers',
+            default=None,
+            help='The number of URLs requested at the same time, CACHING_WARM_WORKERS by default'
+        )
+        parser.add_argument(
+            '--origin',
+            action='store',
+            dest='origin',
+            default=None,
+            help='Send the requests to this server, e.g. http://127.0.0.1:8000, instead of the public URL'
+        )
+        parser.add_argument(
+            '--slowest',
+            action='store',
+            type=int,
+            dest='slowest',
+            default=10,
+            help='The number of slowest URLs to list in the summary'
+        )
+
+    def handle(self, *args, **options):
+        urls = list(options['urls'])
+        for pk in options['pages']:
+            try:
+                page = Page.objects.get(pk=pk)
+            except Page.DoesNotExist:
+                raise CommandError('There is no page with the id {}.'.format(pk))
+            urls.extend(get_purge_urls(page))
+
+        if not options['urls'] and not options['pages']:
+            urls = get_all_urls()
+
+        urls = list(set(urls))
+        self.stdout.write('Warming {} URLs'.format(len(urls)))
+
+        warmer = CacheWarmer(workers=options['workers'], origin=options['origin'])
+        results = []
+        for result in warmer.warm(urls):
+            results.append(result)
+            self.stdout.write('{:>4} {:>8.3f}s {:>5} {}'.format(
+                result.status or 'ERR', result.elapsed, result.cache or '-', result.url))
+
+        if not results:
+            return
+
+        failed = [result for result in results if result.error is not None or result.status >= 400]
+        elapsed = sorted(result.elapsed for result in results)
+        self.stdout.write('')
+        self.stdout.write('URLs warmed:  {} ({} failed)'.format(len(results), len(failed)))
+        self.stdout.write('Render time:  {:.3f}s total, {:.3f}s median, {:.3f}s max'.format(
+            sum(elapsed), elapsed[len(elapsed) // 2], elapsed[-1]))
+
+        if options['slowest']:
+            self.stdout.write('Slowest:')
+            for result in sorted(results, key=lambda result: -result.elapsed)[:options['slowest']]:
+                self.stdout.write('  {:>8.3f}s {}'.format(result.elapsed, result.url))
+
+        for result in failed:
+            self.stderr.write('Failed: {} ({})'.format(result.url, result.error or result.status))
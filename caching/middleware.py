@@ -0,0 +1,14 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.utils.deprecation import MiddlewareMixin
+
+from . import page_cache
+
+
+class PageCacheMiddleware(MiddlewareMixin):
+    '''
+    Stores the responses of pages that were not served from the page cache, see page_cache.py.
+    List it first so that it sees the response after every other middleware.
+    '''
+    def process_response(self, request, response):
+        return page_cache.store_response(request, response)
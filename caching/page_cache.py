@@ -0,0 +1,192 @@
+'''
+Origin-side cache of full page responses for anonymous visitors.
+
+Responses are looked up before Wagtail serves a page (see wagtail_hooks.py) and stored on the way
+out by PageCacheMiddleware. Entries are keyed by host, path, query string and theme, and stored
+zlib-compressed in the CACHING_PAGE_CACHE_ALIAS cache (Redis in production).
+
+Publishing, unpublishing or deleting a page bumps a version for each path it affects, and purging
+a cache tag a version for the tag (see invalidate.py). Entries rendered at an older version of
+their path or of one of their tags, or older than CACHING_PAGE_CACHE_TIMEOUT, are stale: one request re-renders the page while the others keep getting the stale copy, for up to
+CACHING_PAGE_CACHE_STALE_TIMEOUT seconds.
+'''
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+from six.moves.urllib.parse import urlparse
+
+# Headers restored on responses served from the cache
+CACHED_HEADERS = ('Content-Type', 'Content-Language', 'ETag', 'Last-Modified', 'Cache-Tag')
+
+
+def is_enabled():
+    return getattr(settings, 'CACHING_PAGE_CACHE_ENABLED', False)
+
+
+def get_cache():
+    return caches[getattr(settings, 'CACHING_PAGE_CACHE_ALIAS', 'default')]
+
+
+def get_timeout():
+    return getattr(settings, 'CACHING_PAGE_CACHE_TIMEOUT', 600)
+
+
+def get_stale_timeout():
+    return getattr(settings, 'CACHING_PAGE_CACHE_STALE_TIMEOUT', 24 * 60 * 60)
+
+
+def _hash(*parts):
+    return hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_version_key(host, path):
+    return 'pagecache:version:{}'.format(_hash(host, path))
+
+
+def get_tag_version_key(tag):
+    return 'pagecache:tag:{}'.format(tag)
+
+
+def get_tag_versions(tags):
+    cache = get_cache()
+    keys = dict((get_tag_version_key(tag), tag) for tag in tags)
+    versions = cache.get_many(list(keys))
+    return dict((tag, versions.get(key, 0)) for key, tag in keys.items())
+
+
+def get_response_key(host, path, query_string, theme_id):
+    return 'pagecache:response:{}'.format(_hash(host, path, query_string, str(theme_id or '')))
+
+
+def is_cacheable_request(request):
+    if request.method != 'GET' or getattr(request, 'skip_page_cache', False):
+        return False
+
+    if getattr(request, 'is_preview', False):
+        return False
+
+    user = getattr(request, 'user', None)
+    return user is None or not user.is_authenticated
+
+
+def get_version(host, path):
+    return get_cache().get(get_version_key(host, path), 0)
+
+
+def get_response(page, request):
+    '''
+    Return the cached response for the page if there is a usable one. Otherwise, remember on the
+    request where to store the response once it has been rendered, and return None.
+    '''
+    if not is_enabled() or not is_cacheable_request(request):
+        return None
+
+    host = request.get_host()
+    path = request.path
+    cache = get_cache()
+    key = get_response_key(host, path, request.META.get('QUERY_STRING', ''), getattr(page, 'theme_id', None))
+    version = get_version(host, path)
+
+    entry = cache.get(key)
+    if entry is not None:
+        is_current = (
+            entry['version'] == version
+            and time.time() - entry['created'] < get_timeout()
+            and (not entry['tags'] or get_tag_versions(entry['tags']) == entry['tags'])
+        )
+        if is_current:
+            return _build_response(request, entry, 'HIT')
+
+        # Stale: let a single request revalidate while the rest keep being served the stale copy
+        if not cache.add(key + ':lock', 1, 30):
+            return _build_response(request, entry, 'STALE')
+
+    request._page_cache = (key, version)
+    return None
+
+
+def is_cacheable_response(response):
+    if response.status_code != 200 or response.streaming or response.cookies:
+        return False
+
+    cache_control = response.get('Cache-Control', '')
+    return not any(directive in cache_control for directive in ('private', 'no-cache', 'no-store'))
+
+
+def store_response(request, response):
+    '''
+    Store the response if get_response() asked for it and it can be shared between visitors.
+    '''
+    page_cache = getattr(request, '_page_cache', None)
+    if page_cache is None:
+        return response
+
+    key, version = page_cache
+    cache = get_cache()
+
+    if not is_cacheable_response(response):
+        cache.delete(key + ':lock')
+        return response
+
+    tags = [tag for tag in response.get('Cache-Tag', '').split(',') if tag]
+    entry = {
+        'content': zlib.compress(response.content),
+        'status': response.status_code,
+        'headers': [(header, response[header]) for header in CACHED_HEADERS if response.has_header(header)],
+        'version': version,
+        'tags': get_tag_versions(tags) if tags else {},
+        'created': time.time(),
+    }
+    cache.set(key, entry, get_timeout() + get_stale_timeout())
+    cache.delete(key + ':lock')
+
+    response['X-Page-Cache'] = 'MISS'
+    return response
+
+
+def _build_response(request, entry, status):
+    response = HttpResponse(zlib.decompress(entry['content']), status=entry['status'])
+    for header, value in entry['headers']:
+        response[header] = value
+    response['X-Page-Cache'] = status
+
+    # A 304 if the visitor's copy is still current, see ThemeablePage.serve_conditionally()
+    return get_conditional_response(
+        request,
+        etag=response.get('ETag'),
+        last_modified=parse_http_date_safe(response.get('Last-Modified', '')),
+        response=response,
+    )
+
+
+def invalidate_urls(urls):
+    '''
+    Mark the cached responses for the URLs, whatever their query string or theme, as stale.
+    '''
+    cache = get_cache()
+    for path_key in set(get_version_key(url.netloc, url.path) for url in map(urlparse, urls)):
+        try:
+            cache.incr(path_key)
+        except ValueError:
+            # No version yet, so nothing has been cached against it
+            cache.add(path_key, 1, None)
+
+
+def invalidate_tags(tags):
+    '''
+    Mark the cached responses tagged with any of the tags as stale.
+    '''
+    cache = get_cache()
+    for tag in set(tags):
+        try:
+            cache.incr(get_tag_version_key(tag))
+        except ValueError:
+            cache.add(get_tag_version_key(tag), 1, None)
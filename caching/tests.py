@@ -0,0 +1,485 @@
+from __future__ import absolute_import, unicode_literals
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase, override_settings
+
+from analytics.models import Analytics
+from articles.models import ArticleListPage, ArticlePage, SeriesPage
+from articles.references import defer_stream_references
+from core.cache_tags import get_listing_tag
+from core.models import HomePage
+from projects.models import ProjectListPage, ProjectPage
+from themes.models import Theme
+
+from . import fragments, page_cache
+from .coalescer import PurgeCoalescer
+from .export import StaticExporter, get_export_path
+from .fake_cloudflare import FakeCloudflareServer
+from .invalidate import (CloudflareClient, get_purge_urls, purge_pages,
+                         purge_urls)
+from .warmer import get_all_urls, get_page_views, prioritise
+
+
+class PurgePlanTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def test_includes_the_page_itself(self):
+        article = ArticlePage.objects.get(pk=107)
+        urls = get_purge_urls(article)
+        self.assertIn(article.full_url, urls)
+
+    def test_includes_the_index_pages(self):
+        article = ArticlePage.objects.get(pk=107)
+        urls = get_purge_urls(article)
+        self.assertTrue(any(url.endswith('/features/') for url in urls))
+
+    def test_includes_only_the_topics_of_the_page(self):
+        article = ArticlePage.objects.get(slug="test-article-3")
+        urls = get_purge_urls(article)
+        topic_urls = [url for url in urls if '/topics/' in url and not url.endswith('/topics/')]
+        self.assertEqual(len(topic_urls), 1)
+        self.assertIn(article.primary_topic.slug, topic_urls[0])
+
+    def test_includes_the_series_of_the_page(self):
+        article = ArticlePage.objects.get(pk=107)
+        series = SeriesPage.objects.get(pk=110)
+        self.assertIn(series.full_url, get_purge_urls(article))
+
+    def test_has_no_duplicates(self):
+        article = ArticlePage.objects.get(pk=107)
+        urls = get_purge_urls(article)
+        self.assertEqual(len(urls), len(set(urls)))
+
+    def test_includes_the_feed_and_the_sitemap(self):
+        urls = get_purge_urls(ArticlePage.objects.get(pk=107))
+        self.assertTrue(any(url.endswith('/feed/') for url in urls))
+        self.assertTrue(any(url.endswith('/sitemap.xml') for url in urls))
+
+    def test_includes_the_topics_the_page_left(self):
+        article = ArticlePage.objects.get(slug="test-article-3")
+        topic = article.primary_topic
+        article.primary_topic = None
+        article.topic_links = []
+        article.save()
+
+        urls = get_purge_urls(article)
+        self.assertTrue(any(url.endswith('/{}/'.format(topic.slug)) for url in urls))
+
+    def test_includes_the_projects_listing_the_page(self):
+        home = HomePage.objects.first()
+        project_list = home.add_child(instance=ProjectListPage(title="Projects"))
+        project = project_list.add_child(instance=ProjectPage(title="A Project"))
+        self.assertIn(project_list.full_url, get_purge_urls(project))
+
+        article = ArticlePage.objects.get(pk=107)
+        article.project = project
+        article.save()
+        self.assertIn(project.full_url, get_purge_urls(article))
+
+        # And once it is taken out of it
+        article.project = None
+        article.save()
+        self.assertIn(project.full_url, get_purge_urls(article))
+
+    def test_purges_the_cursor_pages_of_the_index_pages(self):
+        features = ArticleListPage.objects.get(slug='features')
+        with mock.patch('caching.invalidate.purge_urls'), mock.patch('caching.invalidate.purge_tags') as purge_tags:
+            purge_pages([ArticlePage.objects.get(pk=107)])
+        self.assertIn(get_listing_tag(features), purge_tags.call_args[0][0])
+
+
+class PurgeCoalescerTestCase(TestCase):
+    def setUp(self):
+        self.sent = []
+        self.coalescer = PurgeCoalescer(self.sent.append, window=3600, workers=1)
+
+    def test_flush_removes_duplicates(self):
+        self.coalescer._queue(['/a/', '/b/'], 3600)
+        self.coalescer._queue(['/b/', '/c/'], 3600)
+        self.coalescer.flush()
+        self.assertEqual(self.sent, [['/a/', '/b/', '/c/']])
+
+    def test_flush_sends_in_chunks_of_30(self):
+        self.coalescer._queue(['/{}/'.format(i) for i in range(70)], 3600)
+        self.coalescer.flush()
+        self.assertEqual([len(chunk) for chunk in self.sent], [30, 30, 10])
+
+    def test_flush_calls_on_flush_with_all_the_urls(self):
+        flushed = []
+        self.coalescer.on_flush = flushed.append
+        self.coalescer._queue(['/{}/'.format(i) for i in range(40)], 3600)
+        self.coalescer.flush()
+        self.assertEqual(flushed, [['/{}/'.format(i) for i in range(40)]])
+
+    def test_flush_at_exit_skips_on_flush(self):
+        self.coalescer.on_flush = mock.Mock()
+        self.coalescer._queue(['/a/'], 3600)
+        self.coalescer.flush(notify=False)
+        self.assertEqual(self.sent, [['/a/']])
+        self.assertFalse(self.coalescer.on_flush.called)
+
+    def test_background_flush_closes_its_connection(self):
+        self.coalescer._queue(['/a/'], 3600)
+        with mock.patch('caching.coalescer.connection') as connection:
+            self.coalescer._flush_in_background()
+        self.assertEqual(self.sent, [['/a/']])
+        self.assertTrue(connection.close.called)
+
+    def test_add_waits_for_the_transaction_to_commit(self):
+        # Test cases run inside a transaction that is never committed
+        self.coalescer.add(['/a/'])
+        self.assertEqual(self.coalescer.pending, [])
+
+
+class CloudflareClientTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeCloudflareServer(retry_after=0).start()
+        self.client = CloudflareClient({
+            'EMAIL': 'test@example.com',
+            'TOKEN': 'test',
+            'ZONEID': 'zone',
+            'API_URL': self.server.url,
+        }, backoff_factor=0.01, failure_threshold=2)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_purge_files(self):
+        self.client.purge_files(['http://localhost/a/', 'http://localhost/b/'])
+        self.assertEqual(self.server.purged_urls, ['http://localhost/a/', 'http://localhost/b/'])
+        self.assertEqual(self.server.requests[0]['zone'], 'zone')
+
+    def test_purge_tags(self):
+        self.client.purge_tags(['topic-1', 'topics'])
+        self.assertEqual(self.server.purged_tags, ['topic-1', 'topics'])
+
+    def test_purge_everything(self):
+        self.client.purge_everything()
+        self.assertEqual(self.server.purge_everything_count, 1)
+
+    def test_retries_when_rate_limited(self):
+        self.server.rate_limit = 1
+        self.server.rate_limit_period = 0.05
+        self.client.purge_files(['http://localhost/a/'])
+        self.client.purge_files(['http://localhost/b/'])
+
+        self.assertEqual(self.server.purged_urls, ['http://localhost/a/', 'http://localhost/b/'])
+        self.assertIn(429, [request['status'] for request in self.server.requests])
+
+    def test_queues_purges_while_the_api_is_down(self):
+        self.server.error_rate = 1
+        self.client.purge_files(['http://localhost/a/'])
+        self.client.purge_files(['http://localhost/b/'])
+        requests_made = len(self.server.requests)
+
+        self.client.purge_files(['http://localhost/c/'])
+        self.assertEqual(len(self.server.requests), requests_made)
+        self.assertEqual(self.client.queued, (False, ['http://localhost/a/', 'http://localhost/b/', 'http://localhost/c/']))
+
+    def test_replays_queued_purges_once_the_api_is_back(self):
+        self.server.error_rate = 1
+        self.client.purge_files(['http://localhost/a/'])
+        self.client.purge_files(['http://localhost/b/'])
+
+        self.server.error_rate = 0
+        self.client.recovery_time = 0
+        self.client.purge_files(['http://localhost/c/'])
+
+        purged_urls = self.server.purged_urls
+        self.assertEqual(sorted(purged_urls), ['http://localhost/a/', 'http://localhost/b/', 'http://localhost/c/'])
+        self.assertEqual(self.client.queued, (False, []))
+
+
+@override_settings(
+    ALLOWED_HOSTS=['localhost'],
+    CACHING_PAGE_CACHE_ENABLED=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'page-cache-tests'}},
+    MIDDLEWARE_CLASSES=('caching.middleware.PageCacheMiddleware',) + settings.MIDDLEWARE_CLASSES,
+)
+class PageCacheTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def setUp(self):
+        page_cache.get_cache().clear()
+        self.page = ArticleListPage.objects.get(slug='features')
+
+    def get(self, url=None):
+        return self.client.get(url or self.page.url, HTTP_HOST='localhost')
+
+    def test_stores_then_serves_from_the_cache(self):
+        self.assertEqual(self.get()['X-Page-Cache'], 'MISS')
+        response = self.get()
+        self.assertEqual(response['X-Page-Cache'], 'HIT')
+        self.assertEqual(response.status_code, 200)
+
+    def test_query_strings_are_cached_separately(self):
+        self.get()
+        self.assertEqual(self.get(self.page.url + '?a=1')['X-Page-Cache'], 'MISS')
+
+    def test_theme_is_part_of_the_key(self):
+        self.get()
+        self.page.theme_id = None
+        request = RequestFactory().get(self.page.url, HTTP_HOST='localhost')
+        request.user = AnonymousUser()
+        self.assertIsNone(page_cache.get_response(self.page, request))
+
+    def test_skips_logged_in_users(self):
+        self.client.force_login(get_user_model().objects.create_user('editor', 'editor@example.com', 'password'))
+        self.assertFalse(self.get().has_header('X-Page-Cache'))
+
+    def test_purging_a_tag_makes_the_tagged_responses_stale(self):
+        response = self.get()
+        self.assertIn('page-{}'.format(self.page.pk), response['Cache-Tag'].split(','))
+
+        page_cache.invalidate_tags(['page-{}'.format(self.page.pk)])
+        self.assertEqual(self.get()['X-Page-Cache'], 'MISS')
+        self.assertEqual(self.get()['X-Page-Cache'], 'HIT')
+
+    def test_purged_urls_are_stale_before_cloudflare_is_asked(self):
+        self.get()
+        with mock.patch('caching.invalidate.transaction.on_commit', side_effect=lambda func: func()), \
+                mock.patch('caching.invalidate.get_purge_coalescer') as get_purge_coalescer:
+            purge_urls([self.page.full_url])
+        get_purge_coalescer.return_value.add.assert_called_once_with([self.page.full_url])
+        self.assertNotEqual(self.get()['X-Page-Cache'], 'HIT')
+
+    def test_serves_stale_while_revalidating(self):
+        self.get()
+        page_cache.invalidate_urls([self.page.full_url])
+
+        # The first request after the invalidation re-renders, the ones arriving meanwhile get the stale copy
+        request = RequestFactory().get(self.page.url, HTTP_HOST='localhost')
+        request.user = AnonymousUser()
+        self.assertIsNone(page_cache.get_response(self.page, request))
+        self.assertEqual(self.get()['X-Page-Cache'], 'STALE')
+
+        page_cache.store_response(request, self.get())
+        self.assertEqual(self.get()['X-Page-Cache'], 'HIT')
+
+
+@override_settings(
+    CACHING_FRAGMENT_CACHE_ENABLED=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'fragment-cache-tests'}},
+)
+class FragmentCacheTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    template = Template('{% load article_tags %}{% for block in page.body %}{% include_cached_block block %}{% endfor %}')
+
+    def setUp(self):
+        fragments.get_cache().clear()
+        fragments.get_lru().clear()
+        self.page = ArticlePage.objects.get(pk=107)
+        self.page.live_revision_id = 1
+        self.set_body('Before')
+
+    def set_body(self, text, block_id='heading'):
+        self.page.body = json.dumps([{'type': 'Heading', 'value': {'text': text, 'heading_level': 2}, 'id': block_id}])
+
+    def render(self, **context):
+        context.setdefault('page', self.page)
+        return self.template.render(Context(context)).replace('\n', '')
+
+    def test_blocks_are_served_from_the_cache(self):
+        self.assertEqual(self.render(), '<h2>Before</h2>')
+        self.set_body('After')
+        self.assertEqual(self.render(), '<h2>Before</h2>')
+
+        # From the shared cache once out of the LRU
+        fragments.get_lru().clear()
+        self.assertEqual(self.render(), '<h2>Before</h2>')
+
+    def test_blocks_without_an_id_are_keyed_by_position(self):
+        self.page.body = [('Heading', {'text': 'First', 'heading_level': 2}),
+                          ('Heading', {'text': 'Second', 'heading_level': 3})]
+        self.assertEqual(self.render(), '<h2>First</h2><h3>Second</h3>')
+
+    def test_publishing_renders_blocks_afresh(self):
+        self.render()
+        self.set_body('After')
+        self.page.live_revision_id = 2
+        self.assertEqual(self.render(), '<h2>After</h2>')
+
+    def test_theme_is_part_of_the_key(self):
+        self.render()
+        self.set_body('After')
+        self.assertEqual(self.render(theme=Theme(pk=1, folder='themes/default')), '<h2>After</h2>')
+
+    def test_blocks_without_an_id_outside_the_page_streams_are_not_cached(self):
+        template = Template(
+            '{% load article_tags %}{% for block in page.body %}{% include_cached_block block %}{% endfor %}'
+            '{% for chapter in page.chapters %}{% for block in chapter.value.body %}'
+            '{% include_cached_block block %}{% endfor %}{% endfor %}'
+        )
+        self.page.body = [('Heading', {'text': 'Body', 'heading_level': 2})]
+        self.page.chapters = json.dumps([{'type': 'chapter', 'value': {'heading': 'A Chapter', 'body': [
+            {'type': 'Heading', 'value': {'text': 'Chapter', 'heading_level': 2}},
+        ]}}])
+        self.assertEqual(template.render(Context({'page': self.page})).replace('\n', ''), '<h2>Body</h2><h2>Chapter</h2>')
+
+    def test_stream_field_is_part_of_the_key(self):
+        block = self.page.body[0]
+        key = fragments.get_fragment_key(Context({'page': self.page}), block)
+        self.page.chapters = self.page.body
+        self.page.body = []
+        self.assertNotEqual(fragments.get_fragment_key(Context({'page': self.page}), block), key)
+
+    def test_changing_what_a_block_links_to_renders_it_afresh(self):
+        def set_text(text):
+            self.page.body = json.dumps([{'type': 'Paragraph', 'id': 'paragraph', 'value': {
+                'text': '<p>{} <a linktype="page" id="108">link</a></p>'.format(text),
+                'use_dropcap': False,
+            }}])
+
+        set_text('Before')
+        self.assertIn('Before', self.render())
+        set_text('After')
+        self.assertIn('Before', self.render())
+
+        ArticlePage.objects.get(pk=108).save()
+        self.assertIn('After', self.render())
+
+    def test_blocks_served_from_the_cache_load_nothing_they_refer_to(self):
+        def defer_body():
+            self.page.body = json.dumps([{'type': 'Image', 'value': {'image': 1, 'placement': 'full'}, 'id': 'image'}])
+            defer_stream_references([self.page], ['body'])
+
+        defer_body()
+        html = self.render()
+        self.assertTrue(self.page.body.resolved)
+
+        defer_body()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render(), html)
+        self.assertIsNone(self.page.body.resolved)
+
+    def test_blocks_opting_out_are_not_cached(self):
+        self.page.body = json.dumps([{'type': 'RelatedItems', 'value': {'heading': 'Before', 'items': []}, 'id': 'related'}])
+        self.assertIn('Before', self.render())
+        self.page.body = json.dumps([{'type': 'RelatedItems', 'value': {'heading': 'After', 'items': []}, 'id': 'related'}])
+        self.assertIn('After', self.render())
+
+        # Nor are the blocks holding one, unlike those which only could
+        block = ArticlePage._meta.get_field('chapters').stream_block.child_blocks['chapter']
+        self.assertTrue(fragments.is_cacheable(block, {'heading': 'A Chapter', 'body': []}))
+        self.assertFalse(fragments.is_cacheable(block, {'heading': 'A Chapter', 'body': [
+            {'type': 'RelatedItems', 'value': {'heading': 'Related', 'items': []}},
+        ]}))
+
+    def test_skips_previews(self):
+        self.render()
+        self.set_body('After')
+        request = RequestFactory().get('/')
+        request.is_preview = True
+        self.assertEqual(self.render(request=request), '<h2>After</h2>')
+
+    @override_settings(CACHING_FRAGMENT_CACHE_ENABLED=False)
+    def test_off_unless_enabled(self):
+        self.render()
+        self.set_body('After')
+        self.assertEqual(self.render(), '<h2>After</h2>')
+
+
+class CacheWarmerTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def test_all_urls_include_the_topic_pages(self):
+        urls = get_all_urls()
+        self.assertIn('http://localhost/topics/topic-1/', urls)
+        self.assertEqual(len(urls), len(set(urls)))
+
+    def test_prioritise_puts_the_most_viewed_first(self):
+        article = ArticlePage.objects.get(pk=107)
+        Analytics.objects.create(page=article, last_period_views=10)
+
+        urls = ['http://localhost/', 'http://localhost/features/?page=2', article.full_url,
+                'http://localhost/features/']
+        self.assertEqual(prioritise(urls, {'/features/': 5, article.url: 10}), [
+            article.full_url,
+            'http://localhost/features/',
+            'http://localhost/features/?page=2',
+            'http://localhost/',
+        ])
+        self.assertEqual(prioritise(urls)[0], article.full_url)
+
+    def test_page_views_are_only_looked_up_for_the_urls(self):
+        articles = ArticlePage.objects.filter(pk__in=[107, 108]).order_by('pk')
+        for views, article in enumerate(articles, 1):
+            Analytics.objects.create(page=article, last_period_views=views)
+
+        self.assertEqual(get_page_views([articles[1].full_url, 'http://localhost/features/?page=2']),
+                         {articles[1].url: 2})
+        self.assertEqual(get_page_views(), {articles[0].url: 1, articles[1].url: 2})
+
+
+@override_settings(ALLOWED_HOSTS=['localhost'])
+class StaticExportTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.exporter = StaticExporter(self.root, workers=1)
+        self.urls = [('http://localhost/', 'a'), ('http://localhost/features/', 'b'), ('http://localhost/feed/', 'c')]
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_export_path(self):
+        self.assertEqual(get_export_path('http://localhost/features/', 'text/html; charset=utf-8'),
+                         os.path.join('localhost', 'features', 'index.html'))
+        self.assertEqual(get_export_path('http://localhost/features/?page=2', 'text/html'),
+                         os.path.join('localhost', 'features', 'index-page-2.html'))
+        self.assertEqual(get_export_path('http://localhost/feed/', 'application/rss+xml; charset=utf-8'),
+                         os.path.join('localhost', 'feed', 'index.xml'))
+        self.assertEqual(get_export_path('http://localhost/sitemap.xml', 'application/xml'),
+                         os.path.join('localhost', 'sitemap.xml'))
+
+    def test_writes_the_pages_and_their_compressed_variants(self):
+        results = list(self.exporter.export(self.urls))
+        self.assertEqual([result.status for result in results], [200, 200, 200])
+
+        path = os.path.join(self.root, 'localhost', 'features', 'index.html')
+        with open(path, 'rb') as f, gzip.open(path + '.gz', 'rb') as compressed:
+            self.assertEqual(f.read(), compressed.read())
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'localhost', 'feed', 'index.xml')))
+
+    @override_settings(CACHING_PAGE_CACHE_ENABLED=True)
+    def test_renders_around_the_page_cache(self):
+        with mock.patch.object(page_cache, 'get_cache', side_effect=AssertionError):
+            results = list(self.exporter.export(self.urls))
+        self.assertEqual([result.status for result in results], [200, 200, 200])
+
+    def test_incremental_export_only_renders_what_changed(self):
+        list(self.exporter.export(self.urls))
+
+        self.urls[1] = ('http://localhost/features/', 'changed')
+        results = list(self.exporter.export(self.urls, incremental=True))
+        self.assertEqual([result.url for result in results if not result.skipped], ['http://localhost/features/'])
+
+    def test_pagers_link_to_the_files_of_the_pages(self):
+        features = ArticleListPage.objects.get(slug='features')
+        features.articles_per_page = 2
+        features.save()
+        urls = [('http://localhost/features/', 'a'), ('http://localhost/features/?page=2', 'b')]
+        list(self.exporter.export(urls))
+
+        with open(os.path.join(self.root, 'localhost', 'features', 'index-page-2.html'), 'rb') as f:
+            content = f.read()
+        self.assertIn(b'href="/features/"', content)
+        self.assertIn(b'href="/features/index-page-3.html"', content)
+        self.assertNotIn(b'?page=', content)
+
+    def test_removes_urls_no_longer_exported(self):
+        list(self.exporter.export(self.urls))
+        list(self.exporter.export(self.urls[:2]))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'localhost', 'feed', 'index.xml')))
@@ -5,6 +5,7 @@ from django.shortcuts import redirect, render
 from wagtail.wagtailadmin.menu import MenuItem
 from wagtail.wagtailcore import hooks
 
+from . import page_cache
 from .invalidate import cloudflare_purge_all
 
 
@@ -30,3 +31,8 @@ def urlconf_time():
 @hooks.register('register_admin_menu_item')
 def register_frank_menu_item():
     return MenuItem('Clear Cache', reverse('admin_clear_cache'), classnames='icon icon-cross', order=10000)
+
+
+@hooks.register('before_serve_page')
+def serve_from_page_cache(page, request, serve_args, serve_kwargs):
+    return page_cache.get_response(page, request)
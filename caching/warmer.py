@@ -0,0 +1,176 @@
+'''
+Re-requests URLs right after they have been purged, so that the first visitor doesn't pay for
+rendering them again.
+
+The URLs are requested most viewed first (see Analytics.last_period_views), a few at a time. With
+CACHING_WARM_ORIGIN set they are sent straight to the origin, with the public host in the Host
+header, instead of through Cloudflare.
+'''
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from six.moves.urllib.parse import urljoin, urlparse, urlunparse
+from wagtail.wagtailcore.models import Page, Site
+
+from analytics.models import Analytics
+
+from .coalescer import chunker
+
+logger = logging.getLogger(__name__)
+
+# Keeps the lookups of the views of many URLs within the limits of the database
+MAX_PATHS_PER_QUERY = 500
+
+WarmResult = namedtuple('WarmResult', ['url', 'status', 'elapsed', 'cache', 'error'])
+
+
+def is_enabled_after_publish():
+    return getattr(settings, 'CACHING_WARM_AFTER_PUBLISH', False)
+
+
+def get_page_views(urls=None):
+    '''
+    Return the views of the pages that have analytics, by URL path, only for the pages at `urls` if
+    given.
+    '''
+    site = Site.objects.filter(is_default_site=True).select_related('root_page').first()
+    if site is None:
+        return {}
+
+    # The URL path of a page is its url_path without the one of the site's root
+    root_path = site.root_page.url_path
+    analytics = Analytics.objects.filter(
+        page__live=True,
+        page__url_path__startswith=root_path,
+        last_period_views__gt=0,
+    ).values_list('page__url_path', 'last_period_views')
+
+    if urls is None:
+        rows = list(analytics)
+    else:
+        url_paths = sorted(set(root_path + urlparse(url).path.lstrip('/') for url in urls))
+        rows = []
+        for chunk in chunker(url_paths, MAX_PATHS_PER_QUERY):
+            rows.extend(analytics.filter(page__url_path__in=chunk))
+
+    return dict(('/' + url_path[len(root_path):], views) for url_path, views in rows)
+
+
+def prioritise(urls, page_views=None):
+    '''
+    Order the URLs by the views of the page they belong to, most viewed first, with the other pages
+    of paginated lists after their first.
+    '''
+    if page_views is None:
+        page_views = get_page_views(urls)
+
+    def priority(url):
+        parsed = urlparse(url)
+        return -page_views.get(parsed.path, 0), bool(parsed.query)
+
+    return sorted(urls, key=priority)
+
+
+def get_sitemap_urls():
+    from sitemap.urls import sitemaps
+
+    root_url = Site.objects.get(is_default_site=True).root_url
+    for sitemap_class in sitemaps.values():
+        sitemap = sitemap_class()
+        for item in sitemap.items():
+            yield urljoin(root_url, sitemap.location(item))
+
+
+def get_all_urls():
+    '''
+    Return every URL the site serves: the paths of every live page, as reported by its
+    get_cached_paths(), and the URLs in the sitemap.
+    '''
+    from .invalidate import get_page_urls
+
+    urls = []
+    seen = set()
+    page_urls = (url for page in Page.objects.live().specific() for url in get_page_urls(page))
+    for url in list(page_urls) + list(get_sitemap_urls()):
+        if url not in seen:
+            seen.add(url)
+            urls.append(url)
+
+    return urls
+
+
+class CacheWarmer(object):
+    '''
+    Requests URLs with at most `workers` requests in flight, and records how long each one took.
+    '''
+    def __init__(self, workers=None, timeout=None, origin=None):
+        if workers is None:
+            workers = getattr(settings, 'CACHING_WARM_WORKERS', 4)
+        if timeout is None:
+            timeout = getattr(settings, 'CACHING_WARM_TIMEOUT', 30)
+        if origin is None:
+            origin = getattr(settings, 'CACHING_WARM_ORIGIN', None)
+        self.workers = workers
+        self.timeout = timeout
+        self.origin = urlparse(origin) if origin else None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def warm(self, urls, page_views=None):
+        '''
+        Request the URLs, most viewed first, and yield a WarmResult for each as they complete.
+        '''
+        urls = prioritise(urls, page_views)
+        if not urls:
+            return
+
+        pool = ThreadPool(min(self.workers, len(urls)))
+        try:
+            for result in pool.imap_unordered(self.fetch, urls):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def fetch(self, url):
+        request_url, headers = url, {}
+        if self.origin is not None:
+            parsed = urlparse(url)
+            request_url = urlunparse(parsed._replace(scheme=self.origin.scheme, netloc=self.origin.netloc))
+            headers['Host'] = parsed.netloc
+
+        start = time.time()
+        try:
+            response = self.session.get(request_url, headers=headers, timeout=self.timeout,
+                                        allow_redirects=False)
+        except requests.RequestException as e:
+            return WarmResult(url, None, time.time() - start, None, e)
+
+        return WarmResult(url, response.status_code, time.time() - start,
+                          response.headers.get('X-Page-Cache'), None)
+
+
+def warm_urls(urls):
+    '''
+    Warm the URLs and log the result, used after a publish (see CACHING_WARM_AFTER_PUBLISH).
+    '''
+    results = list(CacheWarmer().warm(urls))
+    failed = [result for result in results if result.error is not None or result.status >= 400]
+    for result in failed:
+        logger.warning('Unable to warm {}: {}'.format(result.url, result.error or result.status))
+
+    if results:
+        logger.info('Warmed {} URLs in {:.3f}s ({} failed)'.format(
+            len(results), sum(result.elapsed for result in results), len(failed)))
+
+    return results
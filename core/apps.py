@@ -1,9 +1,24 @@
+from collections import OrderedDict
+
 from django.apps import AppConfig
 from django.db.models.signals import post_delete, post_save
 from wagtail.wagtailsearch.backends import get_search_backends
 from wagtail.wagtailsearch.index import get_indexed_instance, get_indexed_models
 from wagtail.wagtailsearch.signal_handlers import post_delete_signal_handler
 
+from core.bulk import defer
+
+
+def update_search_index(instances):
+    # Each instance once, with one request per model
+    models = OrderedDict()
+    for instance in instances:
+        models.setdefault(type(instance), OrderedDict())[instance.pk] = instance
+
+    for model, model_instances in models.items():
+        for backend in get_search_backends(with_auto_update=True):
+            backend.add_bulk(model, list(model_instances.values()))
+
 
 def post_save_signal_handler(instance, **kwargs):
     update_fields = kwargs.get('update_fields')
@@ -16,6 +31,9 @@ def post_save_signal_handler(instance, **kwargs):
     indexed_instance = get_indexed_instance(instance)
 
     if indexed_instance:
+        if defer(update_search_index, indexed_instance):
+            return
+
         for backend in get_search_backends(with_auto_update=True):
             backend.add(indexed_instance)
 
@@ -14,6 +14,10 @@ from django.utils.text import slugify
 
 from six.moves.urllib.parse import urlparse, urlunparse
 
+from .cache_tags import add_cache_tags, add_page_tags, get_listing_tag
+from .pagination import KeysetPaginator, is_cursor
+from .rich_text import prefetch_listing_rich_text
+
 logger = logging.getLogger('OpenCanada.CoreBaseModels')
 
 
@@ -21,11 +25,21 @@ class PaginatedListPageMixin(object):
     '''
     To use this mixing you need to define counter_field_name as the name of the field with
     the items per page and counter_context_name for the template. See jobs/models.py for an example
+
+    Set keyset_field to the field the subpages are ordered on, newest first, to page through them
+    with cursors instead of offsets (see core/pagination.py).
     '''
+    lists_pages = True
+    keyset_field = None
+
     def get_paginator(self, objects=None):
         if objects is None:
             objects = self.subpages
-        return Paginator(objects, getattr(self, self.counter_field_name))
+        per_page = getattr(self, self.counter_field_name)
+
+        if self.keyset_field and objects.query.can_filter():
+            return KeysetPaginator(objects, per_page, self.pk, self.keyset_field)
+        return Paginator(objects, per_page)
 
     def get_context(self, request):
         page = request.GET.get('page')
@@ -38,6 +52,11 @@ class PaginatedListPageMixin(object):
         except EmptyPage:
             objects = paginator.page(paginator.num_pages)
 
+        add_page_tags(request, objects.object_list)
+        if is_cursor(page):
+            add_cache_tags(request, [get_listing_tag(self)])
+        prefetch_listing_rich_text(objects.object_list)
+
         context = super(PaginatedListPageMixin, self).get_context(request)
         context[self.counter_context_name] = objects
         return context
@@ -0,0 +1,102 @@
+'''
+Publishing or unpublishing many pages at once.
+
+Every publish normally updates the search index, the home page headline and the CDN on its own.
+Inside deferred_side_effects() the signal handlers doing so hand their work to defer() instead, and
+it is done once for the whole batch at the end:
+
+    with deferred_side_effects():
+        for page in pages:
+            page.save_revision().publish()
+'''
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class DeferredSideEffects(object):
+    def __init__(self):
+        self._calls = OrderedDict()
+
+    def add(self, func, item):
+        self._calls.setdefault(func, []).append(item)
+
+    def run(self):
+        for func, items in self._calls.items():
+            try:
+                func(items)
+            except Exception:
+                logger.exception('Unable to run {} for {} deferred items.'.format(func.__name__, len(items)))
+
+
+def defer(func, item):
+    '''
+    If side effects are being deferred, queue `item` to be passed to `func`, with every other item
+    queued for it, at the end of the batch and return True. Otherwise return False.
+    '''
+    deferred = getattr(_local, 'deferred', None)
+    if deferred is None:
+        return False
+
+    deferred.add(func, item)
+    return True
+
+
+@contextmanager
+def deferred_side_effects():
+    '''
+    Defer the side effects of the publishes in the block until it is done, in the current thread.
+    Nothing is run if the block raises.
+    '''
+    if getattr(_local, 'deferred', None) is not None:
+        # Already deferring, the outermost block runs them
+        yield _local.deferred
+        return
+
+    deferred = _local.deferred = DeferredSideEffects()
+    try:
+        yield deferred
+    finally:
+        _local.deferred = None
+
+    deferred.run()
+
+
+def bulk_publish(pages, user=None):
+    '''
+    Publish the latest revision of every page, saving one first for pages without any. Returns the
+    published pages.
+    '''
+    published = []
+    with deferred_side_effects():
+        with transaction.atomic():
+            for page in pages:
+                page = page.specific
+                revision = page.get_latest_revision() or page.save_revision(user=user)
+                revision.publish()
+                published.append(page)
+    return published
+
+
+def bulk_unpublish(pages):
+    '''
+    Unpublish every live page. Returns the unpublished pages.
+    '''
+    unpublished = []
+    with deferred_side_effects():
+        with transaction.atomic():
+            for page in pages:
+                page = page.specific
+                if page.live:
+                    page.unpublish()
+                    unpublished.append(page)
+    return unpublished
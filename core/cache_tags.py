@@ -0,0 +1,150 @@
+'''
+Cache-Tag headers naming the objects a response was rendered from, so that Cloudflare can purge
+every response depending on an object by its tag (see caching/invalidate.py).
+
+Tags are collected on the request while it is served and written to the response at the end:
+
+    add_page_tags(request, pages)
+    add_cache_tags(request, [get_tag('topic', topic.pk)])
+    set_cache_tag_header(request, response)
+'''
+from __future__ import absolute_import, unicode_literals
+
+from functools import wraps
+
+from django.utils.decorators import available_attrs
+
+CACHE_TAG_HEADER = 'Cache-Tag'
+
+# Cloudflare ignores Cache-Tag headers longer than 16KB
+MAX_HEADER_LENGTH = 16 * 1024
+
+# Tag on every response depending on all objects of a kind, or on more of them than the header can name
+KIND_TAGS = {
+    'page': 'pages',
+    'topic': 'topics',
+    'contributor': 'contributors',
+    'series': 'series',
+    'theme': 'themes',
+}
+
+
+def get_tag(kind, pk):
+    return '{}-{}'.format(kind, pk)
+
+
+def get_purge_tags(kind, pks):
+    '''
+    Return the tags to purge for objects of a kind: theirs, and the tag for the whole kind.
+    '''
+    return [get_tag(kind, pk) for pk in pks] + [KIND_TAGS[kind]]
+
+
+def get_listing_tag(page):
+    '''
+    Return the tag of the pages of a listing reached through cursors (see core/pagination.py), which
+    its cached paths cannot name.
+    '''
+    return get_tag('listing', page.pk)
+
+
+def get_page_tags(pages):
+    '''
+    Return the tags of pages as they are shown on a page or in a listing: the page, its theme and,
+    for articles and series, their topics, authors and series.
+    '''
+    from articles.models import (ArticleAuthorLink, ArticlePage,
+                                 ArticleTopicLink, SeriesArticleLink,
+                                 SeriesPage)
+    from people.models import ContributorPage
+
+    tags = set()
+    article_ids = set()
+    series_ids = set()
+    for page in pages:
+        tags.add(get_tag('page', page.pk))
+        if getattr(page, 'theme_id', None):
+            tags.add(get_tag('theme', page.theme_id))
+
+        if isinstance(page, ArticlePage):
+            article_ids.add(page.pk)
+        elif isinstance(page, SeriesPage):
+            series_ids.add(page.pk)
+        elif isinstance(page, ContributorPage):
+            tags.add(get_tag('contributor', page.pk))
+
+        if getattr(page, 'primary_topic_id', None):
+            tags.add(get_tag('topic', page.primary_topic_id))
+
+    if series_ids:
+        tags.update(get_tag('series', pk) for pk in series_ids)
+
+        # Series show the authors and topics of their articles
+        series_article_ids = set(SeriesArticleLink.objects.filter(
+            series_id__in=series_ids,
+            article__isnull=False,
+        ).values_list('article_id', flat=True)) - article_ids
+        tags.update(get_tag('page', pk) for pk in series_article_ids)
+        tags.update(get_tag('topic', pk) for pk in ArticlePage.objects.filter(
+            pk__in=series_article_ids,
+            primary_topic__isnull=False,
+        ).values_list('primary_topic_id', flat=True))
+        article_ids.update(series_article_ids)
+
+    if article_ids:
+        tags.update(get_tag('contributor', pk) for pk in ArticleAuthorLink.objects.filter(
+            article_id__in=article_ids,
+            author__isnull=False,
+        ).values_list('author_id', flat=True))
+        tags.update(get_tag('topic', pk) for pk in ArticleTopicLink.objects.filter(
+            article_id__in=article_ids,
+            topic__isnull=False,
+        ).values_list('topic_id', flat=True))
+        tags.update(get_tag('series', pk) for pk in SeriesArticleLink.objects.filter(
+            article_id__in=article_ids,
+        ).values_list('series_id', flat=True))
+
+    return tags
+
+
+def add_cache_tags(request, tags):
+    if not hasattr(request, '_cache_tags'):
+        request._cache_tags = set()
+    request._cache_tags.update(tags)
+
+
+def add_page_tags(request, pages):
+    add_cache_tags(request, get_page_tags(pages))
+
+
+def get_cache_tag_header(tags):
+    header = ','.join(sorted(tags))
+    if len(header) <= MAX_HEADER_LENGTH:
+        return header
+
+    # Too many to name: fall back on the tags of their kinds, which are purged along with any of them
+    kind_tags = set()
+    for tag in tags:
+        kind = tag.rsplit('-', 1)[0]
+        kind_tags.add(KIND_TAGS.get(kind, tag))
+    return ','.join(sorted(kind_tags))
+
+
+def set_cache_tag_header(request, response):
+    tags = getattr(request, '_cache_tags', None)
+    if tags and response.status_code == 200 and not response.has_header(CACHE_TAG_HEADER):
+        response[CACHE_TAG_HEADER] = get_cache_tag_header(tags)
+    return response
+
+
+def cache_tagged(view, tags=None):
+    '''
+    Decorate a view so that its response names the tags collected while it ran, and `tags`.
+    '''
+    @wraps(view, assigned=available_attrs(view))
+    def inner(request, *args, **kwargs):
+        if tags:
+            add_cache_tags(request, tags)
+        return set_cache_tag_header(request, view(request, *args, **kwargs))
+
+    return inner
@@ -0,0 +1,121 @@
+from __future__ import absolute_import, unicode_literals
+
+import uuid
+from calendar import timegm
+
+from django.db.models import Max
+from django.db.models.functions import Coalesce
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from django.utils.timezone import now
+from wagtail.wagtailcore.models import Page
+
+
+# The versions of core.models.ContentVersion
+PUBLISH_STATE = 'publish_state'
+# Objects that pages show but are not pages, like topics and theme content
+OBJECTS = 'objects'
+
+
+def get_versions(request=None):
+    '''
+    Return the content versions by name. Looked up once per request.
+    '''
+    from .models import ContentVersion
+
+    versions = getattr(request, '_content_versions', None)
+    if versions is None:
+        versions = {version.name: version for version in ContentVersion.objects.all()}
+        if request is not None:
+            request._content_versions = versions
+    return versions
+
+
+def touch_version(name, changed_at=None):
+    '''
+    Give the content version a new value, in the database so that every process sees it whichever
+    cache it has, and return it.
+    '''
+    from .models import ContentVersion
+
+    version, created = ContentVersion.objects.update_or_create(name=name, defaults={
+        'version': uuid.uuid4().hex[:12],
+        'changed_at': changed_at or now(),
+    })
+    return version
+
+
+def get_publish_state(request=None):
+    '''
+    Return when a page was last published, unpublished or deleted and a version changing each time
+    one is (see touch_publish_state()).
+    '''
+    version = get_versions(request).get(PUBLISH_STATE)
+    if version is None:
+        # No page was published since the table was created
+        newest = Page.objects.live().aggregate(
+            # last_published_at is only set on pages published since Wagtail 1.2
+            newest=Max(Coalesce('last_published_at', 'latest_revision_created_at')),
+        )['newest']
+        version = touch_version(PUBLISH_STATE, newest)
+        if request is not None:
+            request._content_versions[PUBLISH_STATE] = version
+    return version.changed_at, version.version
+
+
+def touch_publish_state(instances=None):
+    touch_version(PUBLISH_STATE)
+
+
+def get_objects_version(request=None):
+    '''
+    Return the version of the topics, themes and theme content, which changes whenever one of them
+    is saved or deleted (see touch_objects_version()).
+    '''
+    version = get_versions(request).get(OBJECTS)
+    if version is None:
+        version = touch_version(OBJECTS)
+        if request is not None:
+            request._content_versions[OBJECTS] = version
+    return version.version
+
+
+def touch_objects_version():
+    touch_version(OBJECTS)
+
+
+def get_listing_etag(request, *args, **kwargs):
+    '''
+    ETag for views listing pages, usable with django.views.decorators.http.condition.
+    '''
+    changed_at, version = get_publish_state(request)
+    return 'pages-{}'.format(version)
+
+
+def get_listing_last_modified(request, *args, **kwargs):
+    '''
+    Last-Modified for views listing pages, usable with django.views.decorators.http.condition.
+    '''
+    changed_at, version = get_publish_state(request)
+    return changed_at
+
+
+def serve_conditionally(request, etag, last_modified, serve, *args, **kwargs):
+    '''
+    Answer with a 304 if the client's copy matches the validators, without calling serve(). Otherwise
+    return the response from serve(), with the validators set.
+    '''
+    etag = quote_etag(etag) if etag else None
+    last_modified = timegm(last_modified.utctimetuple()) if last_modified else None
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return response
+
+    response = serve(request, *args, **kwargs)
+    if response.status_code == 200:
+        if etag and not response.has_header('ETag'):
+            response['ETag'] = etag
+        if last_modified and not response.has_header('Last-Modified'):
+            response['Last-Modified'] = http_date(last_modified)
+    return response
@@ -1,15 +1,14 @@
 from __future__ import absolute_import, unicode_literals
 
-from itertools import chain
-from operator import attrgetter
-
 from django.conf import settings
 from django.contrib.staticfiles.templatetags.staticfiles import static
 from django.contrib.syndication.views import Feed
 from django.core.urlresolvers import reverse_lazy
 from django.utils.feedgenerator import Rss201rev2Feed
 
-from articles.models import ArticlePage, SeriesPage
+from articles.models import FeedEntry, get_entry_pages
+
+from .cache_tags import add_page_tags
 
 
 # Based on http://www.mechanicalgirl.com/post/customizing-django-rss-feed/
@@ -51,16 +50,14 @@ class MainFeed(Feed):
 
     description_template = 'feeds/main/description.html'
 
-    def items(self):
-        articles = ArticlePage.objects.live().order_by('-first_published_at')[:50]
-        series = SeriesPage.objects.live().order_by('-first_published_at')[:50]
+    def get_object(self, request, *args, **kwargs):
+        # Passed to items(), to collect the cache tags of the items on the request
+        return request
 
-        return list(reversed(
-            sorted(
-                chain(articles, series),
-                key=attrgetter('first_published_at')
-            )
-        ))[:50]
+    def items(self, request):
+        items = get_entry_pages(FeedEntry.objects.order_by('-first_published_at')[:50])
+        add_page_tags(request, items)
+        return items
 
     def item_title(self, obj):
         return obj.title
@@ -0,0 +1,179 @@
+'''
+Lays out the articles of the home page in rows.
+
+Articles are placed in order of preference: each row takes the first articles left whose feature
+style fits in the columns and rows remaining, and an article taller than one row is followed by a
+set of rows filling the columns beside it:
+
+    [
+        [tall_article, [[article, article], [article, article]]],
+        [article, article, article],
+    ]
+
+This is the layout the home page had before, computed in one pass over the articles instead of
+rescanning them, and loading each one once (core/tests.py keeps the former version to compare).
+
+The layouts of the home page are stored as page ids in a HomePageLayout (see core/models.py) and
+turned back into pages with get_layout_ids() and resolve_layout_ids().
+'''
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict, deque
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist
+from wagtail.wagtailcore.models import Page
+
+
+def resolve_articles(pages, deferred_fields=()):
+    '''
+    Return the specific page of each page, in the same order, with their feature style and
+    analytics loaded, and without those of `deferred_fields` they have. One query per type of
+    page, and those of the listing plan of the type (see listing_queryset()).
+    '''
+    ids_by_model = OrderedDict()
+    for page in pages:
+        ids_by_model.setdefault(page.specific_class, []).append(page.pk)
+
+    specific_pages = {}
+    for model, ids in ids_by_model.items():
+        queryset = listing_queryset(model.objects.filter(pk__in=ids)).select_related('feature_style', 'analytics')
+        deferred = [name for name in deferred_fields if _has_field(model, name)]
+        if deferred:
+            queryset = queryset.defer(*deferred)
+        for specific_page in queryset:
+            specific_pages[specific_page.pk] = specific_page
+
+    return [specific_pages[page.pk] for page in pages if page.pk in specific_pages]
+
+
+class ArticlePacker(object):
+    '''
+    Packs articles, in order of preference, into sets of rows. Articles whose id is in `used` are
+    left out, and every article placed is added to it.
+    '''
+    def __init__(self, articles, used=None):
+        self.used = used if used is not None else []
+
+        # The articles left for each size of feature style, in order. The first article fitting a
+        # space is the earliest of the first articles of the sizes that fit.
+        self._queues = OrderedDict()
+        used_ids = set(self.used)
+        for index, article in enumerate(articles):
+            style = article.feature_style
+            if article.id in used_ids or style is None:
+                continue
+            size = (style.number_of_columns, style.number_of_rows)
+            self._queues.setdefault(size, deque()).append((index, article))
+
+    def _take(self, columns, rows):
+        first = None
+        for (size_columns, size_rows), queue in self._queues.items():
+            if queue and size_columns <= columns and size_rows <= rows:
+                if first is None or queue[0][0] < first[0][0]:
+                    first = queue
+
+        if first is None:
+            return None
+
+        index, article = first.popleft()
+        self.used.append(article.id)
+        return article
+
+    def pack(self, columns, rows):
+        '''
+        Return the rows filling `columns` columns over at most `rows` rows.
+        '''
+        article_set = []
+        if columns == 0 and rows == 0:
+            return article_set
+
+        while rows > 0:
+            row, height = self._fill_row(columns, rows)
+            if height == 0:
+                break
+            article_set.append(row)
+            rows = rows - height
+
+        return article_set
+
+    def _fill_row(self, columns, max_height):
+        if columns == 0:
+            return [], 0
+
+        article = self._take(columns, max_height)
+        if article is None:
+            return [], 0
+
+        columns = columns - article.feature_style.number_of_columns
+        max_height = min(max_height, article.feature_style.number_of_rows)
+        row = [article]
+
+        if max_height > 1 and columns > 0:
+            row.append(self.pack(columns, max_height))
+        else:
+            row.extend(self._fill_row(columns, max_height)[0])
+
+        return row, max_height
+
+
+def get_layout_ids(layout, pages):
+    '''
+    Return the layout, a page or nested lists of pages, with the pages replaced by their ids. Each
+    page is added to `pages` by id, with its content type and feature style.
+    '''
+    if layout is None:
+        return None
+    if isinstance(layout, Page):
+        pages[str(layout.pk)] = [layout.content_type_id, getattr(layout, 'feature_style_id', None)]
+        return layout.pk
+    return [get_layout_ids(item, pages) for item in layout]
+
+
+def load_layout_pages(pages):
+    '''
+    Load the specific pages listed by get_layout_ids(), with one query per content type. Returns
+    the pages by id.
+    '''
+    ids_by_content_type = OrderedDict()
+    for pk, (content_type_id, feature_style_id) in pages.items():
+        ids_by_content_type.setdefault(content_type_id, []).append(int(pk))
+
+    loaded = {}
+    for content_type_id, ids in ids_by_content_type.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        related = [name for name in ('feature_style', 'analytics') if _has_field(model, name)]
+        for page in listing_queryset(model.objects.live().filter(pk__in=ids)).select_related(*related):
+            loaded[page.pk] = page
+    return loaded
+
+
+def resolve_layout_ids(layout, pages):
+    '''
+    Return the layout with the ids replaced by the pages in `pages`, leaving out pages that are
+    missing.
+    '''
+    if layout is None:
+        return None
+    if not isinstance(layout, list):
+        return pages.get(layout)
+    resolved = [resolve_layout_ids(item, pages) for item in layout]
+    return [item for item in resolved if item is not None]
+
+
+def listing_queryset(queryset):
+    '''
+    Return the queryset loading what the pages show when listed, for the models with a for_listing()
+    queryset method, such as ArticlePage.
+    '''
+    if hasattr(queryset, 'for_listing'):
+        return queryset.for_listing()
+    return queryset
+
+
+def _has_field(model, name):
+    try:
+        model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return False
+    return True
@@ -0,0 +1,75 @@
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from wagtail.wagtailcore.models import Page
+
+from core.bulk import bulk_publish, bulk_unpublish
+
+
+class Command(BaseCommand):
+    help = 'Publish or unpublish many pages at once, updating the search index, the home page and the cache once at the end'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'pages',
+            nargs='*',
+            type=int,
+            help='The ids of the pages'
+        )
+        parser.add_argument(
+            '--children-of',
+            action='append',
+            type=int,
+            dest='parents',
+            default=[],
+            help='Also the children of this page. Can be given more than once'
+        )
+        parser.add_argument(
+            '--unpublish',
+            action='store_true',
+            dest='unpublish',
+            default=False,
+            help='Unpublish the pages instead of publishing them'
+        )
+        parser.add_argument(
+            '--user',
+            action='store',
+            dest='user',
+            default=None,
+            help='The username to record on the revisions saved for pages without any'
+        )
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            User = get_user_model()
+            try:
+                user = User.objects.get(**{User.USERNAME_FIELD: options['user']})
+            except User.DoesNotExist:
+                raise CommandError('There is no user {}.'.format(options['user']))
+
+        page_ids = list(options['pages'])
+        for pk in options['parents']:
+            try:
+                parent = Page.objects.get(pk=pk)
+            except Page.DoesNotExist:
+                raise CommandError('There is no page with the id {}.'.format(pk))
+            page_ids.extend(parent.get_children().values_list('pk', flat=True))
+
+        pages = Page.objects.filter(pk__in=page_ids).order_by('path')
+        missing = set(page_ids) - set(page.pk for page in pages)
+        if missing:
+            raise CommandError('There are no pages with the ids {}.'.format(', '.join(str(pk) for pk in sorted(missing))))
+
+        start = time.time()
+        if options['unpublish']:
+            done = bulk_unpublish(pages)
+            verb = 'Unpublished'
+        else:
+            done = bulk_publish(pages, user=user)
+            verb = 'Published'
+
+        self.stdout.write('{} {} of {} pages in {:.3f}s'.format(verb, len(done), len(pages), time.time() - start))
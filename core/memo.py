@@ -0,0 +1,156 @@
+'''
+Memoization of computed model properties, such as ArticlePage.authors, which templates evaluate
+several times while rendering a page:
+
+    @memoized_property
+    def authors(self):
+        ...
+
+Values are only kept while a request is served, or inside a memoization() block for renders
+outside of one, and are forgotten at the end of it and whenever a model instance is saved or
+deleted. Elsewhere, as in management commands, the properties are computed on every access.
+
+    with memoization():
+        render_to_string(template, context)
+
+With DEBUG on, the hits and misses of each property are counted and logged at the end of the
+request or block.
+'''
+from __future__ import absolute_import, unicode_literals
+
+import itertools
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+# Attribute of the instances holding their memoized values, with the generation they are from
+MEMO_ATTRIBUTE = '_memoized'
+
+_generations = itertools.count(1)
+_local = threading.local()
+
+
+def is_memoizing():
+    return getattr(_local, 'depth', 0) > 0
+
+
+def invalidate():
+    '''
+    Forget every value memoized in the current thread.
+    '''
+    _local.generation = next(_generations)
+
+
+def start_memoization():
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    if _local.depth == 1:
+        invalidate()
+        reset_stats()
+
+
+def end_memoization():
+    _local.depth = max(getattr(_local, 'depth', 0) - 1, 0)
+    if _local.depth == 0:
+        invalidate()
+        if settings.DEBUG:
+            log_stats()
+
+
+@contextmanager
+def memoization():
+    '''
+    Memoize the properties accessed in the block, in the current thread.
+    '''
+    start_memoization()
+    try:
+        yield
+    finally:
+        end_memoization()
+
+
+def get_stats():
+    '''
+    Return the hits and misses of each property in the current request or block, as counters of
+    'Model.property' names. Only counted with DEBUG on.
+    '''
+    if not hasattr(_local, 'hits'):
+        reset_stats()
+    return _local.hits, _local.misses
+
+
+def reset_stats():
+    _local.hits = Counter()
+    _local.misses = Counter()
+
+
+def log_stats():
+    hits, misses = get_stats()
+    if hits or misses:
+        logger.debug('Memoized properties: {} hits, {} misses. {}'.format(
+            sum(hits.values()),
+            sum(misses.values()),
+            ', '.join('{} {}/{}'.format(key, hits[key], misses[key]) for key in sorted(set(hits) | set(misses))),
+        ))
+
+
+class memoized_property(object):
+    '''
+    A property computed once for each instance while memoizing (see memoization()).
+    '''
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        if not is_memoizing():
+            return self.func(instance)
+
+        generation, memo = instance.__dict__.get(MEMO_ATTRIBUTE, (None, None))
+        if generation != _local.generation:
+            memo = {}
+            instance.__dict__[MEMO_ATTRIBUTE] = (_local.generation, memo)
+
+        hit = self.name in memo
+        if not hit:
+            memo[self.name] = self.func(instance)
+
+        if settings.DEBUG:
+            hits, misses = get_stats()
+            key = '{}.{}'.format(type(instance).__name__, self.name)
+            if hit:
+                hits[key] += 1
+            else:
+                misses[key] += 1
+
+        return memo[self.name]
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def instance_changed_handler(sender, instance, **kwargs):
+    # Any change can change what a property of another instance computes, e.g. renaming an author
+    if is_memoizing():
+        invalidate()
+
+
+@receiver(request_started)
+def request_started_handler(**kwargs):
+    # Requests don't nest: start afresh even if the last one was never finished
+    _local.depth = 0
+    start_memoization()
+
+
+@receiver(request_finished)
+def request_finished_handler(**kwargs):
+    end_memoization()
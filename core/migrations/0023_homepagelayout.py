@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_auto_20151016_0320'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HomePageLayout',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('layout', models.TextField()),
+                ('built_at', models.DateTimeField(auto_now=True)),
+                ('home_page', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.HomePage')),
+            ],
+        ),
+    ]
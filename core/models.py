@@ -1,9 +1,10 @@
 from __future__ import absolute_import, unicode_literals
 
 import itertools
+import json
 
-from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch.dispatcher import receiver
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.timezone import now
@@ -12,7 +13,7 @@ from wagtail.wagtailadmin.edit_handlers import (FieldPanel, MultiFieldPanel,
                                                 StreamFieldPanel,
                                                 TabbedInterface)
 from wagtail.wagtailcore.models import Page
-from wagtail.wagtailcore.signals import page_published
+from wagtail.wagtailcore.signals import page_published, page_unpublished
 from wagtail.wagtailimages.edit_handlers import ImageChooserPanel
 from wagtail.wagtailsearch import index
 from wagtail.wagtailsnippets.models import register_snippet
@@ -24,7 +25,13 @@ from jobs import models as jobs_models
 from newsletter import models as newsletter_models
 from people import models as people_models
 from projects import models as project_models
-from themes.models import ThemeablePage
+from themes.models import Theme, ThemeablePage, ThemeContent
+
+from .bulk import defer
+from .conditional import touch_objects_version
+from .layout import (ArticlePacker, get_layout_ids, load_layout_pages,
+                     resolve_articles, resolve_layout_ids)
+from .rich_text import prefetch_listing_rich_text
 
 
 class StreamPage(ThemeablePage):
@@ -49,6 +56,7 @@ class StreamPage(ThemeablePage):
 
 @python_2_unicode_compatible
 class HomePage(ThemeablePage):
+    lists_pages = True
     subpage_types = [
         article_models.ArticleListPage,
         article_models.SeriesListPage,
@@ -81,82 +89,93 @@ class HomePage(ThemeablePage):
 
     _articles = None
     _most_popular_article = None
+    _graphics = None
+    _series = None
+    _external_articles = None
+
+    # The sections stored in its HomePageLayout
+    layout_sections = ['articles', 'most_popular_article', 'graphics', 'series', 'external_articles']
 
     def __str__(self):
         return self.title
 
-    def get_article_set(self, columns, rows, article_list, used):
-        if columns == 0 and rows == 0 or not article_list:
-            return []
-
-        current_set = []
-        while rows > 0:
-            row, height = self._fill_row(columns, article_list, used, rows)
-            if height == 0:
-                break
-            current_set.append(row)
-            rows = rows - height
-
-        return current_set
-
-    def _fill_row(self, columns, article_list, used, max_height):
-        if columns == 0 or not article_list:
-            return [], 0
-
-        for article in article_list:
-            typed_article = article.content_type.get_object_for_this_type(
-                id=article.id)
-            if typed_article.feature_style.number_of_columns <= columns \
-                    and typed_article.id not in used\
-                    and typed_article.feature_style.number_of_rows <= max_height:
-
-                columns = columns - typed_article.feature_style.number_of_columns
-                used.append(typed_article.id)
-                row = [typed_article]
-                max_height = min(max_height, typed_article.feature_style.number_of_rows)
-
-                if max_height > 1 and columns > 0:
-                    subset = self.get_article_set(columns, max_height, article_list, used)
-                    row.append(subset)
-                else:
-                    recursive_row, height = self._fill_row(columns, article_list, used, max_height)
-                    row.extend(recursive_row)
-                return row, max_height
-
-        return [], 0
+    def get_context(self, request, *args, **kwargs):
+        if getattr(request, 'is_preview', False):
+            # Drafts are laid out from their own settings, and their layout is not stored
+            self.set_layout(self.compute_layout())
+        else:
+            self.load_layout()
+        return super(HomePage, self).get_context(request, *args, **kwargs)
+
+    def compute_layout(self):
+        '''
+        Compute the sections of the page from its fields, as page ids.
+        '''
+        for section in self.layout_sections:
+            setattr(self, '_' + section, None)
+
+        pages = {}
+        layout = {'pages': pages}
+        for section in self.layout_sections:
+            if section == 'most_popular_article' and not self.articles:
+                layout[section] = None
+            else:
+                layout[section] = get_layout_ids(getattr(self, section), pages)
+        return layout
+
+    def build_layout(self):
+        '''
+        Compute the sections of the page and store their page ids in its HomePageLayout. Returns
+        the stored layout.
+        '''
+        layout = self.compute_layout()
+        try:
+            with transaction.atomic():
+                HomePageLayout.objects.update_or_create(home_page_id=self.pk, defaults={
+                    'layout': json.dumps(layout),
+                })
+        except IntegrityError:
+            # Built at the same time elsewhere
+            pass
+
+        return layout
+
+    def load_layout(self):
+        '''
+        Set the sections of the page from its HomePageLayout, building it if there is none.
+        '''
+        layout = HomePageLayout.objects.filter(home_page_id=self.pk).values_list('layout', flat=True).first()
+        if layout is None:
+            layout = self.build_layout()
+        else:
+            layout = json.loads(layout)
+        self.set_layout(layout)
+
+    def set_layout(self, layout):
+        '''
+        Set the sections of the page from their page ids.
+        '''
+        pages = load_layout_pages(layout['pages'])
+        for section in self.layout_sections:
+            setattr(self, '_' + section, resolve_layout_ids(layout[section], pages))
+        prefetch_listing_rich_text(pages.values())
 
     @property
     def articles(self):
         if self._articles is not None:
             return self._articles
 
-        article_content_type = ContentType.objects.get_for_model(
-            article_models.ArticlePage)
-        series_content_type = ContentType.objects.get_for_model(
-            article_models.SeriesPage)
-
-        articles = Page.objects.live().filter(
-            models.Q(content_type=article_content_type)
-            | models.Q(content_type=series_content_type)
-        ).annotate(
-            sticky=models.Case(
-                models.When(
-                    models.Q(seriespage__sticky=True) | (models.Q(articlepage__sticky=True)),
-                    then=models.Value(1)),
-                default=models.Value(0),
-                output_field=models.IntegerField())
-        ).exclude(
-            models.Q(seriespage__slippery=True) | models.Q(articlepage__slippery=True)
+        articles = article_models.FeedEntry.objects.exclude(
+            slippery=True
         ).order_by("-sticky", "-first_published_at")
 
-        articles = list(articles[:42])
+        articles = resolve_articles(list(articles[:42]))
 
         used = []
-        if self.featured_item:
-            used.append(self.featured_item.id)
-        self._articles = self.get_article_set(self.number_of_columns_of_articles,
-                                              self.number_of_rows_of_articles, articles,
-                                              used)
+        if self.featured_item_id:
+            used.append(self.featured_item_id)
+        self._articles = ArticlePacker(articles, used).pack(self.number_of_columns_of_articles,
+                                                            self.number_of_rows_of_articles)
 
         return self._articles
 
@@ -200,6 +219,9 @@ class HomePage(ThemeablePage):
 
     @property
     def external_articles(self):
+        if self._external_articles is not None:
+            return self._external_articles
+
         number_of_external_articles = self.number_of_rows_of_external_articles * self.number_of_columns_of_external_articles
         external_article_list = article_models.ExternalArticlePage.objects.live().order_by("-first_published_at")[:number_of_external_articles]
 
@@ -209,6 +231,9 @@ class HomePage(ThemeablePage):
 
     @property
     def graphics(self):
+        if self._graphics is not None:
+            return self._graphics
+
         number_of_graphics = self.number_of_rows_of_visualizations * self.number_of_columns_of_visualizations
         graphics_list = article_models.ArticlePage.objects.live().filter(
             visualization=True).annotate(
@@ -224,6 +249,9 @@ class HomePage(ThemeablePage):
 
     @property
     def series(self):
+        if self._series is not None:
+            return self._series
+
         number_of_series = self.number_of_rows_of_series
         series_list = article_models.SeriesPage.objects.live().annotate(
             sticky_value=models.Case(
@@ -282,10 +310,22 @@ class HomePage(ThemeablePage):
     ])
 
 
+def update_headlines(home_pages):
+    for pk in set(home_page.pk for home_page in home_pages):
+        update_headline(HomePage.objects.get(pk=pk))
+
+
 @receiver(page_published, sender=HomePage)
 def on_publish(**kwargs):
     instance = kwargs["instance"]
 
+    if defer(update_headlines, instance):
+        return
+
+    update_headline(instance)
+
+
+def update_headline(instance):
     featured_item = instance.featured_item.content_type.get_object_for_this_type(
         id=instance.featured_item.id)
 
@@ -325,6 +365,49 @@ def on_publish(**kwargs):
             )
 
 
+@python_2_unicode_compatible
+class HomePageLayout(models.Model):
+    '''
+    The pages shown in each section of a home page, as page ids, so that it is not computed again
+    on every request. Rebuilt when a page it may show is published, unpublished or deleted, and
+    after the analytics are imported (see update_page_analytics).
+
+    Only ids are stored, so that the teasers show the current authors, topics and images of the
+    pages without the layout being rebuilt when those change. Loading it therefore takes one query
+    for the layout, then one per type of page shown and per relation its teasers show: 9 at most
+    with articles and series, however many pages are shown.
+    '''
+    home_page = models.OneToOneField(HomePage, related_name='+', on_delete=models.CASCADE)
+    layout = models.TextField()
+    built_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "Layout of {}".format(self.home_page)
+
+
+def rebuild_layouts(instances=None):
+    for home_page in HomePage.objects.live():
+        home_page.build_layout()
+
+
+# The pages the layout is computed from
+LAYOUT_MODELS = (
+    HomePage,
+    article_models.ArticlePage,
+    article_models.SeriesPage,
+    article_models.ExternalArticlePage,
+)
+
+
+@receiver(page_published)
+@receiver(page_unpublished)
+@receiver(post_delete)
+def on_layout_publish(sender, instance, **kwargs):
+    # Saves of drafts and of the analytics of single pages leave the layout as it is
+    if sender in LAYOUT_MODELS and not defer(rebuild_layouts, instance):
+        transaction.on_commit(rebuild_layouts)
+
+
 @python_2_unicode_compatible
 class SiteDefaults(models.Model):
     site = models.OneToOneField('wagtailcore.Site',
@@ -347,3 +430,28 @@ class SiteDefaults(models.Model):
         FieldPanel('contact_email'),
     ]
 register_snippet(SiteDefaults)
+
+
+@python_2_unicode_compatible
+class ContentVersion(models.Model):
+    '''
+    A version of what pages show, changed whenever it changes, for their ETags (see
+    core/conditional.py). Kept in the database rather than the cache, which may be one per process.
+    '''
+    name = models.CharField(max_length=50, primary_key=True)
+    version = models.CharField(max_length=12)
+    changed_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return "{} version {}".format(self.name, self.version)
+
+
+# Shown by pages without being pages, see get_objects_version()
+VERSIONED_MODELS = (article_models.Topic, Theme, ThemeContent, SiteDefaults)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def on_versioned_object_change(sender, raw=False, **kwargs):
+    if sender in VERSIONED_MODELS and not raw:
+        touch_objects_version()
@@ -0,0 +1,250 @@
+'''
+Pagination of the list pages without counting every row and skipping over the rows of the
+previous pages on each request.
+
+KeysetPaginator pages through a queryset ordered on a field, newest first, and the primary key.
+The next and previous pages are found from the first or last row of the current page, given in an
+opaque cursor, rather than by offset:
+
+    ?page=c.WyJhZnRlciIsIDIsICIyMDE1LTA3LTE0VDE5OjI0OjA0KzAwOjAwIiwgMTA4XQ
+
+A cursor is what page.next_page_number() and page.previous_page_number() return, so that the
+pagers of the templates link to them unchanged. Numbered pages, ?page=2, are still served, by
+offset.
+
+The total count shown in "Page 2 of 8" is cached, until a page is next published or unpublished.
+'''
+from __future__ import absolute_import, unicode_literals
+
+import base64
+import json
+import uuid
+
+import six
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db.models import F, Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils.functional import cached_property
+from wagtail.wagtailcore.models import Page
+from wagtail.wagtailcore.signals import page_published, page_unpublished
+
+from .bulk import defer
+from .conditional import touch_publish_state
+
+CURSOR_PREFIX = 'c.'
+
+COUNT_VERSION_KEY = 'core.pagination.count_version'
+COUNT_TIMEOUT = 24 * 60 * 60
+
+# Name of the annotation holding the value of the field paged on
+KEY = 'keyset_value'
+
+
+def get_count_version():
+    version = cache.get(COUNT_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(COUNT_VERSION_KEY, version, None)
+    return version
+
+
+def reset_counts():
+    cache.set(COUNT_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+@receiver(page_published)
+@receiver(page_unpublished)
+def page_published_handler(instance, **kwargs):
+    reset_counts()
+    if not defer(touch_publish_state, instance):
+        touch_publish_state()
+
+
+@receiver(post_delete)
+def page_deleted_handler(sender, instance, **kwargs):
+    if isinstance(instance, Page) and instance.live:
+        reset_counts()
+        if not defer(touch_publish_state, instance):
+            touch_publish_state()
+
+
+def encode_cursor(direction, number, value, pk):
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    data = json.dumps([direction, number, value, pk]).encode('utf-8')
+    return CURSOR_PREFIX + base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''
+    Return the direction, page number, value and primary key of a cursor, or raise
+    PageNotAnInteger if it is not one.
+    '''
+    try:
+        data = cursor[len(CURSOR_PREFIX):]
+        data = base64.urlsafe_b64decode(str(data + '=' * (-len(data) % 4)))
+        direction, number, value, pk = json.loads(data.decode('utf-8'))
+        number = int(number)
+        pk = int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise PageNotAnInteger('That page cursor is not valid')
+
+    if direction not in ('after', 'before') or number < 1:
+        raise PageNotAnInteger('That page cursor is not valid')
+    return direction, number, value, pk
+
+
+def is_cursor(number):
+    return isinstance(number, six.string_types) and number.startswith(CURSOR_PREFIX)
+
+
+class CachedCountPaginator(Paginator):
+    '''
+    A Paginator whose count is cached under `count_key` until a page is published or unpublished.
+    '''
+    def __init__(self, object_list, per_page, count_key, **kwargs):
+        super(CachedCountPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.count_key = count_key
+
+    @cached_property
+    def count(self):
+        key = 'core.pagination.count.{}.{}'.format(get_count_version(), self.count_key)
+        count = cache.get(key)
+        if count is None:
+            count = super(CachedCountPaginator, self).count
+            cache.set(key, count, COUNT_TIMEOUT)
+        return count
+
+
+class KeysetPage(object):
+    '''
+    A page of a KeysetPaginator, usable in templates like the pages of Django's Paginator.
+    '''
+    def __init__(self, rows, number, paginator, has_next, has_previous):
+        # The rows of the queryset, which the cursors are made from, and what is shown for them
+        self.rows = rows
+        self.object_list = paginator.resolve(rows) if paginator.resolve else rows
+        self.number = number
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return '<Page {} of {}>'.format(self.number, self.paginator.num_pages)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        if not self._has_next:
+            raise EmptyPage('That page contains no results')
+        last = self.rows[-1]
+        return encode_cursor('after', self.number + 1, getattr(last, KEY), last.pk)
+
+    def previous_page_number(self):
+        if not self._has_previous:
+            raise EmptyPage('That page number is less than 1')
+        if self.number <= 2:
+            # The first page needs no cursor
+            return 1
+        first = self.rows[0]
+        return encode_cursor('before', self.number - 1, getattr(first, KEY), first.pk)
+
+    def start_index(self):
+        if not self.object_list:
+            return 0
+        return (self.number - 1) * self.paginator.per_page + 1
+
+    def end_index(self):
+        return self.start_index() + len(self.object_list) - 1 if self.object_list else 0
+
+
+class KeysetPaginator(CachedCountPaginator):
+    '''
+    Pages through `object_list`, a queryset, newest `field` first then highest primary key first,
+    with rows without a value last. Pages are numbered, or cursors from another page.
+
+    If given, `resolve` is called with the rows of each page and returns the objects to show for
+    them, e.g. to load only the pages listed on that page.
+    '''
+    def __init__(self, object_list, per_page, count_key, field, resolve=None, **kwargs):
+        object_list = object_list.annotate(**{KEY: F(field)})
+        super(KeysetPaginator, self).__init__(object_list, per_page, count_key, **kwargs)
+        self.field = field
+        self.resolve = resolve
+
+    def to_python(self, value):
+        return self.object_list.query.annotations[KEY].output_field.to_python(value)
+
+    def page(self, number):
+        if is_cursor(number):
+            return self.cursor_page(*decode_cursor(number))
+
+        number = self.validate_number(number)
+        if number == 1:
+            # Same as following a cursor from before the first row
+            rows = list(self.ordered()[:self.per_page + 1])
+            return KeysetPage(rows[:self.per_page], 1, self, len(rows) > self.per_page, False)
+
+        bottom = (number - 1) * self.per_page
+        rows = list(self.ordered()[bottom:bottom + self.per_page + 1])
+        if not rows:
+            raise EmptyPage('That page contains no results')
+        return KeysetPage(rows[:self.per_page], number, self, len(rows) > self.per_page, True)
+
+    def ordered(self):
+        return self.object_list.order_by(F(KEY).desc(nulls_last=True), '-pk')
+
+    def cursor_page(self, direction, number, value, pk):
+        value = self.to_python(value) if value is not None else None
+
+        if direction == 'after':
+            if value is None:
+                rows = self.object_list.filter(**{KEY + '__isnull': True, 'pk__lt': pk})
+            else:
+                rows = self.object_list.filter(
+                    Q(**{KEY + '__lt': value})
+                    | Q(**{KEY: value, 'pk__lt': pk})
+                    | Q(**{KEY + '__isnull': True})
+                )
+            rows = list(rows.order_by(F(KEY).desc(nulls_last=True), '-pk')[:self.per_page + 1])
+            if not rows:
+                raise EmptyPage('That page contains no results')
+            return KeysetPage(rows[:self.per_page], number, self, len(rows) > self.per_page, True)
+
+        if value is None:
+            rows = self.object_list.filter(
+                Q(**{KEY + '__isnull': False})
+                | Q(**{KEY + '__isnull': True, 'pk__gt': pk})
+            )
+        else:
+            rows = self.object_list.filter(
+                Q(**{KEY + '__gt': value})
+                | Q(**{KEY: value, 'pk__gt': pk})
+            )
+        rows = list(rows.order_by(F(KEY).asc(nulls_first=True), 'pk')[:self.per_page + 1])
+        if not rows:
+            raise EmptyPage('That page contains no results')
+        has_previous = len(rows) > self.per_page
+        rows = list(reversed(rows[:self.per_page]))
+        if not has_previous:
+            # Back at the start, whatever number the cursor had
+            number = 1
+        return KeysetPage(rows, number, self, True, has_previous)
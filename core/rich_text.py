@@ -0,0 +1,294 @@
+'''
+Expansion of rich text, as Wagtail's richtext filter does, without looking up the pages, images
+and documents it links to or embeds on every render:
+
+    {{ article.excerpt|cached_richtext }}
+
+The expanded HTML is cached under a hash of the rich text and of the versions of the objects it
+refers to. Saving or deleting one of them, e.g. moving a page or changing the focal point of an
+image, gives it a new version, so that the rich text referring to it is expanded again. Entries
+expire after RICH_TEXT_TIMEOUT all the same, to catch the URLs changed along with a parent page's.
+Rich text referring to nothing is expanded without going to the cache, which would cost more.
+
+Snippets get versions too, for the blocks of the fragment cache choosing them (see
+caching/fragments.py).
+
+Within a request, each rich text is expanded once. For listings, prefetch_rich_text() expands the
+rich text of every item at once, loading the objects referred to by those not cached with one
+query per model:
+
+    prefetch_listing_rich_text(objects.object_list)
+'''
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import threading
+import uuid
+
+import six
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from wagtail.wagtailcore import rich_text
+from wagtail.wagtailcore.models import Page
+from wagtail.wagtaildocs.models import get_document_model
+from wagtail.wagtaildocs.rich_text import DocumentLinkHandler
+from wagtail.wagtailimages import get_image_model
+from wagtail.wagtailimages.formats import get_image_format
+from wagtail.wagtailimages.rich_text import ImageEmbedHandler
+from wagtail.wagtailsnippets.models import get_snippet_models
+
+RICH_TEXT_TIMEOUT = 24 * 60 * 60
+
+# The rich text fields shown by the teasers of listings
+LISTING_FIELDS = ('excerpt', 'subtitle', 'short_description', 'short_bio', 'override_text', 'body', 'description')
+
+# Rich text expanded during the request, by source, dropped past this many
+MAX_EXPANDED = 1000
+
+_local = threading.local()
+
+
+def get_references(html):
+    '''
+    Return the (kind, id) of the pages, documents and images the rich text refers to.
+    '''
+    references = set()
+    for match in rich_text.FIND_A_TAG.finditer(html):
+        attrs = rich_text.extract_attrs(match.group(1))
+        if attrs.get('linktype') in ('page', 'document') and 'id' in attrs:
+            references.add((attrs['linktype'], attrs['id']))
+    for match in rich_text.FIND_EMBED_TAG.finditer(html):
+        attrs = rich_text.extract_attrs(match.group(1))
+        if attrs.get('embedtype') == 'image' and 'id' in attrs:
+            references.add(('image', attrs['id']))
+    return references
+
+
+def get_kind(model):
+    '''
+    Return the kind of the references to objects of `model`: page, image, document, or the label
+    of the model for snippets.
+    '''
+    if issubclass(model, Page):
+        return 'page'
+    if issubclass(model, get_image_model()):
+        return 'image'
+    if issubclass(model, get_document_model()):
+        return 'document'
+    return model._meta.label_lower
+
+
+def get_version_key(kind, pk):
+    return 'core.rich_text.version.{}.{}'.format(kind, pk)
+
+
+def get_versions(references):
+    if not references:
+        return {}
+    versions = cache.get_many([get_version_key(kind, pk) for kind, pk in references])
+    return dict((reference, versions.get(get_version_key(*reference), '')) for reference in references)
+
+
+def invalidate(kind, pk):
+    cache.set(get_version_key(kind, pk), uuid.uuid4().hex, None)
+    forget_expanded()
+
+
+def get_key(html, references, versions):
+    parts = [html] + ['{}.{}.{}'.format(kind, pk, versions[(kind, pk)]) for kind, pk in sorted(references)]
+    return 'core.rich_text.{}'.format(hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest())
+
+
+def _get_expanded():
+    if not hasattr(_local, 'expanded'):
+        _local.expanded = {}
+    return _local.expanded
+
+
+def forget_expanded():
+    '''
+    Forget the rich text expanded so far in this thread, as at the start of a request.
+    '''
+    _get_expanded().clear()
+
+
+def _remember(html, expanded):
+    remembered = _get_expanded()
+    if len(remembered) >= MAX_EXPANDED:
+        remembered.clear()
+    remembered[html] = expanded
+
+
+def expand(html):
+    '''
+    Return the rich text `html` expanded, from the cache if it can be.
+    '''
+    if not html:
+        return ''
+
+    expanded = _get_expanded().get(html)
+    if expanded is not None:
+        return expanded
+
+    references = get_references(html)
+    if not references:
+        # Nothing to look up, expanding costs less than a round trip to the cache
+        expanded = rich_text.expand_db_html(html)
+    else:
+        key = get_key(html, references, get_versions(references))
+        expanded = cache.get(key)
+        if expanded is None:
+            expanded = rich_text.expand_db_html(html)
+            cache.set(key, expanded, RICH_TEXT_TIMEOUT)
+
+    _remember(html, expanded)
+    return expanded
+
+
+def load_references(references):
+    '''
+    Return the objects referred to by kind and id, with one query per kind. Missing objects are
+    None.
+    '''
+    ids = {}
+    for kind, pk in references:
+        ids.setdefault(kind, set()).add(pk)
+
+    querysets = {
+        'page': lambda ids: Page.objects.filter(pk__in=ids).specific(),
+        'image': lambda ids: get_image_model().objects.filter(pk__in=ids).prefetch_related('renditions'),
+        'document': lambda ids: get_document_model().objects.filter(pk__in=ids),
+    }
+    loaded = dict((reference, None) for reference in references)
+    for kind, kind_ids in ids.items():
+        for obj in querysets[kind]([int(pk) for pk in kind_ids if pk.isdigit()]):
+            loaded[(kind, str(obj.pk))] = obj
+    return loaded
+
+
+def prefetch_rich_text(values):
+    '''
+    Expand the rich text of `values` for the rest of the request, loading the objects referred to
+    by those not cached at once.
+    '''
+    remembered = _get_expanded()
+    values = set(value for value in values if value and value not in remembered)
+    if not values:
+        return
+
+    references = {}
+    for html in values:
+        references[html] = get_references(html)
+        if not references[html]:
+            _remember(html, rich_text.expand_db_html(html))
+    values = [html for html in values if references[html]]
+    if not values:
+        return
+
+    versions = get_versions(set().union(*references.values()))
+    keys = dict((html, get_key(html, references[html], versions)) for html in values)
+    cached = cache.get_many(list(keys.values()))
+
+    missing = []
+    for html in values:
+        if keys[html] in cached:
+            _remember(html, cached[keys[html]])
+        else:
+            missing.append(html)
+    if not missing:
+        return
+
+    _local.loaded = load_references(set().union(*(references[html] for html in missing)))
+    try:
+        expanded = dict((html, rich_text.expand_db_html(html)) for html in missing)
+    finally:
+        del _local.loaded
+
+    cache.set_many(dict((keys[html], expanded[html]) for html in missing), RICH_TEXT_TIMEOUT)
+    for html in missing:
+        _remember(html, expanded[html])
+
+
+def prefetch_listing_rich_text(objects, fields=LISTING_FIELDS):
+    '''
+    Expand the rich text of the teasers of the pages or snippets listed, see prefetch_rich_text().
+    '''
+    values = []
+    for obj in objects:
+        for name in fields:
+            value = getattr(obj, name, None)
+            if isinstance(value, six.string_types):
+                values.append(value)
+    prefetch_rich_text(values)
+
+
+def get_loaded(kind, pk):
+    '''
+    Return whether the object was loaded by prefetch_rich_text(), and the object.
+    '''
+    loaded = getattr(_local, 'loaded', None)
+    if loaded is None or (kind, pk) not in loaded:
+        return False, None
+    return True, loaded[(kind, pk)]
+
+
+class PageLinkHandler(rich_text.PageLinkHandler):
+    @staticmethod
+    def expand_db_attributes(attrs, for_editor):
+        is_loaded, page = get_loaded('page', attrs.get('id'))
+        if for_editor or not is_loaded:
+            return rich_text.PageLinkHandler.expand_db_attributes(attrs, for_editor)
+        if page is None:
+            return '<a>'
+        return '<a href="%s">' % escape(page.url)
+
+
+class ImageHandler(ImageEmbedHandler):
+    @staticmethod
+    def expand_db_attributes(attrs, for_editor):
+        is_loaded, image = get_loaded('image', attrs.get('id'))
+        if for_editor or not is_loaded:
+            return ImageEmbedHandler.expand_db_attributes(attrs, for_editor)
+        if image is None:
+            return '<img>'
+        return get_image_format(attrs['format']).image_to_html(image, attrs['alt'])
+
+
+class DocumentHandler(DocumentLinkHandler):
+    @staticmethod
+    def expand_db_attributes(attrs, for_editor):
+        is_loaded, document = get_loaded('document', attrs.get('id'))
+        if for_editor or not is_loaded:
+            return DocumentLinkHandler.expand_db_attributes(attrs, for_editor)
+        if document is None:
+            return '<a>'
+        return '<a href="%s">' % escape(document.url)
+
+
+def richtext(value):
+    '''
+    The richtext filter, expanding the rich text with expand().
+    '''
+    if isinstance(value, rich_text.RichText):
+        value = value.source
+    html = expand(value) if value is not None else ''
+    return mark_safe('<div class="rich-text">' + html + '</div>')
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def reference_changed_handler(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    if isinstance(instance, (Page, get_image_model(), get_document_model())) or sender in get_snippet_models():
+        invalidate(get_kind(sender), instance.pk)
+
+
+@receiver(request_started)
+def request_started_handler(**kwargs):
+    forget_expanded()
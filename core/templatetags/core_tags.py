@@ -6,6 +6,7 @@ from django.db.models import ObjectDoesNotExist
 from six.moves.urllib.parse import urlparse
 
 from articles.models import Topic
+from core import rich_text
 
 register = template.Library()
 
@@ -17,6 +18,11 @@ def suggested_searches(number_of_suggestions):
     return search_suggestions
 
 
+@register.filter
+def cached_richtext(value):
+    return rich_text.richtext(value)
+
+
 @register.filter
 def search_string(topic):
     return topic.name.replace(" ", "+")
@@ -1,10 +1,78 @@
 from __future__ import absolute_import, unicode_literals
 
-from django.test import Client, TestCase
+import random
 
-from articles.models import ArticlePage, SeriesPage
+import mock
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.paginator import PageNotAnInteger
+from django.db import connection
+from django.test import Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from wagtail.wagtailcore.templatetags.wagtailcore_tags import richtext
+from wagtail.wagtailimages.formats import get_image_format
+from wagtail.wagtailimages.models import Filter
 
-from .models import HomePage
+from analytics.models import Analytics
+from articles.models import (ArticleListPage, ArticlePage, FeatureStyle,
+                             FeedEntry, Headline, SeriesPage, Topic)
+from images.models import AttributedImage
+from themes.models import Theme
+
+from .bulk import bulk_publish, bulk_unpublish, defer, deferred_side_effects
+from .cache_tags import get_cache_tag_header, get_listing_tag
+from .conditional import get_listing_etag, get_objects_version
+from .layout import ArticlePacker, resolve_articles
+from .models import HomePage, HomePageLayout
+from .pagination import is_cursor
+from .rich_text import (expand, forget_expanded, get_kind, get_versions,
+                        prefetch_listing_rich_text)
+from .templatetags.core_tags import cached_richtext
+
+
+def get_article_set(columns, rows, article_list, used):
+    '''
+    The layout of the home page articles before core.layout, loading each article as it is tried.
+    '''
+    if columns == 0 and rows == 0 or not article_list:
+        return []
+
+    current_set = []
+    while rows > 0:
+        row, height = fill_row(columns, article_list, used, rows)
+        if height == 0:
+            break
+        current_set.append(row)
+        rows = rows - height
+
+    return current_set
+
+
+def fill_row(columns, article_list, used, max_height):
+    if columns == 0 or not article_list:
+        return [], 0
+
+    for article in article_list:
+        typed_article = article.content_type.get_object_for_this_type(
+            id=article.id)
+        if typed_article.feature_style.number_of_columns <= columns \
+                and typed_article.id not in used\
+                and typed_article.feature_style.number_of_rows <= max_height:
+
+            columns = columns - typed_article.feature_style.number_of_columns
+            used.append(typed_article.id)
+            row = [typed_article]
+            max_height = min(max_height, typed_article.feature_style.number_of_rows)
+
+            if max_height > 1 and columns > 0:
+                subset = get_article_set(columns, max_height, article_list, used)
+                row.append(subset)
+            else:
+                recursive_row, height = fill_row(columns, article_list, used, max_height)
+                row.extend(recursive_row)
+            return row, max_height
+
+    return [], 0
 
 
 class HomePageTestCase(TestCase):
@@ -92,27 +160,37 @@ class HomePageTestCase(TestCase):
         self.assertSequenceEqual(home.articles, expected)
 
     def test_fill_row_1(self):
-        home = HomePage.objects.all().first()
-
         articles = SeriesPage.objects.live().all().order_by("-first_published_at")
 
         expected = [SeriesPage.objects.get(pk=116)]
-        actual, height = home._fill_row(1, articles, [], 1)
+        actual, height = fill_row(1, articles, [], 1)
 
         self.assertSequenceEqual(actual, expected)
         self.assertEqual(height, 1)
 
     def test_fill_row_2(self):
-        home = HomePage.objects.all().first()
-
         articles = SeriesPage.objects.live().all().order_by("-first_published_at")
 
         expected = [SeriesPage.objects.get(pk=116), SeriesPage.objects.get(pk=110), ]
-        actual, height = home._fill_row(2, articles, [], 1)
+        actual, height = fill_row(2, articles, [], 1)
 
         self.assertSequenceEqual(actual, expected)
         self.assertEqual(height, 1)
 
+    def test_articles_are_loaded_in_a_constant_number_of_queries(self):
+        home = HomePage.objects.all().first()
+        home.number_of_rows_of_articles = 12
+        home.number_of_columns_of_articles = 3
+
+        # The candidates, then the articles and the series with their feature styles and analytics,
+        # and the authors and topics of each (see ArticlePage.objects.for_listing())
+        with self.assertNumQueries(9):
+            rows = home.articles
+
+        with self.assertNumQueries(0):
+            home.most_popular_article
+            [article.feature_style.name for row in rows for article in row if not isinstance(article, list)]
+
     def test_feed(self):
         client = Client()
         resp = client.get('/feed/')
@@ -120,3 +198,454 @@ class HomePageTestCase(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertNotIn(b'<title>In Depth Articles - No Topic - Not Live</title>', resp.content)
         self.assertIn(b'<title>Test Article 2</title>', resp.content)
+
+
+class ConditionalGetTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def assertNotModified(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertFalse(response.templates)
+
+    def test_page(self):
+        self.assertNotModified('/features/')
+
+    def test_topic_page(self):
+        self.assertNotModified('/topics/topic-1/')
+
+    def test_feed(self):
+        self.assertNotModified('/feed/')
+
+    def test_sitemap(self):
+        self.assertNotModified('/sitemap.xml')
+
+    def test_listing_changes_when_a_page_is_published(self):
+        etag = self.client.get('/')['ETag']
+
+        ArticlePage.objects.get(pk=107).save_revision().publish()
+
+        response = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def get_article_etag(self):
+        # A request of its own, as the publish state is looked up once per request
+        return ArticlePage.objects.get(pk=107).get_etag(RequestFactory().get('/'))
+
+    def test_article_changes_when_a_page_it_shows_is_published(self):
+        etag = self.get_article_etag()
+        ArticlePage.objects.get(pk=108).save_revision().publish()
+        self.assertNotEqual(self.get_article_etag(), etag)
+
+    def test_pages_change_when_a_topic_or_theme_is_saved(self):
+        for obj in (Topic.objects.first(), Theme.objects.create(name="Dark", folder="themes/dark")):
+            etag = self.get_article_etag()
+            obj.save()
+            self.assertNotEqual(self.get_article_etag(), etag)
+
+    def test_versions_do_not_depend_on_the_cache(self):
+        # Which may be one per process
+        etag = self.get_article_etag()
+        cache.clear()
+        self.assertEqual(self.get_article_etag(), etag)
+
+    def test_versions_are_one_query(self):
+        self.get_article_etag()
+        request = RequestFactory().get('/')
+        with self.assertNumQueries(1):
+            get_listing_etag(request)
+            get_objects_version(request)
+
+    def test_logged_in_users_always_get_the_page(self):
+        self.client.force_login(get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get('/features/')
+        self.assertFalse(response.has_header('ETag'))
+
+
+class CacheTagTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def get_tags(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response['Cache-Tag'].split(',')
+
+    def test_page_names_itself_and_its_theme(self):
+        page = ArticleListPage.objects.get(slug='features')
+        tags = self.get_tags('/features/')
+        self.assertIn('page-{}'.format(page.pk), tags)
+        self.assertIn('theme-{}'.format(page.theme_id), tags)
+
+    def test_listing_names_the_articles_and_their_authors(self):
+        tags = self.get_tags('/features/')
+        article = ArticlePage.objects.get(pk=107)
+        self.assertIn('page-{}'.format(article.pk), tags)
+        for author in article.authors:
+            self.assertIn('contributor-{}'.format(author.pk), tags)
+
+    def test_topic_page_names_the_topic(self):
+        topic = Topic.objects.get(slug='topic-1')
+        self.assertIn('topic-{}'.format(topic.pk), self.get_tags('/topics/topic-1/'))
+
+    def test_feed_names_the_articles(self):
+        self.assertIn('page-107', self.get_tags('/feed/'))
+
+    def test_cursor_pages_name_their_listing(self):
+        features = ArticleListPage.objects.get(slug='features')
+        features.articles_per_page = 2
+        features.save()
+        self.assertNotIn(get_listing_tag(features), self.get_tags('/features/'))
+
+        cursor = features.get_paginator().page(1).next_page_number()
+        self.assertIn(get_listing_tag(features), self.get_tags('/features/?page={}'.format(cursor)))
+
+    def test_too_many_tags_fall_back_on_their_kinds(self):
+        tags = ['topic-{}'.format(i) for i in range(5000)] + ['page-1']
+        self.assertEqual(get_cache_tag_header(tags), 'pages,topics')
+
+
+class BulkPublishTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def test_deferred_functions_run_once_with_all_their_items(self):
+        calls = []
+
+        def record(items):
+            calls.append(items)
+
+        with deferred_side_effects():
+            with deferred_side_effects():
+                self.assertTrue(defer(record, 1))
+            self.assertTrue(defer(record, 2))
+            self.assertEqual(calls, [])
+
+        self.assertEqual(calls, [[1, 2]])
+
+    def test_nothing_is_deferred_outside_a_batch(self):
+        self.assertFalse(defer(lambda items: None, 1))
+
+    def test_nothing_runs_if_the_batch_fails(self):
+        calls = []
+
+        def record(items):
+            calls.append(items)
+
+        with self.assertRaises(ValueError):
+            with deferred_side_effects():
+                defer(record, 1)
+                raise ValueError
+        self.assertEqual(calls, [])
+
+    def test_bulk_unpublish_and_publish(self):
+        pages = list(ArticlePage.objects.live().order_by('pk')[:3])
+
+        self.assertEqual(len(bulk_unpublish(pages)), 3)
+        self.assertFalse(ArticlePage.objects.filter(pk__in=[page.pk for page in pages], live=True).exists())
+
+        self.assertEqual(len(bulk_publish(pages)), 3)
+        self.assertEqual(ArticlePage.objects.filter(pk__in=[page.pk for page in pages], live=True).count(), 3)
+
+    def test_home_page_headline_is_updated_once(self):
+        home = HomePage.objects.all().first()
+        home.featured_item = ArticlePage.objects.get(pk=107)
+        home.save()
+
+        bulk_publish([home, home])
+
+        headlines = Headline.objects.filter(containing_page=home)
+        self.assertEqual(headlines.count(), 1)
+        self.assertEqual(headlines.get().featured_item_id, 107)
+
+
+class ArticleLayoutParityTestCase(TestCase):
+    '''
+    The layout engine places articles exactly as get_article_set(), the layout the home page had
+    before it.
+    '''
+    fixtures = ["articlestest.json", ]
+
+    def setUp(self):
+        self.home = HomePage.objects.all().first()
+        self.styles = list(FeatureStyle.objects.all()) + [
+            FeatureStyle.objects.create(name=name, number_of_columns=columns, number_of_rows=rows)
+            for name, columns, rows in [
+                ('Double Width', 2, 1),
+                ('Double Height', 1, 2),
+                ('Double', 2, 2),
+                ('Triple Height', 1, 3),
+                ('Wide Triple Height', 2, 3),
+            ]
+        ]
+
+    def get_pages(self):
+        pages = list(ArticlePage.objects.live()) + list(SeriesPage.objects.live())
+        return sorted(pages, key=lambda page: page.first_published_at, reverse=True)
+
+    def assertSameLayout(self, columns, rows, used=()):
+        pages = self.get_pages()
+        expected = get_article_set(columns, rows, pages, list(used))
+        actual = ArticlePacker(resolve_articles(pages), list(used)).pack(columns, rows)
+        self.assertEqual(actual, expected, 'Different layouts for {} columns and {} rows'.format(columns, rows))
+
+    def assertSameLayouts(self, used=()):
+        for columns in range(0, 5):
+            for rows in range(0, 7):
+                self.assertSameLayout(columns, rows, used)
+
+    def test_fixture_styles(self):
+        self.assertSameLayouts()
+
+    def test_used_articles_are_left_out(self):
+        pages = self.get_pages()
+        self.assertSameLayouts(used=[pages[0].pk, pages[3].pk])
+
+    def test_random_styles(self):
+        generator = random.Random(11)
+        for attempt in range(4):
+            for model in (ArticlePage, SeriesPage):
+                for pk in model.objects.values_list('pk', flat=True):
+                    model.objects.filter(pk=pk).update(feature_style=generator.choice(self.styles))
+            self.assertSameLayouts()
+
+    def test_articles_without_a_feature_style_are_left_out(self):
+        page = self.get_pages()[0]
+        ArticlePage.objects.filter(pk=page.pk).update(feature_style=None)
+        SeriesPage.objects.filter(pk=page.pk).update(feature_style=None)
+
+        packer = ArticlePacker(resolve_articles(self.get_pages()))
+        packer.pack(3, 4)
+        self.assertTrue(packer.used)
+        self.assertNotIn(page.pk, packer.used)
+
+    def test_resolves_specific_pages_in_order(self):
+        pages = [page.page_ptr for page in self.get_pages()]
+        # Each type of page, with what it shows in listings
+        with self.assertNumQueries(8):
+            articles = resolve_articles(pages)
+        self.assertEqual([article.pk for article in articles], [page.pk for page in pages])
+        self.assertEqual(set(type(article) for article in articles), {ArticlePage, SeriesPage})
+
+
+class HomePageLayoutTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def setUp(self):
+        self.home = HomePage.objects.all().first()
+
+    def test_layout_has_the_computed_sections(self):
+        home = HomePage.objects.get(pk=self.home.pk)
+        home.load_layout()
+
+        computed = HomePage.objects.get(pk=self.home.pk)
+        self.assertEqual(home.articles, computed.articles)
+        self.assertEqual(home.most_popular_article, computed.most_popular_article)
+        self.assertEqual(home.series, [list(row) for row in computed.series])
+        self.assertEqual(home.graphics, [list(row) for row in computed.graphics])
+        self.assertEqual(home.external_articles, [list(row) for row in computed.external_articles])
+
+    def test_rendering_builds_the_layout_once(self):
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(HomePageLayout.objects.filter(home_page=self.home).exists())
+
+        home = HomePage.objects.get(pk=self.home.pk)
+        # The layout, then the queries of each type of page shown
+        with self.assertNumQueries(9):
+            home.load_layout()
+
+    def test_drafts_and_analytics_keep_the_layout(self):
+        self.home.build_layout()
+        article = ArticlePage.objects.get(pk=107)
+        article.save_revision()
+        Analytics.objects.create(page=article, last_period_views=10)
+        self.assertTrue(HomePageLayout.objects.exists())
+
+    def test_previews_lay_out_the_draft(self):
+        self.home.build_layout()
+        stored = HomePageLayout.objects.get(home_page=self.home).layout
+
+        draft = HomePage.objects.get(pk=self.home.pk)
+        draft.number_of_rows_of_articles = 1
+        draft.number_of_columns_of_articles = 1
+        request = RequestFactory().get('/')
+        request.is_preview = True
+        draft.get_context(request)
+
+        self.assertEqual(len(draft.articles), 1)
+        self.assertEqual(len(draft.articles[0]), 1)
+        self.assertEqual(HomePageLayout.objects.get(home_page=self.home).layout, stored)
+
+    def test_publishing_rebuilds_the_layout(self):
+        self.home.build_layout()
+        article = ArticlePage.objects.get(pk=111)
+        article.sticky = True
+        article.save_revision()
+        bulk_publish([article])
+
+        home = HomePage.objects.get(pk=self.home.pk)
+        with self.assertNumQueries(9):
+            home.load_layout()
+        self.assertEqual(home.articles[0][0], article)
+
+
+class KeysetPaginationTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def setUp(self):
+        cache.clear()
+        self.features = ArticleListPage.objects.get(slug='features')
+        self.features.articles_per_page = 2
+        self.expected = list(self.features.subpages)
+
+    def get_all_pages(self, paginator):
+        pages = [paginator.page(1)]
+        while pages[-1].has_next():
+            pages.append(paginator.page(pages[-1].next_page_number()))
+        return pages
+
+    def test_cursors_go_through_every_article_in_order(self):
+        pages = self.get_all_pages(self.features.get_paginator())
+
+        self.assertEqual([page.number for page in pages], [1, 2, 3])
+        self.assertEqual([article for page in pages for article in page], self.expected)
+        self.assertTrue(all(is_cursor(page.next_page_number()) for page in pages[:-1]))
+
+    def test_articles_without_a_publish_time_come_last(self):
+        FeedEntry.objects.filter(page_id__in=[107, 108, 109]).update(first_published_at=None)
+        pages = self.get_all_pages(self.features.get_paginator())
+        articles = [article for page in pages for article in page]
+
+        self.assertEqual(len(articles), len(self.expected))
+        self.assertEqual([article.pk for article in articles[-3:]], [109, 108, 107])
+
+    def test_previous_cursors_go_back(self):
+        paginator = self.features.get_paginator()
+        pages = self.get_all_pages(paginator)
+
+        previous = paginator.page(pages[2].previous_page_number())
+        self.assertEqual(previous.number, 2)
+        self.assertEqual(list(previous), list(pages[1]))
+        self.assertEqual(previous.previous_page_number(), 1)
+
+    def test_numbered_pages_match_the_cursors(self):
+        paginator = self.features.get_paginator()
+        pages = self.get_all_pages(paginator)
+
+        for page in pages:
+            self.assertEqual(list(paginator.page(page.number)), list(page))
+        self.assertEqual(list(paginator.page('2')), self.expected[2:4])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(PageNotAnInteger):
+            self.features.get_paginator().page('c.not-a-cursor')
+
+    def test_count_is_cached_until_publish(self):
+        self.assertEqual(self.features.get_paginator().count, len(self.expected))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.features.get_paginator().count, len(self.expected))
+
+        ArticlePage.objects.get(pk=107).unpublish()
+        self.assertEqual(self.features.get_paginator().count, len(self.expected) - 1)
+
+    @override_settings(ALLOWED_HOSTS=['localhost'])
+    def test_serves_cursor_pages(self):
+        self.features.save()
+        cursor = self.features.get_paginator().page(1).next_page_number()
+
+        response = self.client.get('/features/', {'page': cursor}, HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['articles']), self.expected[2:4])
+        self.assertContains(response, 'Page 2 of 3')
+
+        response = self.client.get('/features/', {'page': 'c.garbage'}, HTTP_HOST='localhost')
+        self.assertEqual(response.context['articles'].number, 1)
+
+
+class RichTextTestCase(TestCase):
+    fixtures = ["articlestest.json", ]
+
+    def setUp(self):
+        cache.clear()
+        forget_expanded()
+
+    def link(self, pk):
+        return '<p><a linktype="page" id="{}">Link</a></p>'.format(pk)
+
+    def image(self, pk=1):
+        return '<embed embedtype="image" id="{}" format="left" alt="An image"/>'.format(pk)
+
+    def test_expands_as_the_richtext_filter(self):
+        for html in (self.link(108) + self.image(), self.link(999), '<p>No links</p>', None):
+            self.assertEqual(cached_richtext(html), richtext(html))
+
+    def test_expansions_are_cached(self):
+        html = self.link(108) + self.image()
+        expanded = expand(html)
+        forget_expanded()
+        with self.assertNumQueries(0):
+            self.assertEqual(expand(html), expanded)
+
+    def test_rich_text_without_references_is_not_cached(self):
+        with mock.patch.object(cache, 'get', side_effect=AssertionError), \
+                mock.patch.object(cache, 'set', side_effect=AssertionError):
+            self.assertEqual(expand('<p>No links</p>'), '<p>No links</p>')
+            prefetch_listing_rich_text([ArticlePage(excerpt='<p>No links either</p>')])
+
+    def test_changing_a_linked_page_expands_again(self):
+        html = self.link(108)
+        page = ArticlePage.objects.get(pk=108)
+        self.assertIn('href="{}"'.format(page.url), expand(html))
+
+        page.slug = 'moved'
+        page.save()
+        self.assertIn('href="{}"'.format(page.url), expand(html))
+        self.assertIn('moved', expand(html))
+
+    def test_changing_an_embedded_image_expands_again(self):
+        html = self.image()
+        expand(html)
+        AttributedImage.objects.get(pk=1).save()
+        with self.assertNumQueries(2):
+            expand(html)
+
+    def test_snippets_get_new_versions_when_changed(self):
+        topic = Topic.objects.create(name='A Topic')
+        reference = (get_kind(Topic), str(topic.pk))
+        version = get_versions({reference})[reference]
+        topic.save()
+        self.assertNotEqual(get_versions({reference})[reference], version)
+
+    def test_listings_are_expanded_in_one_batch(self):
+        def count_queries(articles):
+            cache.clear()
+            forget_expanded()
+            for article, pk in zip(articles, (108, 109, 111, 115, 107)):
+                article.excerpt = self.link(pk) + self.image()
+            with CaptureQueriesContext(connection) as context:
+                prefetch_listing_rich_text(articles)
+            return len(context.captured_queries)
+
+        # The rendition of the image, which the fixture's missing file cannot be resized into
+        image = AttributedImage.objects.get(pk=1)
+        image_filter = Filter(spec=get_image_format('left').filter_spec)
+        image.renditions.create(
+            filter_spec=image_filter.spec, focal_point_key=image_filter.get_cache_key(image), file='left.jpg',
+            width=100, height=100,
+        )
+        articles = list(ArticlePage.objects.order_by('pk'))
+        self.assertEqual(count_queries(articles[:5]), count_queries(articles[:2]))
+
+        expected = [cached_richtext(article.excerpt) for article in articles[:5]]
+        forget_expanded()
+        prefetch_listing_rich_text(articles[:5])
+        with self.assertNumQueries(0):
+            self.assertEqual([cached_richtext(article.excerpt) for article in articles[:5]], expected)
+        self.assertEqual(expected, [richtext(article.excerpt) for article in articles[:5]])
@@ -1,11 +1,19 @@
 from __future__ import absolute_import
 
 from django.conf import settings
+from django.conf.urls import url
+from django.contrib import messages
 from django.core.urlresolvers import reverse
+from django.shortcuts import get_object_or_404, redirect, render
 from django.utils.html import format_html, format_html_join
+from wagtail.wagtailadmin.widgets import Button
 from wagtail.wagtailcore import hooks
+from wagtail.wagtailcore.models import Page
 from wagtail.wagtailcore.whitelist import attribute_rule
 
+from .bulk import bulk_publish, bulk_unpublish
+from .rich_text import DocumentHandler, ImageHandler, PageLinkHandler
+
 
 @hooks.register('construct_whitelister_element_rules')
 def whitelister_element_rules():
@@ -14,6 +22,22 @@ def whitelister_element_rules():
     }
 
 
+# After those of wagtailimages and wagtaildocs, which they replace
+@hooks.register('register_rich_text_link_handler', order=100)
+def register_page_link_handler():
+    return ('page', PageLinkHandler)
+
+
+@hooks.register('register_rich_text_link_handler', order=100)
+def register_document_link_handler():
+    return ('document', DocumentHandler)
+
+
+@hooks.register('register_rich_text_embed_handler', order=100)
+def register_image_embed_handler():
+    return ('image', ImageHandler)
+
+
 @hooks.register('insert_editor_js')
 def editor_js():
     js_files = [
@@ -59,3 +83,47 @@ class LogoutLinkItem(object):
 @hooks.register('construct_wagtail_userbar')
 def add_logout_link_item(request, items):
     return items.append(LogoutLinkItem())
+
+
+def bulk_publish_view(request, parent_page_id):
+    parent_page = get_object_or_404(Page, id=parent_page_id)
+    pages = parent_page.get_children().order_by('-latest_revision_created_at')
+
+    if request.method == 'POST':
+        selected = pages.filter(id__in=request.POST.getlist('page'))
+        if 'unpublish' in request.POST:
+            allowed = [page for page in selected if page.permissions_for_user(request.user).can_unpublish()]
+            done = bulk_unpublish(allowed)
+            messages.success(request, "{} pages were unpublished.".format(len(done)))
+        else:
+            allowed = [page for page in selected if page.permissions_for_user(request.user).can_publish()]
+            done = bulk_publish(allowed, user=request.user)
+            messages.success(request, "{} pages were published.".format(len(done)))
+
+        if len(allowed) < len(selected):
+            messages.warning(request, "You do not have permission to change {} of the pages.".format(
+                len(selected) - len(allowed)))
+        return redirect('wagtailadmin_explore', parent_page.id)
+
+    return render(request, 'wagtailadmin/bulk_publish.html', {
+        'parent_page': parent_page,
+        'pages': pages,
+    })
+
+
+@hooks.register('register_admin_urls')
+def bulk_publish_urls():
+    return [
+        url(r'^pages/(\d+)/bulk_publish/$', bulk_publish_view, name='admin_bulk_publish'),
+    ]
+
+
+@hooks.register('register_page_listing_more_buttons')
+def bulk_publish_button(page, page_perms, is_parent=False):
+    if page.numchild:
+        yield Button(
+            'Bulk publish',
+            reverse('admin_bulk_publish', args=[page.id]),
+            attrs={'title': "Publish or unpublish the children of '{}'".format(page.get_admin_display_title())},
+            priority=60,
+        )
@@ -46,6 +46,7 @@ class EventListPage(PaginatedListPageMixin, ThemeablePage):
     events_per_page = models.IntegerField(default=20)
     counter_field_name = 'events_per_page'
     counter_context_name = 'events'
+    keyset_field = 'date'
 
     @property
     def subpages(self):
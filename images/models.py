@@ -1,8 +1,9 @@
 from __future__ import absolute_import, unicode_literals
 
+import six
 from django.db import models
 from wagtail.wagtailimages.models import (AbstractImage, AbstractRendition,
-                                          Image)
+                                          Filter, Image)
 
 
 class AttributedImage(AbstractImage):
@@ -16,6 +17,19 @@ class AttributedImage(AbstractImage):
         "usage_restrictions",
     )
 
+    def get_rendition(self, filter):
+        # Renditions prefetched with the image, as listings do, are looked up without a query
+        renditions = getattr(self, '_prefetched_objects_cache', {}).get('renditions')
+        if renditions is not None:
+            if isinstance(filter, six.string_types):
+                filter = Filter(spec=filter)
+            cache_key = filter.get_cache_key(self)
+            for rendition in renditions:
+                if rendition.filter_spec == filter.spec and rendition.focal_point_key == cache_key:
+                    return rendition
+
+        return super(AttributedImage, self).get_rendition(filter)
+
 
 class AttributedRendition(AbstractRendition):
     image = models.ForeignKey(AttributedImage, related_name='renditions')
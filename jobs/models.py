@@ -34,6 +34,7 @@ class JobPostingListPage(PaginatedListPageMixin, ThemeablePage):
     jobs_per_page = models.IntegerField(default=10)
     counter_field_name = 'jobs_per_page'
     counter_context_name = 'jobs'
+    keyset_field = 'first_published_at'
 
     @property
     def subpages(self):
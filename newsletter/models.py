@@ -16,6 +16,7 @@ from themes.models import ThemeablePage
 
 @python_2_unicode_compatible
 class NewsletterListPage(ThemeablePage):
+    lists_pages = True
     subpage_types = ['NewsletterPage']
     intro_text = RichTextField()
     body = RichTextField()
@@ -85,6 +85,11 @@ LOGGING = {
             'handlers': ['console'],
             'propagate': False,
         },
+        'core.memo': {
+            'level': 'DEBUG',
+            'handlers': ['console'],
+            'propagate': False,
+        },
         'raven': {
             'level': 'DEBUG',
             'handlers': ['console'],
@@ -84,6 +84,18 @@ CACHES = {
     }
 }
 
+# Full page cache for anonymous visitors, see caching/page_cache.py
+CACHING_PAGE_CACHE_ENABLED = True
+
+# Rendered chapters and body blocks of articles, see caching/fragments.py
+CACHING_FRAGMENT_CACHE_ENABLED = True
+
+# Publishes rescore the related articles outside of the request, see articles/related.py
+RELATED_ARTICLES_IN_BACKGROUND = True
+
+# First, so that it stores the response once every other middleware has processed it
+MIDDLEWARE_CLASSES = ('caching.middleware.PageCacheMiddleware',) + MIDDLEWARE_CLASSES
+
 IS_PRODUCTION = True
 
 LOGGING = {
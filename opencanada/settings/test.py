@@ -5,3 +5,10 @@ from .base import *
 DEBUG = False
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+INSTALLED_APPS = INSTALLED_APPS + (
+    'caching',
+)
+
+# Nothing is sent to Cloudflare: tests purging run inside caching.fake_cloudflare.fake_cloudflare()
+CACHING_PURGE_ENABLED = False
@@ -6,6 +6,7 @@ from django.conf import settings
 from django.conf.urls import include, url
 from django.conf.urls.static import static
 from django.contrib import admin
+from django.views.decorators.http import condition
 from django.views.defaults import server_error
 
 from wagtail.wagtailadmin import urls as wagtailadmin_urls
@@ -13,6 +14,8 @@ from wagtail.wagtailcore import urls as wagtail_urls
 from wagtail.wagtaildocs import urls as wagtaildocs_urls
 from wagtail.wagtailsearch import urls as wagtailsearch_urls
 
+from core.cache_tags import cache_tagged
+from core.conditional import get_listing_etag, get_listing_last_modified
 from core.feeds import MainFeed
 from core.views import chooser_search, site_search, template_error
 
@@ -22,7 +25,7 @@ base_urlpatterns = [
     url(r'^documents/', include(wagtaildocs_urls)),
     url(r'^', include('favicon.urls')),
     url(r'^', include('sitemap.urls')),
-    url(r'^feed/$', MainFeed(), name='main_feed'),
+    url(r'^feed/$', condition(get_listing_etag, get_listing_last_modified)(cache_tagged(MainFeed())), name='main_feed'),
     url(r'^error/$', lambda r: 1 / 0, name='error'),
     url(r'^template_error/$', template_error, name='template_error'),
     url(r'^core/', include('core.urls', namespace='core')),
@@ -17,6 +17,8 @@ from themes.models import ThemeablePage
 
 
 class ContributorListPage(ThemeablePage):
+    lists_pages = True
+    cache_tags = ('contributors',)
     subpage_types = ['ContributorPage']
 
     def get_rows(self, contributors, number_of_columns=3, max_columns=4):
@@ -71,6 +73,8 @@ class ContributorListPage(ThemeablePage):
 
 @python_2_unicode_compatible
 class ContributorPage(ThemeablePage):
+    lists_pages = True
+
     first_name = models.CharField(max_length=255, blank=True, default="")
     last_name = models.CharField(max_length=255, blank=True, default="")
     nickname = models.CharField(max_length=1024, blank=True, default="")
@@ -11,6 +11,7 @@ from themes.models import ThemeablePage
 
 
 class ProjectListPage(ThemeablePage):
+    lists_pages = True
     subpage_types = ['ProjectPage']
 
     @property
@@ -30,6 +31,9 @@ class ProjectListPage(ThemeablePage):
 
 @python_2_unicode_compatible
 class ProjectPage(ThemeablePage):
+    # Shows the articles and series of the project
+    lists_pages = True
+
     description = RichTextField(blank=True, default="")
 
     search_fields = Page.search_fields + [
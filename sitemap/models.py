@@ -3,7 +3,7 @@ from django.utils.timezone import datetime, get_default_timezone, make_aware
 
 from articles.models import (ArticleListPage, ArticlePage,
                              ExternalArticleListPage, SeriesListPage,
-                             SeriesPage, Topic, TopicListPage)
+                             SeriesPage, Topic, TopicListPage, TopicStats)
 from core.models import HomePage
 from events.models import EventListPage, EventPage
 from jobs.models import JobPostingListPage, JobPostingPage
@@ -99,18 +99,22 @@ class TopicSitemap(Sitemap):
     changefreq = "always"
     priority = 0.6
 
+    _topic_list_page = None
+
     def items(self):
-        return Topic.objects.all()
+        return Topic.objects.select_related('stats')
 
     def lastmod(self, obj):
-        article = obj.articles.first()
-        if article:
-            return article.latest_revision_created_at
-        else:
-            return make_aware(datetime.min, get_default_timezone())
+        try:
+            latest_published_at = obj.stats.latest_published_at
+        except TopicStats.DoesNotExist:
+            latest_published_at = None
+        return latest_published_at or make_aware(datetime.min, get_default_timezone())
 
     def location(self, obj):
-        topic_list_page = TopicListPage.objects.all().first()
+        if self._topic_list_page is None:
+            self._topic_list_page = TopicListPage.objects.all().first()
+        topic_list_page = self._topic_list_page
         return "{}{}".format(topic_list_page.url, topic_list_page.reverse_subpage('topic', args=(obj.slug, )))
 
 
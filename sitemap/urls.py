@@ -1,5 +1,9 @@
 from django.conf.urls import url
 from django.contrib.sitemaps.views import sitemap
+from django.views.decorators.http import condition
+
+from core.cache_tags import cache_tagged
+from core.conditional import get_listing_etag, get_listing_last_modified
 
 from . import models
 
@@ -22,6 +26,8 @@ sitemaps = {
 }
 
 urlpatterns = [
-    url(r'^sitemap\.xml$', sitemap, {'sitemaps': sitemaps},
+    url(r'^sitemap\.xml$',
+        condition(get_listing_etag, get_listing_last_modified)(cache_tagged(sitemap, tags=['topics'])),
+        {'sitemaps': sitemaps},
         name='django.contrib.sitemaps.views.sitemap')
 ]
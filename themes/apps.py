@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class ThemesAppConfig(AppConfig):
+    name = 'themes'
+    label = 'themes'
+    verbose_name = "Themes"
+
+    def ready(self):
+        from .resolver import prewarm
+
+        prewarm()
@@ -1,24 +1,32 @@
 from __future__ import absolute_import, unicode_literals
 
-from django.template.loader import TemplateDoesNotExist, render_to_string
+from django.template.loader import render_to_string
 from wagtail.wagtailcore.blocks import StructBlock
 
+from ..resolver import resolve_theme_template
+
 # unicode_literals ensures that any render / __str__ methods returning HTML via calls to mark_safe / format_html
 # return a SafeText, not SafeBytes; necessary so that it doesn't get re-encoded when the template engine
 # calls force_text, which would cause it to lose its 'safe' flag
 
 
-__all__ = ['ThemeableStructBlock']
+__all__ = ['ThemeableStructBlock', 'get_context_theme']
 
+# Name of the theme of the page being rendered in the template context, see ThemeablePage.get_context()
+THEME_CONTEXT_NAME = 'theme'
 
-class ThemeableStructBlock(StructBlock):
-    def __init__(self, **kwargs):
-        super(ThemeableStructBlock, self).__init__(**kwargs)
-        self.theme = None
 
-    def set_theme(self, theme):
-        self.theme = theme
+def get_context_theme(context):
+    if context is None:
+        return None
+    return context.get(THEME_CONTEXT_NAME)
+
 
+class ThemeableStructBlock(StructBlock):
+    '''
+    A block rendered with the template of the theme of the page being rendered, if the theme has
+    one. The theme is read from the render context, blocks being shared by every page.
+    '''
     def render(self, value, context=None):
         """
         Return a text rendering of 'value', suitable for display on templates. By default, this will
@@ -27,18 +35,8 @@ class ThemeableStructBlock(StructBlock):
         """
         template = getattr(self.meta, 'template', None)
         if template:
-            if self.theme:
-                theme_template = "{}/{}".format(self.theme.folder, template)
-
-                if context is None:
-                    new_context = self.get_context(value)
-                else:
-                    new_context = self.get_context(value, parent_context=dict(context))
-
-                try:
-                    return render_to_string(theme_template, new_context)
-                except TemplateDoesNotExist:
-                    # Template for the Block does not exist in the Theme...
-                    return render_to_string(template, new_context)
-        else:
-            return self.render_basic(value)
+            theme_template = resolve_theme_template(get_context_theme(context), template)
+            if theme_template != template:
+                return render_to_string(theme_template, self.get_context(value, parent_context=dict(context)))
+
+        return super(ThemeableStructBlock, self).render(value, context=context)
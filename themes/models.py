@@ -1,21 +1,19 @@
 from __future__ import absolute_import, division, unicode_literals
 
-import itertools
-
 from django.db import models
 from django.utils.encoding import python_2_unicode_compatible
 from modelcluster.fields import ParentalKey
 from modelcluster.models import ClusterableModel
 from wagtail.wagtailadmin.edit_handlers import (FieldPanel, InlinePanel,
                                                 MultiFieldPanel)
-from wagtail.wagtailcore.blocks import StreamBlock
-from wagtail.wagtailcore.fields import RichTextField, StreamField
+from wagtail.wagtailcore.fields import RichTextField
 from wagtail.wagtailcore.models import Page
 from wagtail.wagtailimages.edit_handlers import ImageChooserPanel
 from wagtail.wagtailsnippets.edit_handlers import SnippetChooserPanel
 from wagtail.wagtailsnippets.models import register_snippet
 
-from .blocks import ThemeableStructBlock
+from .blocks.base import THEME_CONTEXT_NAME
+from .resolver import resolve_theme_template
 
 
 def get_default_theme_object():
@@ -78,41 +76,67 @@ class ThemeablePage(Page):
                               on_delete=models.SET_NULL,
                               null=True)
 
+    # Pages listing other pages change whenever any page is published, unpublished or deleted
+    lists_pages = False
+
+    # Cache tags of the objects the page depends on besides itself, see core/cache_tags.py
+    cache_tags = ()
+
+    def get_etag(self, request):
+        from core.conditional import get_listing_etag, get_objects_version
+
+        # Every page shows the content of its theme, and most the names of topics
+        etag = 'page-{}-{}-{}-{}'.format(self.pk, self.live_revision_id, self.theme_id, get_objects_version(request))
+        if self.lists_pages:
+            etag += '-' + get_listing_etag(request)
+        return etag
+
+    def get_last_modified(self, request):
+        from core.conditional import get_listing_last_modified
+
+        last_modified = self.last_published_at or self.latest_revision_created_at
+        if self.lists_pages:
+            newest = get_listing_last_modified(request)
+            if newest and (last_modified is None or newest > last_modified):
+                last_modified = newest
+        return last_modified
+
+    def serve_conditionally(self, request, serve, *args, **kwargs):
+        '''
+        Answer with a 304 if the visitor already has the current version of the page, otherwise
+        serve it with serve() and set ETag, Last-Modified and Cache-Tag.
+        '''
+        from core.cache_tags import add_cache_tags, add_page_tags, set_cache_tag_header
+        from core.conditional import serve_conditionally
+
+        user = getattr(request, 'user', None)
+        is_anonymous = user is None or not user.is_authenticated
+        if request.method not in ('GET', 'HEAD') or getattr(request, 'is_preview', False) or not is_anonymous:
+            return serve(request, *args, **kwargs)
+
+        def serve_tagged(request, *args, **kwargs):
+            add_page_tags(request, [self])
+            add_cache_tags(request, self.cache_tags)
+            return set_cache_tag_header(request, serve(request, *args, **kwargs))
+
+        return serve_conditionally(request, self.get_etag(request), self.get_last_modified(request),
+                                   serve_tagged, *args, **kwargs)
+
     def serve(self, request, *args, **kwargs):
-        from articles.fields import ChapterField
-        if self.theme:
-            # If a theme is set, 'Push' the theme down to the blocks, if possible
-            for field in self._meta.fields:
-                # Each StreamField and ChapterField should have a StreamBlock
-                if not isinstance(field, StreamField) and not isinstance(field, ChapterField):
-                    continue
-
-                stream_block = field.stream_block
-                if not isinstance(stream_block, StreamBlock):
-                    continue
-
-                if isinstance(field, ChapterField):
-                    ordered_blocks = itertools.chain(
-                        stream_block.child_blocks.values(),
-                        stream_block.child_blocks['chapter'].child_blocks['body'].child_blocks.values()
-                    )
-                else:
-                    # Assuming that each StreamBlock has an ordered dict of child Blocks
-                    ordered_blocks = stream_block.child_blocks.values()
-                for block in ordered_blocks:
-                    # We only need to set the Theme for blocks that support themes
-                    if isinstance(block, ThemeableStructBlock):
-                        block.set_theme(self.theme)
+        return self.serve_conditionally(request, self._serve, *args, **kwargs)
 
+    def _serve(self, request, *args, **kwargs):
         return super(ThemeablePage, self).serve(request, *args, **kwargs)
 
+    def get_context(self, request, *args, **kwargs):
+        # Themeable blocks render with the templates of the theme in the context, see themes/blocks
+        context = super(ThemeablePage, self).get_context(request, *args, **kwargs)
+        context[THEME_CONTEXT_NAME] = self.theme
+        return context
+
     def get_template(self, request, *args, **kwargs):
         original_template = super(ThemeablePage, self).get_template(request, *args, **kwargs)
-        if self.theme:
-            custom_template = "{}/{}".format(self.theme.folder, original_template)
-            return custom_template
-        else:
-            return original_template
+        return resolve_theme_template(self.theme, original_template)
 
     style_panels = [
         MultiFieldPanel(
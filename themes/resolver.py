@@ -0,0 +1,87 @@
+'''
+Finds which template a theme has for a template of the site, such as the theme's
+"themes/maplewashing/articles/blocks/chapter.html" for "articles/blocks/chapter.html", without
+searching the template loaders on every render.
+
+The templates of the theme folders are listed once at startup (see themes/apps.py), and what each
+(theme folder, template) pair resolves to is kept for the life of the process, including the pairs
+for which the theme has no template. With DEBUG on, those are searched for again on each render,
+so that templates added to a theme show up without a restart.
+'''
+from __future__ import absolute_import, unicode_literals
+
+import os
+
+from django.conf import settings
+from django.template.loader import TemplateDoesNotExist, get_template
+from django.template.utils import get_app_template_dirs
+
+# Directory of the template directories the theme folders are in
+THEMES_DIRECTORY = 'themes'
+
+# The template of each (theme folder, template) pair resolved, either the theme's or the template
+_resolved = {}
+
+# The names of the templates found in the theme folders
+_theme_templates = set()
+
+
+def find_theme_templates():
+    '''
+    Return the names of the templates in the theme folders of the template directories.
+    '''
+    directories = []
+    for engine in settings.TEMPLATES:
+        directories.extend(engine.get('DIRS', []))
+        if engine.get('APP_DIRS'):
+            directories.extend(get_app_template_dirs('templates'))
+
+    names = set()
+    for directory in directories:
+        for root, dirs, files in os.walk(os.path.join(directory, THEMES_DIRECTORY)):
+            for filename in files:
+                path = os.path.relpath(os.path.join(root, filename), directory)
+                names.add(path.replace(os.sep, '/'))
+    return names
+
+
+def prewarm():
+    clear()
+    _theme_templates.update(find_theme_templates())
+
+
+def clear():
+    _resolved.clear()
+    _theme_templates.clear()
+
+
+def template_exists(name):
+    try:
+        get_template(name)
+    except TemplateDoesNotExist:
+        return False
+    return True
+
+
+def resolve_theme_template(theme, template):
+    '''
+    Return the name of the template `theme` has for `template`, or `template` if it has none or
+    there is no theme.
+    '''
+    if theme is None or not theme.folder:
+        return template
+
+    key = (theme.folder, template)
+    resolved = _resolved.get(key)
+    if resolved is not None:
+        return resolved
+
+    resolved = '{}/{}'.format(theme.folder, template)
+    if resolved not in _theme_templates and not template_exists(resolved):
+        # Searched for once, unless with DEBUG on
+        resolved = template
+        if settings.DEBUG:
+            return resolved
+
+    _resolved[key] = resolved
+    return resolved